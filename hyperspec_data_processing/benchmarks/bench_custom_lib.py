@@ -0,0 +1,217 @@
+"""Throughput benchmarks for custom_lib on synthetic hyperspectral data
+
+Generates a BIL/HDR tray image and white/dark calibration frames of a configurable size,
+then times the hot path of the lab pipeline. Every benchmark runs in its own process so
+that its peak RSS and bytes read are not mixed up with the other benchmarks.
+
+Run from the hyperspec_data_processing folder, e.g.:
+    python benchmarks/bench_custom_lib.py --bands 480 --lines 512 --samples 640 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import fnmatch
+import argparse
+import resource
+import platform
+import warnings
+import tempfile
+import multiprocessing
+
+import numpy as np
+from rasterio.errors import NotGeoreferencedWarning
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from custom_lib import hyperspectral, utils  # noqa: E402
+
+TRAITS = ['ndvi', 'npci', 'psri', 'ndre', 'ccci', 'pri']
+INDEX_FUNCTIONS = ['ndvi', 'ndre', 'ccci', 'npci', 'psri', 'pri', 'sr', 'sipi', 'rgr', 'cri1', 'cri2', 'ari1',
+                   'ari2', 'rndvi', 'npqi']
+
+
+def write_synthetic_bil(base_filepath, lines, samples, bands, nbits, low, high, seed=0):
+    """Writes a random BIL image and a matching HDR file (wavelengths 390-1000nm)"""
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype('<u1') if nbits <= 8 else np.dtype('<u2')
+    high = min(high, 2 ** nbits - 1)
+    with open(base_filepath + hyperspectral.BIL_EXTENSION, 'wb') as bil_file:
+        # Written a line at a time to keep memory flat for large cubes
+        for _ in range(lines):
+            rng.integers(low, high, size=(bands, samples), dtype=dtype, endpoint=True).tofile(bil_file)
+
+    with open(base_filepath + hyperspectral.HDR_EXTENSION, 'w') as hdr_file:
+        hdr_file.write('BYTEORDER I\nLAYOUT BIL\nNROWS {}\nNCOLS {}\nNBANDS {}\nNBITS {}\n'.format(
+            lines, samples, bands, nbits))
+        hdr_file.write('WAVELENGTHS\n')
+        for wavelength in np.linspace(390, 1000, bands):
+            hdr_file.write('{:.2f}\n'.format(wavelength))
+        hdr_file.write('WAVELENGTHS_END\n')
+
+
+def make_dataset(folder, bands, lines, samples, nbits, calib_lines):
+    """Creates the synthetic tray image and calibration frames, returns their base paths"""
+    full_scale = 2 ** nbits - 1
+    paths = {name: os.path.join(folder, name) for name in ('tray', 'white', 'dark')}
+    write_synthetic_bil(paths['tray'], lines, samples, bands, nbits, full_scale // 8, full_scale * 3 // 4, seed=1)
+    write_synthetic_bil(paths['white'], calib_lines, samples, bands, nbits, full_scale * 3 // 4, full_scale, seed=2)
+    write_synthetic_bil(paths['dark'], calib_lines, samples, bands, nbits, 0, full_scale // 10, seed=3)
+    return paths
+
+
+def _io_counters():
+    """rchar (bytes requested through read calls) and read_bytes (bytes fetched from storage)
+
+    Pages faulted in through the memmap backend do not count towards rchar, only towards
+    read_bytes when they are not already in the page cache
+    """
+    counters = {'rchar': None, 'read_bytes': None}
+    try:
+        with open('/proc/self/io') as io_file:
+            for line in io_file:
+                key, _, value = line.partition(':')
+                if key in counters:
+                    counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
+
+
+def _max_rss_mb():
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+
+
+def _image(paths, backend):
+    return hyperspectral.HyperspectralImage(paths['tray'], paths['white'], paths['dark'], backend=backend)
+
+
+def _benchmarks(paths, backend):
+    """Benchmark name -> (setup, run). setup is untimed, run(state) is the timed part"""
+
+    def cube_setup():
+        image = _image(paths, backend)
+        return image.extract_all_layers(dtype=np.float32)
+
+    benchmarks = {
+        'load_hyperspectral_image': (
+            lambda: None,
+            lambda _: hyperspectral.LOADERS[backend](paths['tray']).read()),
+        'get_calib_values': (
+            lambda: _image(paths, backend),
+            lambda image: (hyperspectral.clear_calib_cache(), image.get_calib_values())),
+        'extract_image_layer': (
+            lambda: _image(paths, backend),
+            lambda image: image.extract_image_layer(700)),
+        'extract_all_layers': (
+            lambda: _image(paths, backend),
+            lambda image: image.extract_all_layers()),
+        'extract_all_layers_float32': (
+            lambda: _image(paths, backend),
+            lambda image: image.extract_all_layers(dtype=np.float32)),
+        'iter_line_blocks': (
+            lambda: _image(paths, backend),
+            lambda image: sum(block.shape[0] for _, block in image.iter_line_blocks(64))),
+        'compute_indices_traits': (
+            cube_setup,
+            lambda cube: utils.compute_indices(cube[1], cube[0], TRAITS)),
+    }
+    benchmarks['spectral_contact_sheet'] = (
+        cube_setup,
+        lambda cube: utils.spectral_contact_sheet(cube[1] * 255, cube[0], step=4))
+    for name in INDEX_FUNCTIONS:
+        benchmarks['get_' + name] = (
+            cube_setup,
+            lambda cube, name=name: getattr(utils, 'get_' + name)(cube[1], cube[0]))
+    return benchmarks
+
+
+def _run_benchmark(paths, backend, name, repeat, queue):
+    """Runs one benchmark in the current (child) process and puts its result on queue"""
+    # The lab images carry no georeferencing
+    warnings.simplefilter('ignore', NotGeoreferencedWarning)
+    try:
+        setup, run = _benchmarks(paths, backend)[name]
+        state = setup()
+        setup_rss_mb = _max_rss_mb()
+        io_start = _io_counters()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run(state)
+            times.append(time.perf_counter() - start)
+        io_end = _io_counters()
+        result = {
+            'wall_time_s': min(times),
+            'wall_time_median_s': float(np.median(times)),
+            'setup_peak_rss_mb': setup_rss_mb,
+            'peak_rss_mb': _max_rss_mb(),
+        }
+        for key in io_start:
+            total = None if io_start[key] is None else io_end[key] - io_start[key]
+            result[key + '_per_run'] = None if total is None else total // repeat
+        queue.put(result)
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+
+def run_benchmarks(paths, backends, repeat=3, only=None):
+    """Runs every benchmark for every backend, each in a fresh process
+
+    Returns:
+        (list of dict): One result per benchmark and backend
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for backend in backends:
+        for name in _benchmarks(paths, backend):
+            if only is not None and not fnmatch.fnmatch(name, only):
+                continue
+            queue = context.Queue()
+            process = context.Process(target=_run_benchmark, args=(paths, backend, name, repeat, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            result.update({'benchmark': name, 'backend': backend})
+            results.append(result)
+            if 'error' in result:
+                print('{:<28} {:<9} failed: {}'.format(name, backend, result['error']))
+            else:
+                print('{:<28} {:<9} {:>9.4f}s  peak {:>8.1f}MB  read {:>12}B'.format(
+                    name, backend, result['wall_time_s'], result['peak_rss_mb'], result['rchar_per_run']))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark custom_lib on synthetic hyperspectral cubes')
+    parser.add_argument('--bands', type=int, default=hyperspectral.NUM_HYPERSPECTRAL_CHANNELS)
+    parser.add_argument('--lines', type=int, default=256, help='rows of the tray image')
+    parser.add_argument('--samples', type=int, default=320, help='columns of the tray image')
+    parser.add_argument('--nbits', type=int, default=12, help='bit depth of the synthetic data')
+    parser.add_argument('--calib_lines', type=int, default=32, help='rows of the calibration frames')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark, the fastest is reported')
+    parser.add_argument('--backends', nargs='+', default=list(hyperspectral.LOADERS), help='loaders to benchmark')
+    parser.add_argument('--only', type=str, default=None, help='glob of benchmark names to run')
+    parser.add_argument('--data_dir', type=str, default=None, help='where to write the synthetic data')
+    parser.add_argument('--output', type=str, default='bench_results.json', help='json results path')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.data_dir) as folder:
+        paths = make_dataset(folder, args.bands, args.lines, args.samples, args.nbits, args.calib_lines)
+        results = run_benchmarks(paths, args.backends, repeat=args.repeat, only=args.only)
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                    'cpu_count': os.cpu_count(), 'numpy': np.__version__},
+        'results': results,
+    }
+    with open(args.output, 'w') as json_file:
+        json.dump(report, json_file, indent=2)
+    print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+"""Batch processing of all trays in a hyperspectral lab dataset
+
+Runs the same per-tray steps as Hyperspec_lab_pipeline.ipynb (calibrate, mask, compute
+indices, average over the plant mask) across a process pool, writing each tray's row to
+the output csv as soon as it is done
+"""
+import os
+import csv
+import glob
+import fnmatch
+import logging
+import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import cv2
+import numpy as np
+from natsort import natsorted
+
+from .header import DatasetIndex
+from .hyperspectral import HyperspectralImage
+from .render import grid, render_index, render_panel, save_rgb
+from .utils import compute_indices, index_band_indices, MaskedIndexMeans, SPECTRAL_INDICES
+
+TRAIT_NAMES = ('NDVI', 'NPCI', 'PSRI', 'NDRE', 'CCCI', 'PRI')
+CALIB_PATTERN = '*_round-0_cam-1_calibFrame.hdr'
+TRAY_PATTERN = '*-Tray_*.bil'
+TRAY_IMAGE_SUFFIX = '_round-0_cam-1_tray-Tray_'
+
+logger = logging.getLogger(__name__)
+
+
+def hyp_mask(file_name):
+    """Plant mask from the reference png of a tray, as used by the lab notebook
+
+    Returns:
+        (numpy ndarray): uint8 mask, 255 on plant pixels
+    """
+    return hyp_mask_images(file_name)[0]
+
+
+def hyp_mask_images(file_name):
+    """hyp_mask along with the images it is made from, for display
+
+    Returns:
+        (numpy ndarray): uint8 mask, 255 on plant pixels
+        (numpy ndarray): The reference png (BGR)
+        (numpy ndarray): The reference png with everything but the green pixels set to 0
+    """
+    img = cv2.imread(file_name)
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+
+    mask = cv2.inRange(hsv, (38, 25, 25), (68, 255, 255))
+
+    # slice the green
+    imask = mask > 0
+    green = np.zeros_like(img, np.uint8)
+    green[imask] = img[imask]
+
+    # Convert the 'green' image to grayscale to make it single channel
+    th = cv2.cvtColor(green, cv2.COLOR_BGR2GRAY)
+
+    # Set the grayscale values to 255 where mask is >0
+    th[th > 0] = 255
+
+    kernel = np.ones((2, 2), np.uint8)
+
+    # Apply opening operation
+    th = cv2.morphologyEx(th, cv2.MORPH_OPEN, kernel)
+
+    return th, img, green
+
+
+def find_tray_jobs(dataset_path, calib_pattern=CALIB_PATTERN, tray_pattern=TRAY_PATTERN):
+    """Pairs every tray image with its reference png and white/dark calibration frames
+
+    Follows the file naming of the lab notebook: the pngs are taken in natural order, one
+    per tray, and each round of trays uses the next (white, dark) pair of calibration files
+
+    Returns:
+        (list of tuple): (tray_id, png path, hyperspectral image path, white calib, dark calib)
+
+    Raises:
+        ValueError: If there are fewer than two calibration files per round of trays
+    """
+    files = os.listdir(dataset_path)
+    no_t = len([file for file in files if fnmatch.fnmatch(file, tray_pattern)])
+    all_img_path = natsorted(glob.glob(os.path.join(dataset_path, '*.png')))
+    all_calib_file = natsorted(glob.glob(os.path.join(dataset_path, calib_pattern)))
+    if no_t == 0:
+        return []
+    rounds = len(all_img_path) // no_t
+    if len(all_calib_file) < 2 * rounds:
+        raise ValueError('{} has {} rounds of {} trays, which need {} calibration files ({}), found {}'.format(
+            dataset_path, rounds, no_t, 2 * rounds, calib_pattern, len(all_calib_file)))
+
+    jobs = []
+    img_i = 0
+    for round_i in range(rounds):
+        white_calib = os.path.splitext(all_calib_file[2 * round_i])[0]
+        dark_calib = os.path.splitext(all_calib_file[2 * round_i + 1])[0]
+        for k in range(no_t):
+            hyperspec_reference_path = all_img_path[img_i]
+            tmp = '--'.join(os.path.splitext(os.path.basename(hyperspec_reference_path))[0].split('_'))
+            hyperspec_image_path = os.path.join(dataset_path, tmp + TRAY_IMAGE_SUFFIX + str(k + 1))
+            jobs.append((img_i, hyperspec_reference_path, hyperspec_image_path, white_calib, dark_calib))
+            img_i += 1
+    return jobs
+
+
+def render_tray_sheet(reference_path, mask, traits, names=TRAIT_NAMES, columns=4):
+    """Visual QA sheet of a tray: the reference image, the plant mask and every index over the mask
+
+    Args:
+        reference_path (str): Reference png of the tray
+        mask (numpy ndarray): HW boolean plant mask
+        traits (dict): Index name (lower case) -> index image, as returned by compute_indices
+        names (list of str): Indices to show, in order
+
+    Returns:
+        (numpy ndarray): uint8 RGB image
+    """
+    reference = cv2.cvtColor(cv2.imread(reference_path), cv2.COLOR_BGR2RGB)
+    mask_image = np.repeat(mask[:, :, None], 3, axis=2).astype(np.uint8) * 255
+    panels = [render_panel(reference, 'Reference'), render_panel(mask_image, 'Mask')]
+    for name in names:
+        index = traits[name.lower()]
+        if index is None:
+            continue
+        spectral_index = SPECTRAL_INDICES[name.lower()]
+        panels.append(render_index(index, spectral_index.cmap, spectral_index.limits[0], spectral_index.limits[1],
+                                   title=name, mask=mask))
+    return grid(panels, columns)
+
+
+def process_tray(job, names=TRAIT_NAMES, backend='rasterio', calib_cache_dir=None, header=None, block_lines=None,
+                 qa_dir=None):
+    """Computes the mean of each index over the plant mask of one tray
+
+    Args:
+        job (tuple): One entry of find_tray_jobs
+        names (list of str): Indices to compute (keys of SPECTRAL_INDICES, any case)
+        header (HyperspectralHeader): Header of the tray image, parsed from it if None
+        block_lines (int): If given the tray is streamed this many scan lines at a time
+            (see process_tray_streamed) instead of loading the whole cube
+        qa_dir (str): If given a QA sheet (see render_tray_sheet) is written there as
+            tray_<tray_id>.png. Needs the whole cube, so cannot be combined with block_lines
+
+    Returns:
+        (list): tray_id followed by one value per index
+    """
+    tray_id, reference_path, image_path, white_calib, dark_calib = job
+    if block_lines and qa_dir is not None:
+        raise ValueError('QA sheets need the whole cube, they cannot be rendered with block_lines')
+    image = HyperspectralImage(image_path, white_calib, dark_calib, backend=backend,
+                               calib_cache_dir=calib_cache_dir, header=header)
+    mask = hyp_mask(reference_path) > 0
+    if block_lines:
+        return [tray_id] + process_tray_streamed(image, mask, names, block_lines)
+
+    wavelength, hyper = image.extract_all_layers(dtype=np.float32)
+    mask_count = np.count_nonzero(mask)
+
+    # Checking for possible errors and fixing (inverted captures, starting from 27 DAS)
+    if hyper[:, :, 0][mask].sum() > hyper[:, :, -1][mask].sum():
+        np.subtract(1, hyper, out=hyper)
+
+    traits = compute_indices(hyper, wavelength, [name.lower() for name in names])
+    if qa_dir is not None:
+        save_rgb(os.path.join(qa_dir, 'tray_{}.png'.format(tray_id)),
+                 render_tray_sheet(reference_path, mask, traits, names))
+    row = [tray_id]
+    for name in names:
+        index = traits[name.lower()]
+        row.append(np.nan if index is None else index[mask].sum(dtype=np.float64) / mask_count)
+    return row
+
+
+def process_tray_streamed(image, mask, names=TRAIT_NAMES, block_lines=64):
+    """Mean of each index over a mask, reading the image a block of scan lines at a time
+
+    Only the bands the indices need are read. The first and last bands are streamed once
+    beforehand for the inverted capture check
+
+    Args:
+        image (HyperspectralImage): The tray image
+        mask (numpy ndarray): HW boolean plant mask
+        names (list of str): Indices to compute (keys of SPECTRAL_INDICES, any case)
+        block_lines (int): Number of scan lines read at once
+
+    Returns:
+        (list of float): One value per index
+    """
+    last_band = len(image.wavelengths) - 1
+    band_sums = np.zeros(2)
+    for row, block in image.iter_line_blocks(block_lines, band_indices=[0, last_band]):
+        band_sums += block[mask[row:row + block.shape[0]]].sum(axis=0, dtype=np.float64)
+    inverted = band_sums[0] > band_sums[1]
+
+    lowered = [name.lower() for name in names]
+    bands = index_band_indices(image.wavelength_array, lowered)
+    accumulator = MaskedIndexMeans(image.wavelength_array[bands], lowered)
+    for row, block in image.iter_line_blocks(block_lines, band_indices=bands):
+        if inverted:
+            np.subtract(1, block, out=block)
+        accumulator.update(block, mask[row:row + block.shape[0]])
+    means = accumulator.means()
+    return [means[name] for name in lowered]
+
+
+def process_dataset(dataset_path, out_csv='HypIndices.csv', calib_pattern=CALIB_PATTERN, names=TRAIT_NAMES,
+                    workers=None, max_in_flight=None, backend='rasterio', calib_cache_dir=None, nbits=None,
+                    block_lines=None, qa_dir=None):
+    """Processes every tray of a dataset in parallel and writes their traits to a csv
+
+    Rows are written as trays finish, so they are not necessarily in tray_id order. A tray
+    that fails is left out of the csv and returned with its error, the other trays carry on.
+    Progress is logged to the custom_lib.batch logger
+
+    Args:
+        dataset_path (str): Folder containing the pngs, tray images and calibration frames
+        out_csv (str): Output csv path
+        calib_pattern (str): Glob pattern of the calibration frame .hdr files
+        names (list of str): Indices to compute
+        workers (int): Number of worker processes, defaults to the number of cores
+        max_in_flight (int): Maximum number of trays (cubes) being processed or queued at
+            once, which bounds memory use. Defaults to the number of workers
+        backend (str): Loader used for the tray images, see HyperspectralImage
+        calib_cache_dir (str): Optional folder to share the reduced calibration frames
+            between worker processes
+        nbits (int): Overrides the bit depth of the tray images in memory
+        block_lines (int): Stream each tray this many scan lines at a time rather than
+            loading whole cubes, which keeps memory per worker constant
+        qa_dir (str): Folder to write a visual QA sheet of every tray to, rendered by the
+            workers in parallel
+
+    Returns:
+        (int): Number of trays written
+        (list of tuple): (tray_id, hyperspectral image path, exception) of every tray that failed
+    """
+    if block_lines and qa_dir is not None:
+        raise ValueError('QA sheets need the whole cube, they cannot be rendered with block_lines')
+    if qa_dir is not None:
+        os.makedirs(qa_dir, exist_ok=True)
+    jobs = find_tray_jobs(dataset_path, calib_pattern=calib_pattern)
+    # Headers are parsed once here (or read from the dataset's index) and sent with each job
+    index = DatasetIndex.load(dataset_path, nbits=nbits)
+    workers = workers or os.cpu_count()
+    max_in_flight = max_in_flight or workers
+    worker = functools.partial(process_tray, names=names, backend=backend, calib_cache_dir=calib_cache_dir,
+                               block_lines=block_lines, qa_dir=qa_dir)
+
+    written = 0
+    failed = []
+    with open(out_csv, 'w', newline='') as csv_file, ProcessPoolExecutor(workers) as pool:
+        writer = csv.writer(csv_file)
+        writer.writerow(['tray_id'] + list(names))
+
+        def write_done(futures):
+            nonlocal written
+            for future in futures:
+                tray_id, _, image_path = submitted.pop(future)[:3]
+                try:
+                    writer.writerow(future.result())
+                    written += 1
+                    logger.info('Processed tray %s (%d of %d)', tray_id, written + len(failed), len(jobs))
+                except Exception as e:
+                    failed.append((tray_id, image_path, e))
+                    logger.error('Failed to process tray %s (%s): %s', tray_id, image_path, e)
+            csv_file.flush()
+
+        # Future -> job, to report which tray a result or error belongs to
+        submitted = {}
+        for job in jobs:
+            if len(submitted) >= max_in_flight:
+                done, _ = wait(submitted, return_when=FIRST_COMPLETED)
+                write_done(done)
+            submitted[pool.submit(worker, job, header=index.get(job[2]))] = job
+        write_done(wait(submitted).done)
+
+    return written, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute hyperspectral indices for every tray of a dataset')
+    parser.add_argument('dataset_path', type=str, help='folder with the tray images and calibration frames')
+    parser.add_argument('--out_csv', type=str, default='HypIndices.csv', help='output csv path')
+    parser.add_argument('--calib_pattern', type=str, default=CALIB_PATTERN, help='glob of calibration .hdr files')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--max_in_flight', type=int, default=None, help='max trays held in memory at once')
+    parser.add_argument('--backend', type=str, default='rasterio', help='rasterio or memmap')
+    parser.add_argument('--calib_cache_dir', type=str, default=None, help='folder to cache calibration frames')
+    parser.add_argument('--nbits', type=int, default=None, help='override the bit depth of the tray images')
+    parser.add_argument('--block_lines', type=int, default=None, help='stream trays this many lines at a time')
+    parser.add_argument('--qa_dir', type=str, default=None, help='folder to write a QA sheet of every tray to')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    n_trays, failed_trays = process_dataset(args.dataset_path, out_csv=args.out_csv, calib_pattern=args.calib_pattern,
+                              workers=args.workers, max_in_flight=args.max_in_flight, backend=args.backend,
+                              calib_cache_dir=args.calib_cache_dir, nbits=args.nbits, block_lines=args.block_lines,
+                              qa_dir=args.qa_dir)
+    logger.info('Processed %d trays, %d failed', n_trays, len(failed_trays))
+    for tray_id, image_path, error in failed_trays:
+        logger.info('  tray %s (%s): %s', tray_id, image_path, error)
@@ -0,0 +1,378 @@
+"""Header model and dataset index for hyperspectral (ESRI/ENVI .hdr + .bil) files"""
+import os
+import re
+import json
+
+import numpy as np
+
+BIL_EXTENSION = '.bil'
+HDR_EXTENSION = '.hdr'
+
+# Sidecar holding the parsed headers of every image in a dataset folder
+INDEX_FILENAME = '.hyperspec_index.json'
+INDEX_VERSION = 1
+
+# Bit depths the GDAL EHdr driver can open directly
+GDAL_NBITS = (8, 16, 32)
+
+# ENVI 'data type' codes
+ENVI_DTYPES = {'1': 'u1', '2': 'i2', '3': 'i4', '4': 'f4', '5': 'f8', '12': 'u2', '13': 'u4'}
+
+# GDAL data type of each storage dtype, used to describe the raw file in a VRT
+GDAL_DTYPES = {'u1': 'Byte', 'u2': 'UInt16', 'i2': 'Int16', 'u4': 'UInt32', 'i4': 'Int32', 'f4': 'Float32',
+               'f8': 'Float64'}
+
+# e.g. 2023-01-01--1_round-0_cam-1_tray-Tray_1 or <scan>_round-0_cam-1_calibFrame
+FILENAME_PATTERN = re.compile(
+    r'^(?P<scan>.+?)_round-(?P<round>\d+)_cam-(?P<cam>\d+)_(?:tray-Tray_(?P<tray>\d+)|(?P<calib_frame>calibFrame))')
+
+
+def parse_hdr(filepath):
+    """Reads the key/value fields and the wavelengths of a hyperspectral HDR file
+
+    Both ESRI style (``NROWS 100`` with a WAVELENGTHS ... WAVELENGTHS_END block) and ENVI
+    style (``lines = 100``, ``wavelength = {...}``) headers are accepted. Keys are lower-cased
+
+    Args:
+        filepath (str): Filepath to the hyperspectral file (with or without out an extension)
+
+    Returns:
+        (dict): Header field names mapped to their (string) values
+        (list of str): Wavelength of each band, as written in the header
+    """
+    fields = {}
+    wavelengths = []
+    hdr_filepath = os.path.splitext(filepath)[0] + HDR_EXTENSION
+    with open(hdr_filepath, 'r') as hdr_file:
+        in_wavelengths = False
+        for line in hdr_file:
+            line = line.strip()
+            if line == 'WAVELENGTHS':
+                in_wavelengths = True
+            elif line == 'WAVELENGTHS_END':
+                in_wavelengths = False
+            elif in_wavelengths:
+                if line:
+                    wavelengths.append(line)
+            elif line and line != 'ENVI':
+                if '=' in line:
+                    key, _, value = line.partition('=')
+                    # ENVI lists can span several lines
+                    while value.strip().startswith('{') and '}' not in value:
+                        next_line = next(hdr_file, None)
+                        if next_line is None:
+                            break
+                        value += ' ' + next_line.strip()
+                else:
+                    key, _, value = line.partition(' ')
+                fields[key.strip().lower()] = value.strip()
+
+    if not wavelengths and 'wavelength' in fields:
+        wavelengths = [wl.strip() for wl in fields['wavelength'].strip('{} ').split(',') if wl.strip()]
+    return fields, wavelengths
+
+
+def read_hdr(filepath):
+    """Reads the key/value fields of a hyperspectral HDR file (see parse_hdr)
+
+    Returns:
+        (dict): Header field names mapped to their (string) values
+    """
+    return parse_hdr(filepath)[0]
+
+
+def _hdr_field(fields, *keys, default=None):
+    """Returns the first of several equivalent (ESRI/ENVI) header fields that is present"""
+    for key in keys:
+        if key in fields:
+            return fields[key]
+    return default
+
+
+def parse_filename(filepath):
+    """Parses the scan, round, camera and tray (or calibration frame) from a PSI file name
+
+    Returns:
+        (dict): scan (str), round (int), cam (int), tray (int) and calib_frame (bool). Fields
+            that are not in the name are None
+    """
+    match = FILENAME_PATTERN.match(os.path.basename(os.path.splitext(filepath)[0]))
+    if match is None:
+        return {'scan': None, 'round': None, 'cam': None, 'tray': None, 'calib_frame': False}
+    return {
+        'scan': match.group('scan'),
+        'round': int(match.group('round')),
+        'cam': int(match.group('cam')),
+        'tray': None if match.group('tray') is None else int(match.group('tray')),
+        'calib_frame': match.group('calib_frame') is not None,
+    }
+
+
+class HyperspectralHeader:
+    """Everything needed to open a hyperspectral image, parsed once from its .hdr file
+
+    Attributes:
+        base_filepath (str): Filepath of the image without an extension
+        lines, samples, bands (int): Image height, width and number of bands
+        nbits (int): Bit depth of the data, e.g. 12 for 12-bit data stored in 16-bit words
+        interleave (str): 'bil', 'bip' or 'bsq'
+        dtype (numpy dtype): How samples are stored in the file, including the byte order
+        offset (int): Bytes to skip at the start of the file
+        wavelengths (list of str): Wavelength of each band, as written in the header
+        fields (dict): All key/value fields of the header
+        name_fields (dict): Scan, round, cam and tray parsed from the file name
+        nbits_override (bool): True if nbits was set in memory rather than read from the file
+    """
+
+    def __init__(self, base_filepath, lines, samples, bands, nbits, interleave, dtype, offset=0, wavelengths=None,
+                 fields=None, nbits_override=False):
+        self.base_filepath = base_filepath
+        self.lines = lines
+        self.samples = samples
+        self.bands = bands
+        self.nbits = nbits
+        self.interleave = interleave
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+        self.wavelengths = wavelengths or []
+        self.fields = fields or {}
+        self.name_fields = parse_filename(base_filepath)
+        self.nbits_override = nbits_override
+
+    @classmethod
+    def from_file(cls, filepath, nbits=None):
+        """Parses the header of a hyperspectral image
+
+        Args:
+            filepath (str): Filepath to the hyperspectral file (with or without out an extension)
+            nbits (int): Overrides the NBITS field of the header in memory, the file is not changed
+        """
+        base_filepath = os.path.splitext(filepath)[0]
+        fields, wavelengths = parse_hdr(base_filepath)
+
+        byte_order = _hdr_field(fields, 'byteorder', 'byte order', default='I').upper()
+        byte_order = '>' if byte_order in ('M', 'MSBFIRST', '1') else '<'
+
+        if 'data type' in fields:
+            dtype = np.dtype(byte_order + ENVI_DTYPES[fields['data type']])
+            file_nbits = dtype.itemsize * 8
+        else:
+            file_nbits = int(fields.get('nbits', 8))
+            dtype = np.dtype(byte_order + cls._storage_dtype(nbits or file_nbits, fields.get('pixeltype', '')))
+
+        return cls(
+            base_filepath,
+            lines=int(_hdr_field(fields, 'nrows', 'lines')),
+            samples=int(_hdr_field(fields, 'ncols', 'samples')),
+            bands=int(_hdr_field(fields, 'nbands', 'bands', default=1)),
+            nbits=int(nbits or file_nbits),
+            interleave=_hdr_field(fields, 'layout', 'interleave', default='bil').lower(),
+            dtype=dtype,
+            offset=int(_hdr_field(fields, 'skipbytes', 'header offset', default=0)),
+            wavelengths=wavelengths,
+            fields=fields,
+            nbits_override=nbits is not None and int(nbits) != file_nbits,
+        )
+
+    @staticmethod
+    def _storage_dtype(nbits, pixel_type):
+        """Samples are stored in whole bytes, e.g. 12-bit data occupies 16-bit words"""
+        nbytes = 1 if nbits <= 8 else 2 if nbits <= 16 else 4
+        pixel_type = pixel_type.upper()
+        kind = 'f' if pixel_type == 'FLOAT' else 'i' if pixel_type == 'SIGNEDINT' else 'u'
+        return '%s%d' % (kind, nbytes)
+
+    def with_nbits(self, nbits):
+        """Copy of the header with the bit depth overridden in memory"""
+        header = HyperspectralHeader.from_dict(self.to_dict(), os.path.dirname(self.base_filepath))
+        if nbits is not None and int(nbits) != self.nbits:
+            header.nbits = int(nbits)
+            if 'data type' not in self.fields:
+                byte_order = '>' if self.dtype.str[0] == '>' else '<'
+                header.dtype = np.dtype(byte_order + self._storage_dtype(header.nbits, self.fields.get('pixeltype', '')))
+            header.nbits_override = True
+        return header
+
+    @property
+    def bil_filepath(self):
+        return self.base_filepath + BIL_EXTENSION
+
+    @property
+    def shape(self):
+        """Height, width and number of bands"""
+        return self.lines, self.samples, self.bands
+
+    @property
+    def gdal_readable(self):
+        """True if GDAL can open the file as it is described on disk"""
+        if self.nbits_override:
+            return False
+        return 'data type' in self.fields or int(self.fields.get('nbits', 8)) in GDAL_NBITS
+
+    def to_vrt(self):
+        """Describes the raw file as an in-memory GDAL VRT
+
+        This lets rasterio read files whose header GDAL rejects (e.g. NBITS 12), or with an
+        overridden bit depth, without rewriting the header
+
+        Returns:
+            (str): VRT XML that can be passed to rasterio.open
+        """
+        itemsize = self.dtype.itemsize
+        band_bytes = self.samples * itemsize
+        offsets = {
+            # (offset of band b, between pixels, between lines)
+            'bil': (lambda b: b * band_bytes, itemsize, self.bands * band_bytes),
+            'bip': (lambda b: b * itemsize, self.bands * itemsize, self.bands * band_bytes),
+            'bsq': (lambda b: b * self.lines * band_bytes, itemsize, band_bytes),
+        }
+        band_offset, pixel_offset, line_offset = offsets[self.interleave]
+        data_type = GDAL_DTYPES[self.dtype.str[1:]]
+        byte_order = 'MSB' if self.dtype.str[0] == '>' else 'LSB'
+        source = os.path.abspath(self.bil_filepath)
+
+        vrt = ['<VRTDataset rasterXSize="{}" rasterYSize="{}">'.format(self.samples, self.lines)]
+        for band_idx in range(self.bands):
+            vrt.append(
+                '<VRTRasterBand dataType="{}" band="{}" subClass="VRTRawRasterBand">'
+                '<SourceFilename relativeToVRT="0">{}</SourceFilename>'
+                '<ImageOffset>{}</ImageOffset><PixelOffset>{}</PixelOffset><LineOffset>{}</LineOffset>'
+                '<ByteOrder>{}</ByteOrder></VRTRasterBand>'.format(
+                    data_type, band_idx + 1, source, self.offset + band_offset(band_idx), pixel_offset,
+                    line_offset, byte_order))
+        vrt.append('</VRTDataset>')
+        return ''.join(vrt)
+
+    def to_dict(self):
+        """JSON serialisable form of the header, with the file path relative to its folder"""
+        return {
+            'name': os.path.basename(self.base_filepath),
+            'lines': self.lines,
+            'samples': self.samples,
+            'bands': self.bands,
+            'nbits': self.nbits,
+            'interleave': self.interleave,
+            'dtype': self.dtype.str,
+            'offset': self.offset,
+            'wavelengths': self.wavelengths,
+            'fields': self.fields,
+            'nbits_override': self.nbits_override,
+        }
+
+    @classmethod
+    def from_dict(cls, data, folder):
+        """Inverse of to_dict, for a header in folder"""
+        data = dict(data)
+        base_filepath = os.path.join(folder, data.pop('name'))
+        return cls(base_filepath, **data)
+
+    def __repr__(self):
+        return '{}({!r}, shape={}, nbits={}, interleave={!r})'.format(
+            type(self).__name__, os.path.basename(self.base_filepath), self.shape, self.nbits, self.interleave)
+
+
+class DatasetIndex:
+    """Parsed headers of every hyperspectral image in a dataset folder
+
+    The index is stored as a JSON sidecar (INDEX_FILENAME) in the folder. Loading it only
+    parses the .hdr files that are new or have changed since it was written, so opening a
+    dataset a second time is a directory listing and one JSON read. Only the .hdr files directly
+    in the folder are indexed, not those in subfolders (images are looked up by name), so a
+    dataset split into batch subfolders needs one index per subfolder
+    """
+
+    def __init__(self, folder, headers):
+        """
+        Args:
+            folder (str): Dataset folder
+            headers (dict): Image name (without extension) mapped to its HyperspectralHeader
+        """
+        self.folder = folder
+        self.headers = headers
+
+    @classmethod
+    def load(cls, folder, nbits=None, write=True):
+        """Loads the index of a folder, (re)building the entries of new or changed files
+
+        Args:
+            folder (str): Dataset folder
+            nbits (int): Bit depth to use for every image, applied in memory only
+            write (bool): If True the sidecar is updated when any entry changed
+
+        Returns:
+            (DatasetIndex): Index of every .hdr file in the folder (subfolders are not scanned)
+        """
+        index_filepath = os.path.join(folder, INDEX_FILENAME)
+        cached = {}
+        try:
+            with open(index_filepath, 'r') as index_file:
+                contents = json.load(index_file)
+            if contents.get('version') == INDEX_VERSION:
+                cached = contents['entries']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        entries = {}
+        headers = {}
+        changed = False
+        with os.scandir(folder) as scan:
+            hdr_entries = sorted((entry for entry in scan if entry.name.endswith(HDR_EXTENSION)),
+                                 key=lambda entry: entry.name)
+        for entry in hdr_entries:
+            name = entry.name[:-len(HDR_EXTENSION)]
+            stat = entry.stat()
+            entry_data = cached.get(name)
+            if entry_data is None or entry_data['mtime'] != stat.st_mtime or entry_data['size'] != stat.st_size:
+                header = HyperspectralHeader.from_file(os.path.join(folder, name))
+                entry_data = {'mtime': stat.st_mtime, 'size': stat.st_size, 'header': header.to_dict()}
+                changed = True
+            else:
+                header = HyperspectralHeader.from_dict(entry_data['header'], folder)
+            entries[name] = entry_data
+            headers[name] = header if nbits is None else header.with_nbits(nbits)
+        changed = changed or len(entries) != len(cached)
+
+        if write and changed:
+            # Written to a temporary file first so a crash never leaves a half written index
+            tmp_filepath = index_filepath + '.tmp'
+            try:
+                with open(tmp_filepath, 'w') as index_file:
+                    json.dump({'version': INDEX_VERSION, 'entries': entries}, index_file)
+                os.replace(tmp_filepath, index_filepath)
+            except OSError:
+                # Read-only datasets still work, the headers are just parsed every time
+                pass
+        return cls(folder, headers)
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __iter__(self):
+        return iter(self.headers.values())
+
+    def __getitem__(self, filepath):
+        """Header of an image, given its name or path (with or without an extension)"""
+        return self.headers[os.path.basename(os.path.splitext(filepath)[0])]
+
+    def __contains__(self, filepath):
+        return os.path.basename(os.path.splitext(filepath)[0]) in self.headers
+
+    def get(self, filepath, default=None):
+        try:
+            return self[filepath]
+        except KeyError:
+            return default
+
+    def find(self, **name_fields):
+        """Headers whose file name fields match, e.g. find(calib_frame=True) or find(round=0, tray=3)"""
+        return [header for header in self.headers.values()
+                if all(header.name_fields.get(key) == value for key, value in name_fields.items())]
+
+    def trays(self):
+        """Headers of the tray images, ordered by round and tray"""
+        return sorted((header for header in self.headers.values() if header.name_fields['tray'] is not None),
+                      key=lambda header: (header.name_fields['round'], header.name_fields['tray']))
+
+    def calib_frames(self):
+        """Headers of the calibration frames"""
+        return self.find(calib_frame=True)
@@ -1,13 +1,16 @@
 """Class to represent hyperspectral data"""
 import os
+import hashlib
+import zipfile
 import rasterio
 import cv2
 import numpy as np
 
+from .header import BIL_EXTENSION, HDR_EXTENSION, HyperspectralHeader, parse_hdr  # noqa: F401
+from .utils import find_nearest_many, index_band_indices, reduce_indices
+
 RGB_WAVELENGTH = (700, 530, 470)
 
-BIL_EXTENSION = '.bil'
-HDR_EXTENSION = '.hdr'
 H5PY_EXTENSION = '.hdf5'
 
 # Network Constants
@@ -24,19 +27,213 @@ TEST_RESULTS_PATH = os.path.join(RESULTS_PATH, 'test')
 TEMP_DIR = 'temp'
 
 
-def load_hyperspectral_image(filepath):
+def load_hyperspectral_image(filepath, nbits=None, header=None):
     """Loads a hyperspectral image
 
     IMPORTANT: Both the .hdr and .bil files must be named identically
 
+    Files GDAL cannot open as described by their header (e.g. NBITS 12) or with an
+    overridden bit depth are opened through an in-memory VRT, the header is never rewritten
+
     Args:
         filepath (str): Filepath to the hyperspectral file (with or without out an extension)
+        nbits (int): Overrides the NBITS field of the header
+        header (HyperspectralHeader): Already parsed header (e.g. from a DatasetIndex)
 
     Returns:
         (rasterio.io.DatasetReader): The rasterio object representing the hyperspectral data
     """
-    bil_filepath = os.path.splitext(filepath)[0] + BIL_EXTENSION
-    return rasterio.open(bil_filepath)
+    if header is None:
+        header = HyperspectralHeader.from_file(filepath, nbits=nbits)
+    elif nbits is not None:
+        header = header.with_nbits(nbits)
+    if header.gdal_readable:
+        return rasterio.open(header.bil_filepath)
+    return rasterio.open(header.to_vrt())
+
+
+class BilMemmap:
+    """Memory-mapped view over a BIL (or BIP/BSQ) hyperspectral file
+
+    Mirrors the parts of the rasterio dataset interface used by HyperspectralImage
+    (``count``, ``height``, ``width`` and a 1-indexed ``read``), so it can be used in place
+    of load_hyperspectral_image. Nothing is read from disk until data is accessed, and the
+    ``*_view`` methods return zero-copy views into the file
+    """
+
+    def __init__(self, filepath, nbits=None, header=None):
+        """Constructor for the memory-mapped image
+
+        Args:
+            filepath (str): Filepath to the hyperspectral file (with or without out an extension)
+            nbits (int): Overrides the NBITS field of the header (e.g. 12-bit data stored in 16 bits)
+            header (HyperspectralHeader): Already parsed header (e.g. from a DatasetIndex)
+        """
+        if header is None:
+            header = HyperspectralHeader.from_file(filepath, nbits=nbits)
+        elif nbits is not None:
+            header = header.with_nbits(nbits)
+        self.header = header
+        self.name = header.bil_filepath
+        self.height = header.lines
+        self.width = header.samples
+        self.count = header.bands
+        self.interleave = header.interleave
+        self.dtype = header.dtype
+
+        shapes = {
+            'bil': (self.height, self.count, self.width),
+            'bip': (self.height, self.width, self.count),
+            'bsq': (self.count, self.height, self.width),
+        }
+        # Axes to transpose each layout into band, line, sample order
+        axes = {'bil': (1, 0, 2), 'bip': (2, 0, 1), 'bsq': (0, 1, 2)}
+        self.memmap = np.memmap(self.name, dtype=self.dtype, mode='r', offset=header.offset,
+                                shape=shapes[self.interleave])
+        # Band, line, sample (CHW) view of the file, this does not copy any data
+        self.array = self.memmap.transpose(axes[self.interleave])
+
+    @staticmethod
+    def _window_slices(window):
+        """Converts a rasterio style window (or ((row_start, row_stop), (col_start, col_stop))) to slices"""
+        if window is None:
+            return slice(None), slice(None)
+        if hasattr(window, 'toslices'):
+            return window.toslices()
+        (row_start, row_stop), (col_start, col_stop) = window
+        return slice(row_start, row_stop), slice(col_start, col_stop)
+
+    def read(self, indexes=None, window=None):
+        """Reads bands from the file, following rasterio's read
+
+        NOTE: As with rasterio, band indexes start at 1
+
+        Args:
+            indexes (int/list of int): Band(s) to read, all bands if None
+            window (tuple): ((row_start, row_stop), (col_start, col_stop)) region to read
+
+        Returns:
+            (numpy ndarray): HW array for a single band, otherwise CHW
+        """
+        rows, cols = self._window_slices(window)
+        if indexes is None:
+            return np.array(self.array[:, rows, cols])
+        if isinstance(indexes, (int, np.integer)):
+            return np.array(self.array[indexes - 1, rows, cols])
+        return np.asarray(self.array[[int(idx) - 1 for idx in indexes], rows, cols])
+
+    def band_view(self, band_idx):
+        """Zero-copy HW view of a single band (zero-based index)"""
+        return self.array[band_idx]
+
+    def line_view(self, start, stop):
+        """Zero-copy CHW view of the scan lines [start, stop)"""
+        return self.array[:, start:stop]
+
+    def window_view(self, rows, cols, bands=None):
+        """Zero-copy CHW view of a (row_start, row_stop), (col_start, col_stop) window
+
+        Args:
+            rows (tuple): Start and stop rows
+            cols (tuple): Start and stop columns
+            bands (tuple): Start and stop (zero-based) bands, all bands if None
+        """
+        bands = slice(None) if bands is None else slice(*bands)
+        return self.array[bands, rows[0]:rows[1], cols[0]:cols[1]]
+
+    def close(self):
+        """Drops the memory map, the file is unmapped once no views into it remain"""
+        self.memmap = None
+        self.array = None
+
+
+def load_hyperspectral_memmap(filepath, nbits=None, header=None):
+    """Loads a hyperspectral image as a memory map
+
+    IMPORTANT: Both the .hdr and .bil files must be named identically
+
+    Args:
+        filepath (str): Filepath to the hyperspectral file (with or without out an extension)
+        nbits (int): Overrides the NBITS field of the header
+        header (HyperspectralHeader): Already parsed header (e.g. from a DatasetIndex)
+
+    Returns:
+        (BilMemmap): Memory-mapped object representing the hyperspectral data
+    """
+    return BilMemmap(filepath, nbits=nbits, header=header)
+
+
+# Loaders that can back a HyperspectralImage
+LOADERS = {
+    'rasterio': load_hyperspectral_image,
+    'memmap': load_hyperspectral_memmap,
+}
+
+
+# Calibration frames already reduced this session, keyed by (filepath, mtime)
+_CALIB_CACHE = {}
+
+
+def load_calib_frame(filepath, backend='rasterio', cache_dir=None):
+    """Loads a white/dark calibration frame and averages it over its scan lines
+
+    The reduced frame is cached per file path and modification time, so trays sharing
+    a calibration pair only pay for it once. If cache_dir is given the frame is also
+    stored there as a .npz file and reused across sessions
+
+    Args:
+        filepath (str): Filepath to the calibration file (with or without out an extension)
+        backend (str): Loader to read the file with, one of LOADERS
+        cache_dir (str): Optional folder for the on-disk .npz cache
+
+    Returns:
+        (numpy ndarray): Read-only calibration values in format (columns, bands)
+    """
+    base_filepath = os.path.abspath(os.path.splitext(filepath)[0])
+    mtime = os.path.getmtime(base_filepath + BIL_EXTENSION)
+    key = (base_filepath, mtime)
+    if key in _CALIB_CACHE:
+        return _CALIB_CACHE[key]
+
+    npz_filepath = None
+    calib = None
+    if cache_dir is not None:
+        path_hash = hashlib.md5(base_filepath.encode()).hexdigest()[:8]
+        npz_filepath = os.path.join(cache_dir, '{}-{}.npz'.format(os.path.basename(base_filepath), path_hash))
+        try:
+            with np.load(npz_filepath) as cached:
+                if str(cached['filepath']) == base_filepath and float(cached['mtime']) == mtime:
+                    calib = cached['calib']
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # Missing, truncated or foreign cache files are recomputed
+            calib = None
+
+    if calib is None:
+        image = LOADERS[backend](base_filepath)
+        # Read as CHW, average over the rows and store as (columns, bands)
+        calib = image.read().mean(axis=1).T
+        if npz_filepath is not None:
+            # Written to a temporary file first so other sessions sharing cache_dir never read a
+            # half written frame
+            tmp_filepath = '{}.{}.tmp'.format(npz_filepath, os.getpid())
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(tmp_filepath, 'wb') as npz_file:
+                    np.savez(npz_file, calib=calib, filepath=base_filepath, mtime=mtime)
+                os.replace(tmp_filepath, npz_filepath)
+            except OSError:
+                # A read-only cache_dir only costs the reduction next session
+                pass
+
+    # The frame is shared between images, so make sure nobody modifies it in place
+    calib.flags.writeable = False
+    _CALIB_CACHE[key] = calib
+    return calib
+
+
+def clear_calib_cache():
+    """Empties the in-memory calibration frame cache"""
+    _CALIB_CACHE.clear()
 
 
 def extract_hyperspectral_wavelengths(filepath):
@@ -50,55 +247,137 @@ def extract_hyperspectral_wavelengths(filepath):
     Returns:
         (list): List of hyperspectral wavelengths
     """
-    wavelengths = []
-    hdr_filepath = os.path.splitext(filepath)[0] + HDR_EXTENSION
+    return parse_hdr(filepath)[1]
+
+
+
+def _import_h5py():
+    """h5py is only needed for the HDF5 cube cache, so it is imported on first use"""
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('h5py is required to read or write {} files, install it with pip install h5py'.format(
+            H5PY_EXTENSION))
+    return h5py
+
+
+def create_calibrated_cube(filepath, wavelengths, shape, dtype=np.float32, attrs=None, band_chunk=16,
+                           tile_size=256, compression='gzip'):
+    """Creates an HDF5 file to hold a calibrated reflectance cube
+
+    The cube is stored as HWC in a 'reflectance' dataset, chunked in tile_size x tile_size
+    spatial tiles by band_chunk bands and compressed, so readers only decompress the bands
+    and tiles they ask for. The wavelengths are stored in a 'wavelengths' dataset
+
+    Args:
+        filepath (str): Filepath to the HDF5 file
+        wavelengths (list of float): Wavelength of each band
+        shape (tuple): Height, width and number of bands of the cube
+        attrs (dict): Attributes (e.g. calibration provenance) to store on the file
+
+    Returns:
+        (h5py.File, h5py.Dataset): The open file and the reflectance dataset to write into
+    """
+    h5py = _import_h5py()
+    height, width, bands = shape
+    chunks = (max(1, min(tile_size, height)), max(1, min(tile_size, width)), max(1, min(band_chunk, bands)))
+    h5_file = h5py.File(filepath, 'w')
+    h5_file.create_dataset('wavelengths', data=np.asarray(wavelengths, dtype=np.float64))
+    dataset = h5_file.create_dataset('reflectance', shape=shape, dtype=dtype, chunks=chunks,
+                                     compression=compression, shuffle=compression is not None)
+    for key, value in (attrs or {}).items():
+        h5_file.attrs[key] = value
+    return h5_file, dataset
+
+
+def save_calibrated_cube(filepath, wavelengths, cube, attrs=None, **kwargs):
+    """Saves a calibrated HWC cube to a chunked, compressed HDF5 file (see create_calibrated_cube)"""
+    h5_file, dataset = create_calibrated_cube(filepath, wavelengths, cube.shape, dtype=cube.dtype, attrs=attrs,
+                                              **kwargs)
+    with h5_file:
+        dataset[...] = cube
+
+
+def load_calibrated_cube(filepath, wavelengths=None, crop_region=None):
+    """Loads a calibrated cube saved with save_calibrated_cube or HyperspectralImage.export_hdf5
+
+    Only the chunks covering the requested bands and crop region are read
+
+    Args:
+        filepath (str): Filepath to the HDF5 file
+        wavelengths (list of float): Wavelengths to load (closest band to each), all if None
+        crop_region (2x2 numpy ndarray): The top-left/bottom-right x,y coordinates of the crop
+            to take
+
+    Returns:
+        (list of float): Wavelengths of the loaded bands
+        (numpy ndarray): The calibrated data in format HWC
+        (dict): The attributes stored with the cube
+    """
+    h5py = _import_h5py()
+    with h5py.File(filepath, 'r') as h5_file:
+        dataset = h5_file['reflectance']
+        all_wavelengths = h5_file['wavelengths'][()]
+        attrs = dict(h5_file.attrs)
+
+        rows, cols = slice(None), slice(None)
+        if crop_region is not None:
+            rows = slice(*slice(crop_region[0][1], crop_region[1][1]).indices(dataset.shape[0])[:2])
+            cols = slice(*slice(crop_region[0][0], crop_region[1][0]).indices(dataset.shape[1])[:2])
 
-    # Extract the data from the hdr file
-    with open(hdr_filepath, 'r') as hdr_file:
-        contents = hdr_file.readlines()
-        contents = [content.rstrip() for content in contents]
-        wl_start_idx = contents.index('WAVELENGTHS')
-        wl_end_idx = contents.index('WAVELENGTHS_END')
-        wavelengths = contents[wl_start_idx + 1:wl_end_idx]
-    return wavelengths
+        if wavelengths is None:
+            return [float(wl) for wl in all_wavelengths], dataset[rows, cols, :], attrs
 
+        band_indices = find_nearest_many(all_wavelengths, wavelengths)[0]
+        # h5py needs increasing, unique indexes, so read those and then put them back in order
+        unique_indices, inverse = np.unique(band_indices, return_inverse=True)
+        cube = dataset[rows, cols, list(unique_indices)]
+        return [float(wl) for wl in all_wavelengths[band_indices]], np.take(cube, inverse, axis=2), attrs
 
 
 class HyperspectralImage:
-    def __init__(self, filepath, white_calib, dark_calib):
+    def __init__(self, filepath, white_calib, dark_calib, backend='rasterio', calib_cache_dir=None, header=None,
+                 nbits=None):
         """Constructor for hyperspectral image
 
         Args:
             filepath (str): Filepath to the hyperspectral file (with or without out an extension)
+            backend (str): How to open the image and calibration files, one of LOADERS.
+                'memmap' maps the files into memory instead of reading them through rasterio
+            calib_cache_dir (str): Optional folder to cache the reduced calibration frames in
+            header (HyperspectralHeader): Already parsed header of the image, e.g. from a
+                DatasetIndex, so the .hdr file is not read again
+            nbits (int): Overrides the NBITS field of the header in memory
         """
-        self.base_filepath = os.path.splitext(filepath)[0]
-        self.image = load_hyperspectral_image(self.base_filepath)
-        self.wavelengths = extract_hyperspectral_wavelengths(self.base_filepath)
+        if backend not in LOADERS:
+            raise ValueError('Unknown backend {}, expected one of {}'.format(backend, list(LOADERS)))
+        load_image = LOADERS[backend]
 
-        self.white_image = load_hyperspectral_image(os.path.splitext(white_calib)[0])
-        self.white_wavelengths = extract_hyperspectral_wavelengths(os.path.splitext(white_calib)[0])
-        self.dark_image = load_hyperspectral_image(os.path.splitext(dark_calib)[0])
-        self.dark_wavelengths = extract_hyperspectral_wavelengths(os.path.splitext(dark_calib)[0])
+        self.base_filepath = os.path.splitext(filepath)[0]
+        if header is None:
+            header = HyperspectralHeader.from_file(self.base_filepath, nbits=nbits)
+        elif nbits is not None:
+            header = header.with_nbits(nbits)
+        self.header = header
+        self.image = load_image(self.base_filepath, header=header)
+        self.wavelengths = header.wavelengths
+        # Parsed once for fast lookups, wavelengths keeps the strings from the header
+        self.wavelength_array = np.array(self.wavelengths, dtype=np.float64)
+
+        self.backend = backend
+        self.calib_cache_dir = calib_cache_dir
+        self.white_filepath = os.path.splitext(white_calib)[0]
+        self.dark_filepath = os.path.splitext(dark_calib)[0]
         self.get_calib_values()
 
     def get_calib_values(self):
         '''
         calculate white and dark calibration values
-        '''
-        white = []
-        dark = []
-        for w_wl_idx in range(len(self.white_wavelengths)):
-            white_im = self.white_image.read(w_wl_idx + 1)
-            white.append(white_im)
-        white_array = np.stack(white, axis=2)
-        self.white_calib = white_array.mean(0)
 
-
-        for d_wl_idx in range(len(self.dark_wavelengths)):
-            dark_im = self.dark_image.read(d_wl_idx + 1)
-            dark.append(dark_im)
-        dark_array = np.stack(dark, axis=2)
-        self.dark_calib = dark_array.mean(0)
+        Each calibration file is only reduced once and then shared (see load_calib_frame)
+        '''
+        self.white_calib = load_calib_frame(self.white_filepath, self.backend, self.calib_cache_dir)
+        self.dark_calib = load_calib_frame(self.dark_filepath, self.backend, self.calib_cache_dir)
 
 
 
@@ -121,9 +400,19 @@ class HyperspectralImage:
 
     def get_closest_wavelength(self, wavelength):
         """Given a wavelength, searches the list of wavelengths to find the closest one"""
-        closest_wavelength = min(self.wavelengths, key=lambda x: abs(float(x) - wavelength))
-        closest_idx = self.wavelengths.index(closest_wavelength)
-        return closest_idx, closest_wavelength
+        closest_idx = int(self.get_band_indices([wavelength])[0])
+        return closest_idx, self.wavelengths[closest_idx]
+
+    def get_band_indices(self, wavelengths):
+        """Finds the (zero-based) index of the closest band for each of several wavelengths
+
+        Args:
+            wavelengths (list of float): Wavelengths to look up
+
+        Returns:
+            (numpy ndarray): Band index for each wavelength
+        """
+        return find_nearest_many(self.wavelength_array, wavelengths)[0]
 
     def extract_image_layer(self, wavelength, normalized=False, crop_region=None):
         """Extracts the image layer with wavelength closest to the specified parameter
@@ -146,22 +435,7 @@ class HyperspectralImage:
                 to take
         """
         wavelength_idx, _ = self.get_closest_wavelength(wavelength)
-        im = self.image.read(wavelength_idx + 1)
-        white_calib_values = self.white_calib[:, wavelength_idx]
-        white_calib_values = white_calib_values.reshape(1, white_calib_values.shape[0])
-        white_calib_values = np.tile(white_calib_values, [im.shape[0], 1])
-
-        dark_calib_values = self.dark_calib[:, wavelength_idx]
-        dark_calib_values = dark_calib_values.reshape(1, dark_calib_values.shape[0])
-        dark_calib_values = np.tile(dark_calib_values, [im.shape[0], 1])
-
-        im_cal = (im - dark_calib_values) / (white_calib_values - dark_calib_values + 1e-10)
-        im_cal[im_cal > 1] = 1
-        im_cal[im_cal < 0] = 0
-
-        if crop_region is not None:
-            im_cal = im_cal[crop_region[0][1]:crop_region[1][1], crop_region[0][0]:crop_region[1][0]]
-            im = im[crop_region[0][1]:crop_region[1][1], crop_region[0][0]:crop_region[1][0]]
+        im_cal = self.extract_layers([wavelength_idx], crop_region=crop_region)[:, :, 0]
 
         return wavelength_idx, im_cal
 
@@ -178,32 +452,215 @@ class HyperspectralImage:
             (tuple): red, green, blue wavelength indexes
             (numpy ndarray): Array representing the image
         """
-        red_idx, red_image = self.extract_image_layer(rgb_wavelengths[0], normalized=normalized,
-                                                      crop_region=crop_region)
-        green_idx, green_image = self.extract_image_layer(rgb_wavelengths[1], normalized=normalized,
-                                                          crop_region=crop_region)
-        blue_idx, blue_image = self.extract_image_layer(rgb_wavelengths[2], normalized=normalized,
-                                                        crop_region=crop_region)
+        red_idx, green_idx, blue_idx = [int(idx) for idx in self.get_band_indices(rgb_wavelengths)]
 
-        rgb_im = np.stack([red_image, green_image, blue_image], axis=2)
+        rgb_im = self.extract_layers([red_idx, green_idx, blue_idx], crop_region=crop_region)
 
         return (red_idx, green_idx, blue_idx), rgb_im
 
-    def extract_all_layers(self, normalized=False, crop_region=None):
+    def extract_layers(self, band_indices, crop_region=None, dtype=np.float64):
+        """Extracts and calibrates several image layers in a single read
+
+        All requested bands are read from the dataset at once and the dark/white
+        calibration is broadcast over the whole cube, rather than tiling the
+        calibration rows for every band. If a crop region is given only that window is
+        read and calibrated
+
+        Data returned in format: HWC (Where channels are the requested bands, in order)
+
+        Args:
+            band_indices (list of int): Zero-based band indexes to extract
+            crop_region (2x2 numpy ndarray): The top-left/bottom-right x,y coordinates of the crop
+                to take
+            dtype (numpy dtype): Data type of the calibrated output, float32 halves the memory used
+
+        Returns:
+            (numpy ndarray): The calibrated image data in format HWC
+        """
+        band_indices = [int(idx) for idx in band_indices]
+        rows, cols = self._crop_window(crop_region)
+        # Only the cropped window is read, rasterio returns the bands as CHW so move the
+        # channels last without copying
+        im = np.moveaxis(self.image.read([idx + 1 for idx in band_indices], window=(rows, cols)), 0, -1)
+
+        # Calibration values are stored as (columns, bands) so broadcast across rows
+        white_calib_values = self.white_calib[cols[0]:cols[1], band_indices]
+        dark_calib_values = self.dark_calib[cols[0]:cols[1], band_indices]
+
+        im_cal = im.astype(dtype)
+        im_cal -= dark_calib_values
+        im_cal /= white_calib_values - dark_calib_values + 1e-10
+        np.clip(im_cal, 0, 1, out=im_cal)
+
+        return im_cal
+
+    def iter_line_blocks(self, block_lines=64, band_indices=None, crop_region=None, dtype=np.float32):
+        """Reads and calibrates the image a block of scan lines at a time
+
+        Only block_lines lines are held in memory at once, so a scan of any length is
+        processed in constant memory. As the file is line interleaved each block is a
+        contiguous read. The per-column white/dark calibration is applied to each block
+        as it is read, exactly as in extract_layers
+
+        Args:
+            block_lines (int): Number of scan lines per block
+            band_indices (list of int): Zero-based band indexes to extract, all bands if None
+            crop_region (2x2 numpy ndarray): The top-left/bottom-right x,y coordinates of the crop
+                to take
+            dtype (numpy dtype): Data type of the calibrated blocks
+
+        Yields:
+            (int): Row of the image the block starts at
+            (numpy ndarray): The calibrated block in format HWC
+        """
+        if band_indices is None:
+            band_indices = range(len(self.wavelengths))
+        (row_start, row_stop), (col_start, col_stop) = self._crop_window(crop_region)
+        for block_start in range(row_start, row_stop, block_lines):
+            block_stop = min(block_start + block_lines, row_stop)
+            # Crop regions are x,y: columns first
+            block_region = ((col_start, block_start), (col_stop, block_stop))
+            yield block_start, self.extract_layers(band_indices, crop_region=block_region, dtype=dtype)
+
+    def extract_masked_spectra(self, mask, band_indices=None, dtype=np.float32):
+        """Calibrated spectra of the masked pixels only
+
+        Only the bounding box of the mask is read and calibrated, then the masked pixels
+        are gathered into a compact array
+
+        Args:
+            mask (numpy ndarray): HW boolean mask, or label image where 0 is background
+            band_indices (list of int): Zero-based band indexes to extract, all bands if None
+            dtype (numpy dtype): Data type of the calibrated spectra
+
+        Returns:
+            (numpy ndarray): The spectra in format N x bands
+            (numpy ndarray): The label (mask value) of each of the N pixels
+        """
+        if band_indices is None:
+            band_indices = range(len(self.wavelengths))
+        band_indices = list(band_indices)
+        mask = np.asarray(mask)
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if rows.size == 0:
+            return np.empty((0, len(band_indices)), dtype=dtype), np.empty(0, dtype=np.int64)
+
+        row_start, row_stop = rows[0], rows[-1] + 1
+        col_start, col_stop = cols[0], cols[-1] + 1
+        cube = self.extract_layers(band_indices, crop_region=((col_start, row_start), (col_stop, row_stop)),
+                                   dtype=dtype)
+        window_mask = mask[row_start:row_stop, col_start:col_stop]
+        selected = window_mask != 0
+        return cube[selected], window_mask[selected].astype(np.int64)
+
+    def reduce_indices(self, mask, names, stats=('mean', 'median', 'std'), dtype=np.float32):
+        """Per-plant statistics of spectral indices, computed only over the masked pixels
+
+        Only the bands the indices need are read. Several plants (e.g. all plants of a
+        tray) are summarised at once by passing a label image
+
+        Args:
+            mask (numpy ndarray): HW boolean mask, or label image where 0 is background
+            names (list of str): Keys of SPECTRAL_INDICES to compute
+            stats (list of str): Statistics to compute, see utils.reduce_indices
+
+        Returns:
+            (numpy ndarray): Sorted labels found in the mask (1 for a boolean mask)
+            (dict): Index name -> statistic -> array with one value per label
+        """
+        bands = index_band_indices(self.wavelength_array, names)
+        spectra, labels = self.extract_masked_spectra(mask, bands, dtype=dtype)
+        return reduce_indices(spectra, self.wavelength_array[bands], names, labels, stats=stats, dtype=dtype)
+
+    def mean_spectrum(self, mask=None, block_lines=64):
+        """Average calibrated spectrum over a mask, streamed a block of lines at a time
+
+        Args:
+            mask (numpy ndarray): HW mask of the pixels to average (non-zero), all pixels if None
+            block_lines (int): Number of scan lines read at once
+
+        Returns:
+            (numpy ndarray): Mean reflectance of each band
+        """
+        total = np.zeros(len(self.wavelengths), dtype=np.float64)
+        count = 0
+        for row, block in self.iter_line_blocks(block_lines, dtype=np.float64):
+            if mask is None:
+                total += block.sum(axis=(0, 1))
+                count += block.shape[0] * block.shape[1]
+            else:
+                block_mask = mask[row:row + block.shape[0]] > 0
+                total += block[block_mask].sum(axis=0)
+                count += np.count_nonzero(block_mask)
+        return total / max(count, 1)
+
+    def _crop_window(self, crop_region=None):
+        """Converts a crop region to ((row_start, row_stop), (col_start, col_stop)) within the image
+
+        Out of range coordinates are handled the same way as when slicing an array
+        """
+        if crop_region is None:
+            return (0, self.image.height), (0, self.image.width)
+        row_start, row_stop, _ = slice(crop_region[0][1], crop_region[1][1]).indices(self.image.height)
+        col_start, col_stop, _ = slice(crop_region[0][0], crop_region[1][0]).indices(self.image.width)
+        return (row_start, max(row_start, row_stop)), (col_start, max(col_start, col_stop))
+
+    def extract_all_layers(self, normalized=False, crop_region=None, dtype=np.float64):
         """Extracts all layers (wavelengths) of the hyperspectral image
 
+        The whole cube is read and calibrated in one pass (see extract_layers)
+
         Data returned in format: HWC (Where channels are all 480 wavelengths)
 
+        Args:
+            dtype (numpy dtype): Data type of the calibrated output
+
         Returns:
             (list of float): All extracted wavelength values
             (numpy ndarray): The hyperspectral image data in format HWC
         """
-        output_images = []
-        for wavelength in self.wavelengths:
-            output_images.append(
-                self.extract_image_layer(float(wavelength), normalized=normalized, crop_region=crop_region)[1])
-        return [float(wavelength) for wavelength in self.wavelengths], np.stack(output_images, axis=2)
+        band_indices = list(range(len(self.wavelengths)))
+        return ([float(wavelength) for wavelength in self.wavelengths],
+                self.extract_layers(band_indices, crop_region=crop_region, dtype=dtype))
+
+
+    def export_hdf5(self, filepath=None, dtype=np.float32, band_block=32, **kwargs):
+        """Saves the calibrated reflectance cube to a chunked, compressed HDF5 file
+
+        The cube is calibrated and written band_block bands at a time, so the whole cube
+        is never held in memory. Calibration provenance is stored as file attributes.
+        Load it again with load_calibrated_cube
 
+        Args:
+            filepath (str): Output path, defaults to the image path with the .hdf5 extension
+            dtype (numpy dtype): Data type to store the reflectance as
+            band_block (int): Number of bands calibrated per write
+            **kwargs: Chunking/compression options, see create_calibrated_cube
+
+        Returns:
+            (str): Filepath of the HDF5 file
+        """
+        if filepath is None:
+            filepath = self.base_filepath + H5PY_EXTENSION
+        bands = len(self.wavelengths)
+        attrs = {
+            'source': os.path.abspath(self.base_filepath + BIL_EXTENSION),
+            'source_mtime': os.path.getmtime(self.base_filepath + BIL_EXTENSION),
+            'white_calib': os.path.abspath(self.white_filepath + BIL_EXTENSION),
+            'white_calib_mtime': os.path.getmtime(self.white_filepath + BIL_EXTENSION),
+            'dark_calib': os.path.abspath(self.dark_filepath + BIL_EXTENSION),
+            'dark_calib_mtime': os.path.getmtime(self.dark_filepath + BIL_EXTENSION),
+            'calibration': '(raw - dark) / (white - dark), clipped to [0, 1]',
+        }
+        h5_file, dataset = create_calibrated_cube(filepath, self.wavelength_array,
+                                                  (self.image.height, self.image.width, bands),
+                                                  dtype=dtype, attrs=attrs, **kwargs)
+        with h5_file:
+            for start in range(0, bands, band_block):
+                stop = min(start + band_block, bands)
+                dataset[:, :, start:stop] = self.extract_layers(range(start, stop), dtype=dtype)
+        return filepath
 
     def threshold_image(self, wavelength, threshold, max=1):
         """Performs a binary threshold on an image at a specific wavelength
@@ -0,0 +1,159 @@
+"""Headless rendering of index maps, colour bars and text labels
+
+Everything is drawn with numpy and OpenCV straight into uint8 RGB arrays. No pyplot state
+is involved, so these functions are safe to call from threads or worker processes (e.g.
+to write a visual QA sheet for every tray of a batch in parallel)
+"""
+import cv2
+import numpy as np
+
+from .utils import apply_colour_map
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+TEXT_COLOUR = (255, 255, 255)
+BACKGROUND = (0, 0, 0)
+
+
+def colourise(data, cmap, vmin=0, vmax=1, mask=None, background=BACKGROUND):
+    """Maps data in [vmin, vmax] through a colour map
+
+    Args:
+        data (numpy ndarray): HW data
+        cmap (str): Colour map name (see utils.get_colour_lut)
+        mask (numpy ndarray): Optional HW mask, pixels outside it are set to background
+
+    Returns:
+        (numpy ndarray): HW x 3 uint8 RGB image
+    """
+    rgb = apply_colour_map((np.asarray(data) - vmin) / (vmax - vmin), cmap)
+    if mask is not None:
+        rgb[~np.asarray(mask, dtype=bool)] = background
+    return rgb
+
+
+def text_size(text, font_scale=0.5, thickness=1):
+    """Width and height (including the part below the baseline) of rendered text"""
+    (width, height), baseline = cv2.getTextSize(text, FONT, font_scale, thickness)
+    return width, height + baseline
+
+
+def draw_text(image, text, origin, font_scale=0.5, colour=TEXT_COLOUR, thickness=1):
+    """Draws text in place, origin is the top-left corner of the text"""
+    (_, height), _ = cv2.getTextSize(text, FONT, font_scale, thickness)
+    cv2.putText(image, text, (int(origin[0]), int(origin[1]) + height), FONT, font_scale, colour, thickness,
+                cv2.LINE_AA)
+    return image
+
+
+def text_strip(text, width, font_scale=0.5, padding=4, colour=TEXT_COLOUR, background=BACKGROUND):
+    """A strip of (at least) the given width with one line of text, e.g. a title"""
+    text_width, height = text_size(text, font_scale)
+    strip = np.full((height + 2 * padding, max(width, text_width + 2 * padding), 3), background, dtype=np.uint8)
+    return draw_text(strip, text, (padding, padding), font_scale, colour)
+
+
+def colour_bar(length, cmap, vmin=0, vmax=1, thickness=16, ticks=5, vertical=True, font_scale=0.4,
+               label_format='{:g}', background=BACKGROUND):
+    """Renders a colour bar with tick labels
+
+    Args:
+        length (int): Length of the gradient in pixels (usually the height of the image)
+        cmap (str): Colour map name
+        thickness (int): Width of the gradient in pixels
+        ticks (int): Number of evenly spaced tick labels, fewer are drawn on short bars
+        vertical (bool): Vertical bar (vmax at the top) with labels to its right, otherwise
+            horizontal (vmin on the left) with labels below
+
+    Returns:
+        (numpy ndarray): uint8 RGB image
+    """
+    gradient = np.linspace(1, 0, length) if vertical else np.linspace(0, 1, length)
+    bar = apply_colour_map(gradient, cmap)[:, None, :]
+    bar = np.repeat(bar, thickness, axis=1)
+    if not vertical:
+        bar = bar.transpose(1, 0, 2)
+
+    _, label_height = text_size(label_format.format(vmax), font_scale)
+    ticks = max(2, min(ticks, length // (label_height + 2)))
+    values = np.linspace(vmin, vmax, ticks)
+    labels = [label_format.format(value) for value in values]
+    sizes = [text_size(label, font_scale) for label in labels]
+    max_width = max(width for width, _ in sizes)
+    max_height = max(height for _, height in sizes)
+    # Offset of each tick along the gradient, from the vmin end
+    positions = np.linspace(0, 1, ticks) * (length - 1)
+
+    if vertical:
+        out = np.full((length, thickness + 4 + max_width, 3), background, dtype=np.uint8)
+        out[:, :thickness] = bar
+        for label, (_, height), position in zip(labels, sizes, positions):
+            y = np.clip(length - 1 - position - height / 2, 0, length - height)
+            draw_text(out, label, (thickness + 4, y), font_scale)
+    else:
+        out = np.full((thickness + 4 + max_height, length, 3), background, dtype=np.uint8)
+        out[:thickness] = bar
+        for label, (width, _), position in zip(labels, sizes, positions):
+            x = np.clip(position - width / 2, 0, length - width)
+            draw_text(out, label, (x, thickness + 4), font_scale)
+    return out
+
+
+def hstack(images, pad=4, background=BACKGROUND):
+    """Places images side by side, top aligned"""
+    height = max(image.shape[0] for image in images)
+    width = sum(image.shape[1] for image in images) + pad * (len(images) - 1)
+    out = np.full((height, width, 3), background, dtype=np.uint8)
+    x = 0
+    for image in images:
+        out[:image.shape[0], x:x + image.shape[1]] = image
+        x += image.shape[1] + pad
+    return out
+
+
+def vstack(images, pad=4, background=BACKGROUND):
+    """Places images above one another, left aligned"""
+    width = max(image.shape[1] for image in images)
+    height = sum(image.shape[0] for image in images) + pad * (len(images) - 1)
+    out = np.full((height, width, 3), background, dtype=np.uint8)
+    y = 0
+    for image in images:
+        out[y:y + image.shape[0], :image.shape[1]] = image
+        y += image.shape[0] + pad
+    return out
+
+
+def grid(images, columns, pad=4, background=BACKGROUND):
+    """Tiles images (e.g. panels) into rows of columns images"""
+    rows = [hstack(images[i:i + columns], pad, background) for i in range(0, len(images), columns)]
+    return vstack(rows, pad, background)
+
+
+def render_panel(image, title=None, cmap=None, vmin=0, vmax=1, bar=True, font_scale=0.5):
+    """Adds a title above an RGB image and, if cmap is given, a colour bar to its right"""
+    parts = [image]
+    if cmap is not None and bar:
+        parts.append(colour_bar(image.shape[0], cmap, vmin, vmax, font_scale=font_scale * 0.8))
+    panel = hstack(parts)
+    if title is not None:
+        panel = vstack([text_strip(title, panel.shape[1], font_scale), panel], pad=0)
+    return panel
+
+
+def render_index(index, cmap, vmin=-1, vmax=1, title=None, mask=None, bar=True):
+    """Renders an index map with a title and colour bar
+
+    Args:
+        index (numpy ndarray): HW index values
+        cmap (str): Colour map name
+        vmin, vmax (float): Range mapped onto the colour map
+        mask (numpy ndarray): Optional HW mask, pixels outside it are black
+
+    Returns:
+        (numpy ndarray): uint8 RGB image
+    """
+    return render_panel(colourise(index, cmap, vmin, vmax, mask), title, cmap, vmin, vmax, bar)
+
+
+def save_rgb(filepath, image):
+    """Writes an RGB uint8 image (PNG, JPEG, ... by extension)"""
+    return cv2.imwrite(filepath, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
@@ -1,8 +1,10 @@
+from collections import namedtuple
+from functools import lru_cache
 import matplotlib.pyplot as plt
+from matplotlib.colors import ListedColormap
 import numpy as np
 import os
 import cv2
-import colorsys
 
 
 def find_nearest(array, value):
@@ -12,529 +14,602 @@ def find_nearest(array, value):
     return idx, array[idx], diff
 
 
-def get_ndvi(hyper, wavelength):
+def find_nearest_many(array, values):
+    """
+    Find the nearest entry of array for every one of values with a binary search
+    array: 1xn, e.g. wavelengths (sorted first if not in increasing order)
+    values: 1xk values to look up
+    Returns arrays of the k indexes, nearest entries and absolute differences.
+    As with find_nearest, ties go to the lower index
+    """
+    array = np.asarray(array, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    order = None
+    sorted_array = array
+    if np.any(array[1:] < array[:-1]):
+        order = np.argsort(array, kind='stable')
+        sorted_array = array[order]
+
+    pos = np.searchsorted(sorted_array, values)
+    left = np.clip(pos - 1, 0, len(array) - 1)
+    right = np.clip(pos, 0, len(array) - 1)
+    use_left = np.abs(values - sorted_array[left]) <= np.abs(sorted_array[right] - values)
+    idx = np.where(use_left, left, right)
+    if order is not None:
+        idx = order[idx]
+    return idx, array[idx], np.abs(values - array[idx])
+
+
+class BandPrefixSum:
+    """
+    Cumulative sum of hyperspectral data along the spectral axis
+    hyper: hyperspectral data hxwxn (or any array with bands last)
+    start, stop: band range [start, stop) to cover, all bands by default
+
+    Built once per cube, after which the sum or mean of any contiguous band range
+    is a single subtraction per pixel
+    """
+
+    def __init__(self, hyper, start=0, stop=None, dtype=np.float64):
+        stop = hyper.shape[-1] if stop is None else stop
+        self.start = start
+        self.stop = stop
+        # prefix[..., k] is the sum of the first k bands, prefix[..., 0] is zero
+        self.prefix = np.zeros(hyper.shape[:-1] + (stop - start + 1,), dtype=dtype)
+        np.cumsum(hyper[..., start:stop], axis=-1, dtype=dtype, out=self.prefix[..., 1:])
+
+    def sum(self, first, last):
+        """Sum of bands first to last (inclusive band indexes of the original cube)"""
+        if first < self.start or last >= self.stop:
+            raise ValueError('Bands {}-{} are outside of the summed range {}-{}'.format(
+                first, last, self.start, self.stop - 1))
+        return self.prefix[..., last - self.start + 1] - self.prefix[..., first - self.start]
+
+    def mean(self, first, last):
+        """Mean of bands first to last (inclusive band indexes of the original cube)"""
+        total = self.sum(first, last)
+        total /= last - first + 1
+        return total
+
+    def bin_means(self, edges):
+        """Mean of every band range [edges[i], edges[i+1]) at once, returned as hxwxk"""
+        edges = np.asarray(edges, dtype=np.intp)
+        if edges[0] < self.start or edges[-1] > self.stop:
+            raise ValueError('Bin edges are outside of the summed range {}-{}'.format(self.start, self.stop))
+        means = np.diff(self.prefix[..., edges - self.start], axis=-1)
+        means /= np.diff(edges)
+        return means
+
+
+def spectral_bins(hyper, wavelength, width):
+    """
+    Bin hyperspectral data into spectral bands of (about) width nm
+    hyper: hyperspectral data hxwxn
+    wavelength: wavelength 1xn, in increasing order
+    Returns the mean wavelength of each bin and the binned data hxwxk
+    """
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    bin_ids = ((wavelength - wavelength[0]) // width).astype(np.intp)
+    edges = np.flatnonzero(np.diff(bin_ids, prepend=-1, append=bin_ids[-1] + 1))
+    centres = np.add.reduceat(wavelength, edges[:-1]) / np.diff(edges)
+    return centres, BandPrefixSum(hyper).bin_means(edges)
+
+
+def _normalised_difference(rho, out):
+    """(rho_1 - rho_2) / (rho_1 + rho_2)"""
+    np.subtract(rho[0], rho[1], out=out)
+    out /= rho[0] + rho[1]
+
+
+def _ratio(rho, out):
+    """rho_1 / rho_2"""
+    np.divide(rho[0], rho[1], out=out)
+
+
+def _difference_ratio(rho, out):
+    """(rho_1 - rho_2) / rho_3"""
+    np.subtract(rho[0], rho[1], out=out)
+    out /= rho[2]
+
+
+def _sipi(rho, out):
+    """(rho_1 - rho_2) / (rho_1 - rho_3)"""
+    np.subtract(rho[0], rho[1], out=out)
+    out /= rho[0] - rho[2]
+
+
+def _reciprocal_difference(rho, out):
+    """(1 / rho_1) - (1 / rho_2)"""
+    np.divide(1, rho[0], out=out)
+    out -= 1 / rho[1]
+
+
+def _ari2(rho, out):
+    """rho_3 * ((1 / rho_1) - (1 / rho_2))"""
+    _reciprocal_difference(rho, out)
+    out *= rho[2]
+
+
+def _ccci(rho, out):
+    """NDRE rescaled to the range of the frame"""
+    _normalised_difference(rho, out)
+    np.nan_to_num(out, copy=False)
+    np.clip(out, -1, 1, out=out)
+    if out.size == 0:
+        return
+    ndre_min, ndre_max = np.min(out), np.max(out)
+    out -= ndre_min
+    out /= ndre_max - ndre_min
+
+
+# Spectral index definitions
+#   wavelengths: wavelengths (nm) the index uses, each resolved to the nearest band
+#   formula: computes the index from the band images into out
+#   limits: range the index is clipped to
+#   cmap: matplotlib colour map used to render the index
+#   band_ranges: if True the wavelengths are (start, stop) pairs and the formula receives
+#       the mean image of each band range instead of single bands
+SpectralIndex = namedtuple('SpectralIndex', ['wavelengths', 'formula', 'limits', 'cmap', 'band_ranges'],
+                           defaults=(False,))
+
+SPECTRAL_INDICES = {
+    'ndvi': SpectralIndex((800, 680), _normalised_difference, (-1, 1), 'viridis'),
+    # reference for wavelegth: https://www.researchgate.net/publication/259360047_Use_of_the_Canopy_Chlorophyl_Content_Index_CCCI_for_Remote_Estimation_of_Wheat_Nitrogen_Content_in_Rainfed_Environments
+    # reference for range: https://www.tandfonline.com/doi/pdf/10.1080/22797254.2018.1527661#:~:text=The%20NDRE%20values%20range%20between,the%20level%20of%20chlorophyll%20content.
+    'ndre': SpectralIndex((800, 720), _normalised_difference, (-1, 1), 'PiYG'),
+    # Modified according to paper
+    # https://www.sciencedirect.com/science/article/pii/S1161030121001179
+    'ccci': SpectralIndex((800, 720), _ccci, (0, 1), 'PiYG'),
+    'npci': SpectralIndex((680, 430), _normalised_difference, (-1, 1), 'PiYG'),
+    'psri': SpectralIndex((680, 531, 800), _difference_ratio, (-1, 1), 'PiYG'),
+    'pri': SpectralIndex((531, 570), _normalised_difference, (-1, 1), 'PiYG'),
+    'sr': SpectralIndex((800, 680), _ratio, (0, 30), 'viridis'),
+    'sipi': SpectralIndex((800, 445, 680), _sipi, (0, 2), 'PiYG'),
+    # mean red (640-760) / mean green (490-570)
+    'rgr': SpectralIndex((640, 760, 490, 570), _ratio, (0.1, 8), 'PiYG', band_ranges=True),
+    'cri1': SpectralIndex((510, 550), _reciprocal_difference, (0, 15), 'PiYG'),
+    'cri2': SpectralIndex((510, 700), _reciprocal_difference, (0, 15), 'PiYG'),
+    'ari1': SpectralIndex((550, 700), _reciprocal_difference, (0, 0.2), 'PiYG'),
+    'ari2': SpectralIndex((550, 700, 800), _ari2, (0, 0.2), 'PiYG'),
+    'rndvi': SpectralIndex((750, 705), _normalised_difference, (-1, 1), 'viridis'),
+    'npqi': SpectralIndex((415, 430), _normalised_difference, (0.5, 1.5), 'viridis'),
+}
+
+
+def compute_indices(hyper, wavelength, names, diff_thresh=50, dtype=np.float32, prefix=None):
+    """
+    Compute several spectral indices from data in one pass
+    hyper: hyperspectral data hxwxn (or any array with bands last)
+    wavelength: wavelength 1xn
+    names: keys of SPECTRAL_INDICES to compute
+    prefix: optional BandPrefixSum of hyper, band range means are then taken from it
+
+    The wavelengths of all requested indices are resolved to bands once, each band
+    image is converted to dtype once and shared by every index that uses it, and the
+    index arithmetic is done in place.
+    Returns a dict of index name -> index array, or None if one of its wavelengths
+    is further than diff_thresh from any band
+    """
+    indices = {name: SPECTRAL_INDICES[name] for name in names}
+    targets = sorted({wl for index in indices.values() for wl in index.wavelengths})
+    resolved = dict(zip(targets, zip(*find_nearest_many(wavelength, targets))))
+
+    planes = {}
+
+    def plane(idx):
+        if idx not in planes:
+            planes[idx] = np.asarray(hyper[..., idx], dtype=dtype)
+        return planes[idx]
+
+    def range_mean(start, stop):
+        if prefix is not None:
+            total = prefix.sum(start, stop).astype(dtype, copy=False)
+        else:
+            total = np.sum(hyper[..., start:stop + 1], axis=-1, dtype=dtype)
+        # Divided by the number of steps rather than bands, as get_rgr always has
+        total /= stop - start
+        return total
+
+    results = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name, index in indices.items():
+            bands = [resolved[wl] for wl in index.wavelengths]
+            if any(diff >= diff_thresh for _, _, diff in bands):
+                results[name] = None
+                continue
+
+            idxs = [int(idx) for idx, _, _ in bands]
+            if index.band_ranges:
+                rho = [range_mean(idxs[i], idxs[i + 1]) for i in range(0, len(idxs), 2)]
+            else:
+                rho = [plane(idx) for idx in idxs]
+
+            out = np.empty(hyper.shape[:-1], dtype=dtype)
+            index.formula(rho, out)
+            np.nan_to_num(out, copy=False)
+            np.clip(out, index.limits[0], index.limits[1], out=out)
+            results[name] = out
+    return results
+
+
+def index_band_indices(wavelength, names):
+    """
+    Bands compute_indices reads to compute names
+    wavelength: wavelength 1xn
+    names: keys of SPECTRAL_INDICES
+
+    Band ranges are included in full, so compute_indices gives the same result on
+    hyper[..., bands] with wavelength[bands] as on the whole cube
+    Returns a sorted list of zero-based band indices
+    """
+    bands = set()
+    for name in names:
+        index = SPECTRAL_INDICES[name]
+        idxs = [int(idx) for idx in find_nearest_many(wavelength, index.wavelengths)[0]]
+        if index.band_ranges:
+            for start, stop in zip(idxs[::2], idxs[1::2]):
+                bands.update(range(start, stop + 1))
+        else:
+            bands.update(idxs)
+    return sorted(bands)
+
+
+REDUCE_STATS = ('mean', 'median', 'std', 'count')
+
+
+def reduce_indices(spectra, wavelength, names, labels=None, stats=('mean', 'median', 'std'), diff_thresh=50,
+                   dtype=np.float32):
+    """
+    Per-label statistics of spectral indices over a compact set of pixel spectra
+    spectra: Nxn calibrated spectra of the pixels to summarise (e.g. only plant pixels)
+    wavelength: wavelength 1xn
+    names: keys of SPECTRAL_INDICES to compute
+    labels: label of each pixel (N), all pixels are one group if None
+    stats: any of REDUCE_STATS, std is the population standard deviation
+
+    The indices are only computed for the N given pixels, so the cost scales with the
+    number of plant pixels rather than the frame. NOTE: CCCI is rescaled by the min/max
+    of the given pixels rather than of the whole frame
+    Returns the sorted unique labels and a dict of index name -> stat -> array with one
+    value per label (nan if the index could not be computed). If labels is None the single
+    group is returned even without pixels, with a count of 0 and nan statistics
+    """
+    for stat in stats:
+        if stat not in REDUCE_STATS:
+            raise ValueError('Unknown statistic {}, expected one of {}'.format(stat, REDUCE_STATS))
+    spectra = np.asarray(spectra)
+    if labels is None:
+        unique_labels, inverse = np.ones(1, dtype=np.int64), np.zeros(len(spectra), dtype=np.int64)
+    else:
+        unique_labels, inverse = np.unique(labels, return_inverse=True)
+        inverse = inverse.ravel()
+    counts = np.bincount(inverse, minlength=len(unique_labels))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    indices = compute_indices(spectra, wavelength, names, diff_thresh=diff_thresh, dtype=dtype)
+    results = {}
+    for name in names:
+        values = indices[name]
+        if values is None:
+            results[name] = {stat: np.full(len(unique_labels), np.nan) for stat in stats}
+            continue
+
+        values = values.astype(np.float64)
+        if len(values) == 0:
+            # No pixels to summarise
+            results[name] = {stat: counts if stat == 'count' else np.full(len(unique_labels), np.nan)
+                             for stat in stats}
+            continue
+
+        mean = np.bincount(inverse, weights=values, minlength=len(unique_labels)) / counts
+        result = {}
+        for stat in stats:
+            if stat == 'mean':
+                result[stat] = mean
+            elif stat == 'std':
+                squared = (values - mean[inverse]) ** 2
+                result[stat] = np.sqrt(np.bincount(inverse, weights=squared, minlength=len(unique_labels)) / counts)
+            elif stat == 'median':
+                # Sorted by label then value, the median of each label is in the middle of its run
+                ordered = values[np.lexsort((values, inverse))]
+                result[stat] = (ordered[starts + (counts - 1) // 2] + ordered[starts + counts // 2]) / 2
+            elif stat == 'count':
+                result[stat] = counts
+        results[name] = result
+    return unique_labels, results
+
+
+class MaskedIndexMeans:
+    """Mean of spectral indices over a mask, accumulated one block of lines at a time
+
+    Used with HyperspectralImage.iter_line_blocks to get per-tray index averages without
+    holding the cube in memory. The result matches averaging the compute_indices images
+    over the mask. CCCI is rescaled by the min/max of the whole frame, since that rescale
+    is linear its mean is recovered from the running NDRE sums and the frame min/max
+    """
+
+    def __init__(self, wavelength, names, diff_thresh=50, dtype=np.float32):
+        """
+        Args:
+            wavelength (list of float): Wavelength of each band of the blocks passed to update
+            names (list of str): Keys of SPECTRAL_INDICES to average
+        """
+        self.wavelength = np.asarray(wavelength, dtype=np.float64)
+        self.names = list(names)
+        self.diff_thresh = diff_thresh
+        self.dtype = dtype
+        # CCCI is NDRE (nan_to_num and clipped to [-1, 1]) before its rescale
+        self._compute = {name: 'ndre' if name == 'ccci' else name for name in self.names}
+        self.sums = {name: 0.0 for name in self.names}
+        self.count = 0
+        self.missing = set()
+        self.ndre_min = np.inf
+        self.ndre_max = -np.inf
+
+    def update(self, hyper, mask):
+        """Adds a block of calibrated data
+
+        Args:
+            hyper (numpy ndarray): HWC block, bands matching the wavelengths given to the constructor
+            mask (numpy ndarray): HW boolean mask of the pixels to average
+        """
+        computed = compute_indices(hyper, self.wavelength, sorted(set(self._compute.values())),
+                                   diff_thresh=self.diff_thresh, dtype=self.dtype)
+        for name in self.names:
+            index = computed[self._compute[name]]
+            if index is None:
+                self.missing.add(name)
+                continue
+            if name == 'ccci' and index.size:
+                self.ndre_min = min(self.ndre_min, float(np.min(index)))
+                self.ndre_max = max(self.ndre_max, float(np.max(index)))
+            self.sums[name] += index[mask].sum(dtype=np.float64)
+        self.count += np.count_nonzero(mask)
+
+    def means(self):
+        """
+        Returns a dict of index name -> mean over the mask, nan if the index could not be
+        computed or the mask was empty
+        """
+        results = {}
+        for name in self.names:
+            if name in self.missing or self.count == 0:
+                results[name] = np.nan
+            elif name == 'ccci':
+                limits = SPECTRAL_INDICES['ccci'].limits
+                if self.ndre_max > self.ndre_min:
+                    mean = (self.sums[name] / self.count - self.ndre_min) / (self.ndre_max - self.ndre_min)
+                else:
+                    mean = 0.0
+                results[name] = float(np.clip(mean, limits[0], limits[1]))
+            else:
+                results[name] = self.sums[name] / self.count
+        return results
+
+
+def apply_colour_map(data, cmap):
+    """Renders data in the range [0, 1] as a uint8 RGB image through a colour lookup table
+
+    Gives the same colours as plt.get_cmap(cmap)(data), values outside [0, 1] (including
+    +-inf) take the end colours, but without building an HxWx4 float image. NaN pixels are
+    black, the RGB of the colour map's transparent bad colour
+    """
+    lut = get_colour_lut(cmap)
+    lut_idx = np.multiply(data, lut.shape[0], dtype=np.result_type(data, np.float32))
+    bad = np.isnan(lut_idx)
+    lut_idx[bad] = 0
+    np.clip(lut_idx, 0, lut.shape[0] - 1, out=lut_idx)
+    rgb = np.take(lut, lut_idx.astype(np.uint8 if lut.shape[0] <= 256 else np.intp), axis=0)
+    rgb[bad] = 0
+    return rgb
+
+
+def save_colour_png(filepath, data, cmap, vmin=0, vmax=1):
+    """Writes data as a colour mapped PNG, straight from the lookup table without a pyplot figure
+
+    Gives the pixels plt.imshow(data, cmap=cmap, vmin=vmin, vmax=vmax) would show
+
+    Returns:
+        (bool): True if the image was written
+    """
+    scaled = (np.asarray(data) - vmin) / (vmax - vmin)
+    return cv2.imwrite(filepath, cv2.cvtColor(apply_colour_map(scaled, cmap), cv2.COLOR_RGB2BGR))
+
+
+def colourise_index(index, cmap):
+    """Renders an index as a uint8 RGB image, mapping [-1, 1] onto the colour map"""
+    return apply_colour_map((index+1)/2, cmap)
+
+
+def _get_index(hyper, wavelength, name, colour=True, prefix=None):
+    """Computes a single index in the dtype of hyper, and its colour image only if asked for
+
+    Shared by the get_* functions below. They return (index, colour image), or None if a
+    wavelength of the index is missing. With colour=False the colour image is not rendered
+    and None is returned in its place
+    """
+    dtype = hyper.dtype if np.issubdtype(hyper.dtype, np.floating) else np.float64
+    index = compute_indices(hyper, wavelength, [name], dtype=dtype, prefix=prefix)[name]
+    if index is None:
+        return None
+    index_out = colourise_index(index, SPECTRAL_INDICES[name].cmap) if colour else None
+    return index, index_out
+
+
+def get_ndvi(hyper, wavelength, colour=True):
     """
     Compute ndvi from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    nir = 800
-    red = 680
-    diff_thresh = 50
-    idx_nir, wl_nir, diff_nir = find_nearest(wavelength, nir)
-    idx_red, wl_red, diff_red = find_nearest(wavelength, red)
-    if diff_nir < diff_thresh and diff_red < diff_thresh:
-        rho_nir = hyper[:, :, idx_nir]
-        rho_red = hyper[:, :, idx_red]
-        numerator = rho_nir - rho_red
-        denominator = rho_nir + rho_red
-        with np.errstate(divide='ignore', invalid='ignore'):
-            ndvi = numerator / denominator
-            ndvi = np.nan_to_num(ndvi)
-            ndvi[ndvi > 1] = 1
-            ndvi[ndvi < -1] = -1
-
-        cm = plt.get_cmap('viridis')
-        ndvi_out = cm((ndvi+1)/2)[:, :, :3]
-        ndvi_out = ndvi_out * 255
-        ndvi_out = ndvi_out.astype(np.uint8)
-        return ndvi, ndvi_out
-    else:
-        return None
+    return _get_index(hyper, wavelength, 'ndvi', colour)
 
 
-def get_ndre(hyper, wavelength):
+def get_ndre(hyper, wavelength, colour=True):
     """
     Compute ndre from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    wl1 = 800
-    wl2 = 720
-    diff_thresh = 50
-    idx1, wl_1, diff_1 = find_nearest(wavelength, wl1)
-    idx2, wl_2, diff_2 = find_nearest(wavelength, wl2)
-    if diff_1 < diff_thresh and diff_2 < diff_thresh:
-        rho_1 = hyper[:, :, idx1]
-        rho_2 = hyper[:, :, idx2]
-        numerator = rho_1 - rho_2
-        denominator = rho_1 + rho_2
-        with np.errstate(divide='ignore', invalid='ignore'):
-            ndre = numerator / denominator
-            ndre = np.nan_to_num(ndre)
-            ndre[ndre > 1] = 1
-            ndre[ndre < -1] = -1
-
-
-        cm = plt.get_cmap('PiYG')
-        ndre_out = cm((ndre+1)/2)[:, :, :3]
-        ndre_out = ndre_out * 255
-        ndre_out = ndre_out.astype(np.uint8)
-        return ndre, ndre_out
-    else:
-        return None
-# reference for wavelegth: https://www.researchgate.net/publication/259360047_Use_of_the_Canopy_Chlorophyl_Content_Index_CCCI_for_Remote_Estimation_of_Wheat_Nitrogen_Content_in_Rainfed_Environments
-# reference for range: https://www.tandfonline.com/doi/pdf/10.1080/22797254.2018.1527661#:~:text=The%20NDRE%20values%20range%20between,the%20level%20of%20chlorophyll%20content.
+    return _get_index(hyper, wavelength, 'ndre', colour)
+
 
-# Modified according to paper
-def get_ccci(hyper, wavelength):
+def get_ccci(hyper, wavelength, colour=True):
     """
     Compute ccci from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    ndre, _ = get_ndre(hyper, wavelength)
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    nir = 800
-    # diff_thresh = 50
-    # idx_nir, wl_nir, diff_nir = find_nearest(wavelength, nir)
-    # if diff_nir < diff_thresh:
-    # rho_nir = hyper[:, :, idx_nir]
-    # rho_nir /= np.max(rho_nir)
-    numerator = ndre - np.min(ndre)
-    denominator = np.max(ndre) - np.min(ndre)
-    with np.errstate(divide='ignore', invalid='ignore'):
-        ccci = numerator / denominator
-        ccci = np.nan_to_num(ccci)
-        ccci[ccci > 1] = 1
-        ccci[ccci < 0] = 0
-
-        cm = plt.get_cmap('PiYG')
-        ccci_out = cm((ccci+1)/2)[:, :, :3]
-        ccci_out = ccci_out * 255
-        ccci_out = ccci_out.astype(np.uint8)
-        return ccci, ccci_out
-    # else:
-    #     return None
-# https://www.sciencedirect.com/science/article/pii/S1161030121001179
-
-def get_npci(hyper, wavelength):
+    return _get_index(hyper, wavelength, 'ccci', colour)
+
+
+def get_npci(hyper, wavelength, colour=True):
     """
     Compute npci from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    wl1 = 680
-    wl2 = 430
-    diff_thresh = 50
-    idx1, wl_1, diff_1 = find_nearest(wavelength, wl1)
-    idx2, wl_2, diff_2 = find_nearest(wavelength, wl2)
-    if diff_1 < diff_thresh and diff_2 < diff_thresh:
-        rho_1 = hyper[:, :, idx1]
-        rho_2 = hyper[:, :, idx2]
-        numerator = rho_1 - rho_2
-        denominator = rho_1 + rho_2
-        with np.errstate(divide='ignore', invalid='ignore'):
-            npci = numerator / denominator
-            npci = np.nan_to_num(npci)
-            npci[npci > 1] = 1
-            npci[npci < -1] = -1
-
-        cm = plt.get_cmap('PiYG')
-        npci_out = cm((npci+1)/2)[:, :, :3]
-        npci_out = npci_out * 255
-        npci_out = npci_out.astype(np.uint8)
-        return npci, npci_out
-    else:
-        return None
+    return _get_index(hyper, wavelength, 'npci', colour)
 
 
-def get_psri(hyper, wavelength):
+def get_psri(hyper, wavelength, colour=True):
     """
     Compute psri from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    wl1 = 680
-    wl2 = 531
-    wl3 = 800
-    diff_thresh = 50
-    idx1, wl_1, diff_1 = find_nearest(wavelength, wl1)
-    idx2, wl_2, diff_2 = find_nearest(wavelength, wl2)
-    idx3, wl_3, diff_3 = find_nearest(wavelength, wl3)
-    if diff_1 < diff_thresh and diff_2 < diff_thresh and diff_2 < diff_thresh:
-        rho_1 = hyper[:, :, idx1]
-        rho_2 = hyper[:, :, idx2]
-        rho_3 = hyper[:, :, idx3]
-        numerator = rho_1 - rho_2
-        denominator = rho_3
-        with np.errstate(divide='ignore', invalid='ignore'):
-            psri = numerator / denominator
-            psri = np.nan_to_num(psri)
-            psri[psri >1] = 1
-            psri[psri <-1] =-1
-
-
-        cm = plt.get_cmap('PiYG')
-        psri_out = cm((psri+1)/2)[:, :, :3]
-        psri_out = psri_out * 255
-        psri_out = psri_out.astype(np.uint8)
-
-        return psri, psri_out
-    else:
-        return None
+    return _get_index(hyper, wavelength, 'psri', colour)
 
 
-def get_pri(hyper, wavelength):
+def get_pri(hyper, wavelength, colour=True):
     """
     Compute pri from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    wl1 = 531
-    wl2 = 570
-    diff_thresh = 50
-    idx1, wl_1, diff_1 = find_nearest(wavelength, wl1)
-    idx2, wl_2, diff_2 = find_nearest(wavelength, wl2)
-    if diff_1 < diff_thresh and diff_2 < diff_thresh:
-        rho_1 = hyper[:, :, idx1]
-        rho_2 = hyper[:, :, idx2]
-        numerator = rho_1 - rho_2
-        denominator = rho_1 + rho_2
-        with np.errstate(divide='ignore', invalid='ignore'):
-            pri = numerator / denominator
-            pri = np.nan_to_num(pri)
-            pri[pri > 1] = 1
-            pri[pri < -1] = -1
-
-        cm = plt.get_cmap('PiYG')
-        pri_out = cm((pri+1)/2)[:, :, :3]
-        pri_out = pri_out * 255
-        pri_out = pri_out.astype(np.uint8)
-        return pri, pri_out
-    else:
-        return None
+    return _get_index(hyper, wavelength, 'pri', colour)
 
-def get_sr(hyper, wavelength):
+
+def get_sr(hyper, wavelength, colour=True):
     """
     Compute sr from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     SR = NIR / RED
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    nir = 800
-    red = 680
-    diff_thresh = 50
-    idx_nir, wl_nir, diff_nir = find_nearest(wavelength, nir)
-    idx_red, wl_red, diff_red = find_nearest(wavelength, red)
-    if diff_nir < diff_thresh and diff_red < diff_thresh:
-        rho_nir = hyper[:, :, idx_nir]
-        rho_red = hyper[:, :, idx_red]
-        with np.errstate(divide='ignore', invalid='ignore'):
-            sr = rho_nir / rho_red
-            sr = np.nan_to_num(sr)
-            sr[sr > 30] = 30
-            sr[sr < 0] = 0
-
-        cm = plt.get_cmap('viridis')
-        sr_out = cm((sr+1)/2)[:, :, :3]
-        sr_out = sr_out * 255
-        sr_out = sr_out.astype(np.uint8)
-        return sr, sr_out
-    else:
-        return None
+    return _get_index(hyper, wavelength, 'sr', colour)
 
 
-def get_sipi(hyper, wavelength):
+def get_sipi(hyper, wavelength, colour=True):
     """
     Compute sipi from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    wl1 = 800
-    wl2 = 445
-    wl3 = 680
-    diff_thresh = 50
-    idx1, wl_1, diff_1 = find_nearest(wavelength, wl1)
-    idx2, wl_2, diff_2 = find_nearest(wavelength, wl2)
-    idx3, wl_3, diff_3 = find_nearest(wavelength, wl3)
-    if diff_1 < diff_thresh and diff_2 < diff_thresh and diff_2 < diff_thresh:
-        rho_1 = hyper[:, :, idx1]
-        rho_2 = hyper[:, :, idx2]
-        rho_3 = hyper[:, :, idx3]
-        numerator = rho_1 - rho_2
-        denominator = rho_1 - rho_3
-        with np.errstate(divide='ignore', invalid='ignore'):
-            sipi = numerator / denominator
-            sipi = np.nan_to_num(sipi)
-            sipi[sipi >2] = 2
-            sipi[sipi < 0] = 0
-
-
-        cm = plt.get_cmap('PiYG')
-        sipi_out = cm((sipi+1)/2)[:, :, :3]
-        sipi_out = sipi_out * 255
-        sipi_out = sipi_out.astype(np.uint8)
-
-        return sipi, sipi_out
-    else:
-        return None
+    return _get_index(hyper, wavelength, 'sipi', colour)
+
 
 # in dip
-def get_rgr(hyper, wavelength):
+def get_rgr(hyper, wavelength, colour=True, prefix=None):
     """
     Compute rgr from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
+    prefix: optional BandPrefixSum of the data, reused for the green and red band means
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    wl1 = 490
-    wl2 = 570
-    wl3 = 640
-    wl4 = 760
-    diff_thresh = 50
-
-    idx1, wl_1, diff_1 = find_nearest(wavelength, wl1)
-    idx2, wl_2, diff_2 = find_nearest(wavelength, wl2)
-    idx3, wl_3, diff_3 = find_nearest(wavelength, wl3)
-    idx4, wl_4, diff_4 = find_nearest(wavelength, wl4)
-
-    if diff_1 < diff_thresh and diff_2 < diff_thresh and diff_2 < diff_thresh:
-
-        sum_green = hyper[:, :, idx1]
-        green_t = 0
-        for itr in range(idx1+1,idx2+1):
-            sum_green = sum_green + hyper[:, :, itr]
-            green_t += 1
-        mean_green = sum_green/green_t
-
-        sum_red = hyper[:, :, idx3]
-        red_t = 0
-        for itr in range(idx3+1,idx4+1):
-            sum_red = sum_red + hyper[:, :, itr]
-            red_t += 1
-        mean_red = sum_red/red_t
-
-
-        numerator = mean_red
-        denominator = mean_green
-        with np.errstate(divide='ignore', invalid='ignore'):
-            rgr = numerator / denominator
-            rgr = np.nan_to_num(rgr)
-            rgr[rgr > 8] = 8
-            rgr[rgr < 0.1] = 0.1
-
-
-        cm = plt.get_cmap('PiYG')
-        rgr_out = cm((rgr+1)/2)[:, :, :3]
-        rgr_out = rgr_out * 255
-        rgr_out = rgr_out.astype(np.uint8)
-
-        return rgr, rgr_out
-    else:
-        return None
+    return _get_index(hyper, wavelength, 'rgr', colour, prefix)
+
 
 # in dip
-def get_cri1(hyper, wavelength):
+def get_cri1(hyper, wavelength, colour=True):
     """
     Compute cri1 from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    wl1 = 510
-    wl2 = 550
-    diff_thresh = 50
-    idx1, wl_1, diff_1 = find_nearest(wavelength, wl1)
-    idx2, wl_2, diff_2 = find_nearest(wavelength, wl2)
-    if diff_1 < diff_thresh and diff_2 < diff_thresh:
-        rho_1 = hyper[:, :, idx1]
-        rho_2 = hyper[:, :, idx2]
-        with np.errstate(divide='ignore', invalid='ignore'):
-            cri1 = (1/rho_1) - (1/rho_2)
-            cri1 = np.nan_to_num(cri1)
-            cri1[cri1 > 15] = 15
-            cri1[cri1 < 0] = 0
-
-        cm = plt.get_cmap('PiYG')
-        cri1_out = cm((cri1+1)/2)[:, :, :3]
-        cri1_out = cri1_out * 255
-        cri1_out = cri1_out.astype(np.uint8)
-        return cri1, cri1_out
-    else:
-        return None
-
+    return _get_index(hyper, wavelength, 'cri1', colour)
 
 
-def get_cri2(hyper, wavelength):
+def get_cri2(hyper, wavelength, colour=True):
     """
     Compute cri2 from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    wl1 = 510
-    wl2 = 700
-    diff_thresh = 50
-    idx1, wl_1, diff_1 = find_nearest(wavelength, wl1)
-    idx2, wl_2, diff_2 = find_nearest(wavelength, wl2)
-    if diff_1 < diff_thresh and diff_2 < diff_thresh:
-        rho_1 = hyper[:, :, idx1]
-        rho_2 = hyper[:, :, idx2]
-        with np.errstate(divide='ignore', invalid='ignore'):
-            cri2 = (1/rho_1) - (1/rho_2)
-            cri2 = np.nan_to_num(cri2)
-            cri2[cri2 > 15] = 15
-            cri2[cri2 < 0] = 0
-
-        cm = plt.get_cmap('PiYG')
-        cri2_out = cm((cri2+1)/2)[:, :, :3]
-        cri2_out = cri2_out * 255
-        cri2_out = cri2_out.astype(np.uint8)
-        return cri2, cri2_out
-    else:
-        return None
+    return _get_index(hyper, wavelength, 'cri2', colour)
+
 
 # in dip
-def get_ari1(hyper, wavelength):
+def get_ari1(hyper, wavelength, colour=True):
     """
     Compute ari1 from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    wl1 = 550
-    wl2 = 700
-    diff_thresh = 50
-    idx1, wl_1, diff_1 = find_nearest(wavelength, wl1)
-    idx2, wl_2, diff_2 = find_nearest(wavelength, wl2)
-    if diff_1 < diff_thresh and diff_2 < diff_thresh:
-        rho_1 = hyper[:, :, idx1]
-        rho_2 = hyper[:, :, idx2]
-        with np.errstate(divide='ignore', invalid='ignore'):
-            ari1 = (1/rho_1) - (1/rho_2)
-            ari1 = np.nan_to_num(ari1)
-            ari1[ari1 > 0.2] = 0.2
-            ari1[ari1 < 0] = 0
-
-        cm = plt.get_cmap('PiYG')
-        ari1_out = cm((ari1+1)/2)[:, :, :3]
-        ari1_out = ari1_out * 255
-        ari1_out = ari1_out.astype(np.uint8)
-        return ari1, ari1_out
-    else:
-        return None
+    return _get_index(hyper, wavelength, 'ari1', colour)
+
 
-# in dip    
-def get_ari2(hyper, wavelength):
+# in dip
+def get_ari2(hyper, wavelength, colour=True):
     """
     Compute ari2 from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    wl1 = 550
-    wl2 = 700
-    wl3 = 800
-    diff_thresh = 50
-    idx1, wl_1, diff_1 = find_nearest(wavelength, wl1)
-    idx2, wl_2, diff_2 = find_nearest(wavelength, wl2)
-    idx3, wl_3, diff_3 = find_nearest(wavelength, wl3)
-    if diff_1 < diff_thresh and diff_2 < diff_thresh:
-        rho_1 = hyper[:, :, idx1]
-        rho_2 = hyper[:, :, idx2]
-        rho_3 = hyper[:, :, idx3]
-        with np.errstate(divide='ignore', invalid='ignore'):
-            ari2 = (1/rho_1) - (1/rho_2)
-            ari2 = rho_3 * ari2
-            ari2 = np.nan_to_num(ari2)
-            ari2[ari2 > 0.2] = 0.2
-            ari2[ari2 < 0] = 0
-
-        cm = plt.get_cmap('PiYG')
-        ari2_out = cm((ari2+1)/2)[:, :, :3]
-        ari2_out = ari2_out * 255
-        ari2_out = ari2_out.astype(np.uint8)
-        return ari2, ari2_out
-    else:
-        return None
-    
-    
-def get_rndvi(hyper, wavelength):
+    return _get_index(hyper, wavelength, 'ari2', colour)
+
+
+def get_rndvi(hyper, wavelength, colour=True):
     """
     Compute ndvi from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    nir = 750
-    red = 705
-    diff_thresh = 50
-    idx_nir, wl_nir, diff_nir = find_nearest(wavelength, nir)
-    idx_red, wl_red, diff_red = find_nearest(wavelength, red)
-    if diff_nir < diff_thresh and diff_red < diff_thresh:
-        rho_nir = hyper[:, :, idx_nir]
-        rho_red = hyper[:, :, idx_red]
-        numerator = rho_nir - rho_red
-        denominator = rho_nir + rho_red
-        with np.errstate(divide='ignore', invalid='ignore'):
-            ndvi = numerator / denominator
-            ndvi = np.nan_to_num(ndvi)
-            ndvi[ndvi > 1] = 1
-            ndvi[ndvi < -1] = -1
-
-        cm = plt.get_cmap('viridis')
-        ndvi_out = cm((ndvi+1)/2)[:, :, :3]
-        ndvi_out = ndvi_out * 255
-        ndvi_out = ndvi_out.astype(np.uint8)
-        return ndvi, ndvi_out
-    else:
-        return None
-    
-    
-def get_npqi(hyper, wavelength):
+    return _get_index(hyper, wavelength, 'rndvi', colour)
+
+
+def get_npqi(hyper, wavelength, colour=True):
     """
     Compute ndvi from data
     data[0]: wavelength 1xn
     data[1]: hyperspectral data hxwxn
     """
-    # hyper = data[1].astype(np.float)
-    # wavelength = data[0]
-    nir = 415
-    red = 430
-    diff_thresh = 50
-    idx_nir, wl_nir, diff_nir = find_nearest(wavelength, nir)
-    idx_red, wl_red, diff_red = find_nearest(wavelength, red)
-    if diff_nir < diff_thresh and diff_red < diff_thresh:
-        rho_nir = hyper[:, :, idx_nir]
-        rho_red = hyper[:, :, idx_red]
-        numerator = rho_nir - rho_red
-        denominator = rho_nir + rho_red
-        with np.errstate(divide='ignore', invalid='ignore'):
-            ndvi = numerator / denominator
-            ndvi = np.nan_to_num(ndvi)
-            ndvi[ndvi > 1.5] = 1.5
-            ndvi[ndvi < 0.5] = 0.5
-
-        cm = plt.get_cmap('viridis')
-        ndvi_out = cm((ndvi+1)/2)[:, :, :3]
-        ndvi_out = ndvi_out * 255
-        ndvi_out = ndvi_out.astype(np.uint8)
-        return ndvi, ndvi_out
-    else:
-        return None
+    return _get_index(hyper, wavelength, 'npqi', colour)
+
 
+def wavelengths_to_rgb(wavelengths, gamma=0.8):
+    '''Vectorized wavelength_to_rgb, converts an array of wavelengths
+    (nm) to approximate RGB colour values at once
+
+    Wavelengths outside 380-750nm are black. Where ranges meet, the first
+    range applies, as in wavelength_to_rgb
+
+    Returns:
+        (numpy ndarray): Nx3 R, G, B values in the range [0, 1]
+    '''
+    wl = np.asarray(wavelengths, dtype=np.float64).reshape(-1)
+    # Clipped so the ranges that do not apply to a wavelength never raise a negative
+    # number to a fractional power
+    ramp = lambda start, stop: np.clip((wl - start) / (stop - start), 0, None)
+    violet = 0.3 + 0.7 * np.clip(wl - 380, 0, None) / (440 - 380)
+    red = 0.3 + 0.7 * np.clip(750 - wl, 0, None) / (750 - 645)
+
+    conditions = [
+        (wl >= 380) & (wl <= 440),
+        (wl >= 440) & (wl <= 490),
+        (wl >= 490) & (wl <= 510),
+        (wl >= 510) & (wl <= 580),
+        (wl >= 580) & (wl <= 645),
+        (wl >= 645) & (wl <= 750),
+    ]
+    zero, one = np.zeros_like(wl), np.ones_like(wl)
+    r = np.select(conditions, [(np.clip(-(wl - 440) / (440 - 380), 0, None) * violet) ** gamma, zero, zero,
+                               ramp(510, 580) ** gamma, one, red ** gamma])
+    g = np.select(conditions, [zero, ramp(440, 490) ** gamma, one, one,
+                               np.clip(-(wl - 645) / (645 - 580), 0, None) ** gamma, zero])
+    b = np.select(conditions, [violet ** gamma, one, np.clip(-(wl - 510) / (510 - 490), 0, None) ** gamma,
+                               zero, zero, zero])
+    return np.stack([r, g, b], axis=-1)
 
 
 def wavelength_to_rgb(wavelength, gamma=0.8):
@@ -546,87 +621,116 @@ def wavelength_to_rgb(wavelength, gamma=0.8):
     Based on code by Dan Bruton
     http://www.physics.sfasu.edu/astro/color/spectra.html
     '''
+    return wavelengths_to_rgb([wavelength], gamma=gamma)[0].tolist()
 
-    wavelength = float(wavelength)
-    # if wavelength < 380:
-    #     wavelength = 380
-    # elif wavelength > 750:
-    #     wavelength = 750
-    if wavelength >= 380 and wavelength <= 440:
-        attenuation = 0.3 + 0.7 * (wavelength - 380) / (440 - 380)
-        R = ((-(wavelength - 440) / (440 - 380)) * attenuation) ** gamma
-        G = 0.0
-        B = (1.0 * attenuation) ** gamma
-    elif wavelength >= 440 and wavelength <= 490:
-        R = 0.0
-        G = ((wavelength - 440) / (490 - 440)) ** gamma
-        B = 1.0
-    elif wavelength >= 490 and wavelength <= 510:
-        R = 0.0
-        G = 1.0
-        B = (-(wavelength - 510) / (510 - 490)) ** gamma
-    elif wavelength >= 510 and wavelength <= 580:
-        R = ((wavelength - 510) / (580 - 510)) ** gamma
-        G = 1.0
-        B = 0.0
-    elif wavelength >= 580 and wavelength <= 645:
-        R = 1.0
-        G = (-(wavelength - 645) / (645 - 580)) ** gamma
-        B = 0.0
-    elif wavelength >= 645 and wavelength <= 750:
-        attenuation = 0.3 + 0.7 * (750 - wavelength) / (750 - 645)
-        R = (1.0 * attenuation) ** gamma
-        G = 0.0
-        B = 0.0
-    else:
-        R = 0.0
-        G = 0.0
-        B = 0.0
-    # R *= 255
-    # G *= 255
-    # B *= 255
-    return [R, G, B]
 
+def _rgb_to_hsv(rgb):
+    """Vectorized colorsys.rgb_to_hsv of an Nx3 array"""
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    maxc = rgb.max(axis=1)
+    minc = rgb.min(axis=1)
+    delta = maxc - minc
+    grey = delta == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.where(grey, 0.0, delta / maxc)
+        rc, gc, bc = [(maxc - c) / delta for c in (r, g, b)]
+        h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = np.where(grey, 0.0, (h / 6.0) % 1.0)
+    return np.stack([h, s, maxc], axis=-1)
+
+
+@lru_cache(maxsize=32)
+def _band_colour_lut(wavelengths):
+    hsv = _rgb_to_hsv(wavelengths_to_rgb(wavelengths))
+    lut = np.zeros((len(wavelengths), 2), dtype=np.uint8)
+    # Scaled to 0-255 and truncated as transfer_hyper_color_wl always has
+    lut[:, 0] = (hsv[:, 0] * 255).astype(int)
+    lut[:, 1] = (hsv[:, 1] * 255).astype(int)
+    visible = (np.asarray(wavelengths) >= 380) & (np.asarray(wavelengths) <= 750)
+    lut.flags.writeable = False
+    visible.flags.writeable = False
+    return lut, visible
+
+
+def get_band_colour_lut(wavelengths):
+    """Hue and saturation used to render each band in its own colour (cached per wavelength list)
+
+    Returns:
+        (numpy ndarray): Read-only Nx2 uint8 hue, saturation of each band
+        (numpy ndarray): Read-only N boolean, False for bands outside 380-750nm (rendered black)
+    """
+    return _band_colour_lut(tuple(float(wl) for wl in np.ravel(wavelengths)))
+
+
+def transfer_hyper_color_bands(data, wavelengths):
+    """Renders every band of a cube in the colour of its wavelength in one batch
+
+    Gives the same images as calling transfer_hyper_color_wl on each band
+
+    Args:
+        data (numpy ndarray): HWC cube (values are saturated to uint8 as the brightness)
+        wavelengths (list of float): Wavelength of each of the C bands
 
-def RGBToPyCmap(rgbdata):
-    nsteps = rgbdata.shape[0]
-    stepaxis = np.linspace(0, 1, nsteps)
+    Returns:
+        (numpy ndarray): C x H x W x 3 uint8 RGB images
+    """
+    row, col, bands = data.shape
+    lut, visible = get_band_colour_lut(wavelengths)
+    hsv = np.empty((bands, row, col, 3), dtype=np.uint8)
+    hsv[..., 0] = lut[:, 0, None, None]
+    hsv[..., 1] = lut[:, 1, None, None]
+    # convertScaleAbs works on 2D data, so the cube is flattened to one row per pixel
+    hsv[..., 2] = np.moveaxis(cv2.convertScaleAbs(data.reshape(row * col, bands)).reshape(row, col, bands), -1, 0)
+    data_out = cv2.cvtColor(hsv.reshape(bands * row, col, 3), cv2.COLOR_HSV2RGB).reshape(bands, row, col, 3)
+    data_out[~visible] = 0
+    return data_out
 
-    rdata = [];
-    gdata = [];
-    bdata = []
-    for istep in range(nsteps):
-        r = rgbdata[istep, 0]
-        g = rgbdata[istep, 1]
-        b = rgbdata[istep, 2]
-        rdata.append((stepaxis[istep], r, r))
-        gdata.append((stepaxis[istep], g, g))
-        bdata.append((stepaxis[istep], b, b))
 
-    mpl_data = {'red': rdata,
-                'green': gdata,
-                'blue': bdata}
+def spectral_contact_sheet(data, wavelengths, columns=24, step=1, band_step=1):
+    """Tiles a false-colour preview of every band into one image
 
-    return mpl_data
+    Args:
+        data (numpy ndarray): HWC cube, e.g. scaled to 0-255
+        wavelengths (list of float): Wavelength of each band
+        columns (int): Number of band thumbnails per row of the sheet
+        step (int): Spatial subsampling of each thumbnail
+        band_step (int): Only render every band_step-th band
+
+    Returns:
+        (numpy ndarray): uint8 RGB image
+    """
+    thumbs = transfer_hyper_color_bands(data[::step, ::step, ::band_step], np.ravel(wavelengths)[::band_step])
+    bands, row, col, _ = thumbs.shape
+    rows = -(-bands // columns)
+    sheet = np.zeros((rows * columns, row, col, 3), dtype=np.uint8)
+    sheet[:bands] = thumbs
+    # (rows, columns, h, w, 3) -> (rows, h, columns, w, 3)
+    return sheet.reshape(rows, columns, row, col, 3).swapaxes(1, 2).reshape(rows * row, columns * col, 3)
+
+
+@lru_cache(maxsize=None)
+def get_turbo_cmap():
+    """The turbo colour map of get_color_map as a matplotlib colour map, built once"""
+    return ListedColormap(get_color_map(), name='turbo')
 
 
 def save_disparity(savename, data, max_disp):
-    turbo_colormap_data = get_color_map()
-    mpl_data = RGBToPyCmap(turbo_colormap_data)
-    plt.register_cmap(name='turbo', data=mpl_data, lut=turbo_colormap_data.shape[0])
-    plt.imshow(data, cmap='turbo', vmin=0, vmax=max_disp)
-    plt.colorbar()
-    plt.savefig(savename)
-    plt.close()
+    # Drawn with the headless renderer (image and colour bar) so it can run from worker
+    # threads/processes, imported here as render depends on this module
+    from .render import render_index, save_rgb
+    save_rgb(savename, render_index(data, 'turbo', vmin=0, vmax=max_disp))
     # plt.show()
     # plt.imsave(savename, data, vmin=0, vmax=max_disp, cmap='turbo')
 
 
+def write_disparity_png(savename, data, max_disp):
+    """Saves a disparity image in the turbo colour map without a figure or colour bar (see save_colour_png)"""
+    return save_colour_png(savename, data, 'turbo', vmin=0, vmax=max_disp)
+
+
 def show_disparity(data, max_disp, min_disp, colorname):
-    # turbo_colormap_data = get_color_map()
-    # mpl_data = RGBToPyCmap(turbo_colormap_data)
-    # plt.register_cmap(name=colorname, data=mpl_data, lut=turbo_colormap_data.shape[0])
-    plt.imshow(data, cmap=colorname, vmin=min_disp, vmax=max_disp)
+    cmap = get_turbo_cmap() if colorname == 'turbo' else colorname
+    plt.imshow(data, cmap=cmap, vmin=min_disp, vmax=max_disp)
     plt.colorbar()
     plt.show()
 
@@ -634,10 +738,7 @@ def transfer_hyper_color(data, max=None):
     if max is not None:
         data = data / max
     # data = data/np.max(data)
-    cm = plt.get_cmap('gray')
-    data_out = cm(data)[:,:,:3]
-    data_out = data_out*255
-    data_out = data_out.astype(np.uint8)
+    data_out = apply_colour_map(data, 'gray')
 
     return data_out
 
@@ -647,24 +748,7 @@ def transfer_hyper_color_wl(data, wavelength):
     # data_out = data_out*255
     # data_out = data_out.astype(np.uint8)
 
-    if wavelength >= 380 and wavelength <= 750:
-        row, col = np.shape(data)
-        v = cv2.convertScaleAbs(data)
-
-        r, g, b = wavelength_to_rgb(wavelength)
-        h, s, _ = colorsys.rgb_to_hsv(r, g, b)
-        h = int(h * 255)
-        s = int(s * 255)
-        data_out = np.ones((row, col, 3), dtype=np.uint8)
-        data_out[:, :, 0] *= h
-        data_out[:, :, 1] *= s
-        data_out[:, :, 2] = v
-        data_out = cv2.cvtColor(data_out, cv2.COLOR_HSV2RGB)
-        return data_out
-    else:
-        return np.zeros((np.shape(data)[0], np.shape(data)[1], 3), dtype=np.uint8)
-
-
+    return transfer_hyper_color_bands(np.asarray(data)[:, :, None], [wavelength])[0]
 
 
 def get_color_map():
@@ -926,13 +1010,34 @@ def get_color_map():
                      [0.47960, 0.01583, 0.01055]])
 
 
+# Colour maps used in this module, their lookup tables are built once at import (COLOUR_LUTS).
+# Defined after get_color_map, which the turbo table comes from
+COLOUR_MAPS = ('turbo', 'viridis', 'PiYG', 'gray')
+
+
+@lru_cache(maxsize=None)
+def get_colour_lut(cmap):
+    """Returns the colour map as an Nx3 uint8 RGB lookup table (N=256 for the maps used here)
+
+    'turbo' is the table from get_color_map, as used by save_disparity
+    """
+    if cmap == 'turbo':
+        colours = get_color_map()
+    else:
+        cm = plt.get_cmap(cmap)
+        colours = cm(np.arange(cm.N))[:, :3]
+    lut = (colours * 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+COLOUR_LUTS = {cmap: get_colour_lut(cmap) for cmap in COLOUR_MAPS}
+
+
 def plot_color_gradients(cmap_name, size):
     gradient = np.linspace(0, 1, size[0])
     gradient = np.tile(gradient, (size[1], 1))
-    cm = plt.get_cmap(cmap_name)
-    out = cm(gradient)[:, :, :3]
-    out = out * 255
-    out = out.astype(np.uint8)
+    out = apply_colour_map(gradient, cmap_name)
     font = cv2.FONT_ITALIC
     fontScale = 0.5
     fontColor = (255, 255, 255)
@@ -951,4 +1056,4 @@ def plot_color_gradients(cmap_name, size):
     #             fontColor,
     #             lineType)
 
-    return out
\ No newline at end of file
+    return out
@@ -0,0 +1,59 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# custom_lib is imported from the hyperspec_data_processing folder, as in the notebook
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def pytest_configure(config):
+    # The synthetic BIL files have no georeferencing
+    config.addinivalue_line('filterwarnings', 'ignore::rasterio.errors.NotGeoreferencedWarning')
+
+
+BANDS = 40
+LINES = 24
+SAMPLES = 32
+
+
+def write_bil(base_filepath, lines=LINES, samples=SAMPLES, bands=BANDS, nbits=16, low=0, high=4095, seed=0,
+              wavelengths=None):
+    """Writes a random BIL image and its HDR file (wavelengths 390-1000nm), returns the data as CHW"""
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype('<u1') if nbits <= 8 else np.dtype('<u2')
+    data = rng.integers(low, high, size=(lines, bands, samples), dtype=dtype, endpoint=True)
+    data.tofile(base_filepath + '.bil')
+    if wavelengths is None:
+        wavelengths = np.linspace(390, 1000, bands)
+    with open(base_filepath + '.hdr', 'w') as hdr_file:
+        hdr_file.write('BYTEORDER I\nLAYOUT BIL\nNROWS {}\nNCOLS {}\nNBANDS {}\nNBITS {}\n'.format(
+            lines, samples, bands, nbits))
+        hdr_file.write('WAVELENGTHS\n')
+        for wavelength in wavelengths:
+            hdr_file.write('{:.2f}\n'.format(wavelength))
+        hdr_file.write('WAVELENGTHS_END\n')
+    return data.transpose(1, 0, 2)
+
+
+@pytest.fixture
+def tray(tmp_path):
+    """Base paths of a synthetic tray image and its white and dark calibration frames"""
+    paths = {
+        'tray': str(tmp_path / 'a_round-0_cam-1_tray-Tray_1'),
+        'white': str(tmp_path / 'a_round-0_cam-1_calibFrame'),
+        'dark': str(tmp_path / 'b_round-0_cam-1_calibFrame'),
+    }
+    write_bil(paths['tray'], low=500, high=3000, seed=1)
+    write_bil(paths['white'], lines=8, low=3000, high=4000, seed=2)
+    write_bil(paths['dark'], lines=8, low=0, high=400, seed=3)
+    return paths
+
+
+@pytest.fixture(autouse=True)
+def _clear_calib_cache():
+    from custom_lib.hyperspectral import clear_calib_cache
+    clear_calib_cache()
+    yield
+    clear_calib_cache()
@@ -0,0 +1,77 @@
+import csv
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from conftest import write_bil
+from custom_lib.batch import find_tray_jobs, hyp_mask, hyp_mask_images, process_dataset, process_tray
+
+PNG_NAMES = ['2023-01-01_1', '2023-01-01_2', '2023-01-01_3']
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    """Three trays of one round, their reference pngs and a white/dark calibration pair"""
+    write_bil(str(tmp_path / 'a_round-0_cam-1_calibFrame'), lines=8, low=3000, high=4000, seed=2)
+    write_bil(str(tmp_path / 'b_round-0_cam-1_calibFrame'), lines=8, low=0, high=400, seed=3)
+    for k, png in enumerate(PNG_NAMES):
+        img = np.zeros((24, 32, 3), np.uint8)
+        # A green (BGR) plant
+        img[5:15, 6:20] = (40, 200, 60)
+        cv2.imwrite(str(tmp_path / (png + '.png')), img)
+        write_bil(str(tmp_path / (png.replace('_', '--') + '_round-0_cam-1_tray-Tray_{}'.format(k + 1))),
+                  low=500, high=3000, seed=10 + k)
+    return tmp_path
+
+
+def test_hyp_mask(dataset):
+    mask, img, green = hyp_mask_images(str(dataset / '2023-01-01_1.png'))
+    assert mask.dtype == np.uint8
+    assert set(np.unique(mask)) == {0, 255}
+    # The opening keeps the whole 10 x 14 plant
+    assert np.count_nonzero(mask) == np.count_nonzero(img[:, :, 1] == 200) == 140
+    assert np.array_equal(green, img)
+    np.testing.assert_array_equal(hyp_mask(str(dataset / '2023-01-01_1.png')), mask)
+
+
+def test_find_tray_jobs(dataset):
+    jobs = find_tray_jobs(str(dataset))
+    assert [job[0] for job in jobs] == [0, 1, 2]
+    assert [os.path.basename(job[2]) for job in jobs] == [
+        '2023-01-01--{}_round-0_cam-1_tray-Tray_{}'.format(k, k) for k in (1, 2, 3)]
+    assert {job[3] for job in jobs} == {str(dataset / 'a_round-0_cam-1_calibFrame')}
+    assert {job[4] for job in jobs} == {str(dataset / 'b_round-0_cam-1_calibFrame')}
+
+
+def test_find_tray_jobs_missing_calibration(dataset):
+    os.remove(str(dataset / 'b_round-0_cam-1_calibFrame.hdr'))
+    with pytest.raises(ValueError, match=str(dataset)):
+        find_tray_jobs(str(dataset))
+
+
+@pytest.mark.parametrize('block_lines', [None, 5])
+def test_process_dataset(dataset, tmp_path, block_lines):
+    out_csv = str(tmp_path / 'traits.csv')
+    written, failed = process_dataset(str(dataset), out_csv=out_csv, workers=2, block_lines=block_lines)
+    assert written == 3 and failed == []
+
+    with open(out_csv) as csv_file:
+        rows = sorted(csv.reader(csv_file), key=lambda row: row[0])
+    header, rows = rows[-1], rows[:-1]
+    assert header[0] == 'tray_id'
+    for job, row in zip(find_tray_jobs(str(dataset)), rows):
+        np.testing.assert_allclose([float(value) for value in row[1:]], process_tray(job)[1:], rtol=1e-5)
+
+
+def test_process_dataset_reports_failed_trays(dataset, tmp_path):
+    # A truncated tray image cannot be read
+    bil_filepath = str(dataset / '2023-01-01--2_round-0_cam-1_tray-Tray_2.bil')
+    with open(bil_filepath, 'r+b') as bil_file:
+        bil_file.truncate(100)
+    written, failed = process_dataset(str(dataset), out_csv=str(tmp_path / 'traits.csv'), workers=2)
+    assert written == 2
+    assert [(tray_id, os.path.basename(image_path)) for tray_id, image_path, _ in failed] == [
+        (1, '2023-01-01--2_round-0_cam-1_tray-Tray_2')]
+    assert isinstance(failed[0][2], Exception)
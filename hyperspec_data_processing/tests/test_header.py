@@ -0,0 +1,89 @@
+import json
+import os
+
+import numpy as np
+
+from conftest import BANDS, LINES, SAMPLES, write_bil
+from custom_lib.header import INDEX_FILENAME, DatasetIndex, HyperspectralHeader
+
+
+def _write_dataset(folder):
+    write_bil(str(folder / 'a_round-0_cam-1_calibFrame'), lines=8)
+    write_bil(str(folder / 'b_round-0_cam-1_calibFrame'), lines=8)
+    for round_, tray in [(1, 2), (0, 2), (0, 1)]:
+        write_bil(str(folder / 'scan_round-{}_cam-1_tray-Tray_{}'.format(round_, tray)))
+
+
+def test_header_from_file(tmp_path):
+    write_bil(str(tmp_path / 'scan_round-0_cam-1_tray-Tray_3'), nbits=12)
+    header = HyperspectralHeader.from_file(str(tmp_path / 'scan_round-0_cam-1_tray-Tray_3.bil'))
+    assert header.shape == (LINES, SAMPLES, BANDS)
+    assert header.nbits == 12
+    assert header.dtype == np.dtype('<u2')
+    assert len(header.wavelengths) == BANDS
+    assert header.name_fields == {'scan': 'scan', 'round': 0, 'cam': 1, 'tray': 3, 'calib_frame': False}
+
+    restored = HyperspectralHeader.from_dict(header.to_dict(), str(tmp_path))
+    assert restored.to_dict() == header.to_dict()
+    assert restored.base_filepath == header.base_filepath
+
+
+def test_dataset_index(tmp_path):
+    _write_dataset(tmp_path)
+    index = DatasetIndex.load(str(tmp_path))
+    assert len(index) == 5
+    assert os.path.exists(str(tmp_path / INDEX_FILENAME))
+
+    assert [(header.name_fields['round'], header.name_fields['tray']) for header in index.trays()] == [
+        (0, 1), (0, 2), (1, 2)]
+    assert sorted(os.path.basename(header.base_filepath) for header in index.calib_frames()) == [
+        'a_round-0_cam-1_calibFrame', 'b_round-0_cam-1_calibFrame']
+    assert len(index.find(round=0)) == 4
+
+    # Looked up by name or path, with or without an extension
+    header = index[str(tmp_path / 'scan_round-0_cam-1_tray-Tray_2.bil')]
+    assert header is index['scan_round-0_cam-1_tray-Tray_2']
+    assert 'scan_round-0_cam-1_tray-Tray_2.hdr' in index
+    assert index.get('missing') is None
+
+
+def test_dataset_index_reuses_sidecar(tmp_path):
+    _write_dataset(tmp_path)
+    DatasetIndex.load(str(tmp_path))
+    index_filepath = str(tmp_path / INDEX_FILENAME)
+
+    # Unchanged entries are read from the sidecar rather than the .hdr files
+    with open(index_filepath) as index_file:
+        contents = json.load(index_file)
+    contents['entries']['scan_round-0_cam-1_tray-Tray_1']['header']['lines'] = 99
+    with open(index_filepath, 'w') as index_file:
+        json.dump(contents, index_file)
+    assert DatasetIndex.load(str(tmp_path))['scan_round-0_cam-1_tray-Tray_1'].lines == 99
+
+    # A changed header is parsed again and the sidecar updated
+    write_bil(str(tmp_path / 'scan_round-0_cam-1_tray-Tray_1'), lines=LINES + 1)
+    os.utime(str(tmp_path / 'scan_round-0_cam-1_tray-Tray_1.hdr'), (0, 0))
+    assert DatasetIndex.load(str(tmp_path))['scan_round-0_cam-1_tray-Tray_1'].lines == LINES + 1
+    with open(index_filepath) as index_file:
+        assert json.load(index_file)['entries']['scan_round-0_cam-1_tray-Tray_1']['header']['lines'] == LINES + 1
+
+    # Removed images are dropped from the index
+    os.remove(str(tmp_path / 'scan_round-1_cam-1_tray-Tray_2.hdr'))
+    assert 'scan_round-1_cam-1_tray-Tray_2' not in DatasetIndex.load(str(tmp_path))
+
+
+def test_dataset_index_without_writing(tmp_path):
+    _write_dataset(tmp_path)
+    index = DatasetIndex.load(str(tmp_path), nbits=12, write=False)
+    assert len(index) == 5
+    assert not os.path.exists(str(tmp_path / INDEX_FILENAME))
+    assert all(header.nbits == 12 and header.nbits_override for header in index)
+
+
+def test_dataset_index_skips_subfolders(tmp_path):
+    _write_dataset(tmp_path)
+    (tmp_path / 'batch_2').mkdir()
+    write_bil(str(tmp_path / 'batch_2' / 'scan_round-2_cam-1_tray-Tray_1'))
+    index = DatasetIndex.load(str(tmp_path))
+    assert len(index) == 5
+    assert index.find(round=2) == []
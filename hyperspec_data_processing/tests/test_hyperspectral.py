@@ -0,0 +1,148 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import BANDS, LINES, SAMPLES, write_bil
+from custom_lib.hyperspectral import (HyperspectralImage, clear_calib_cache, load_calib_frame, load_calibrated_cube,
+                                      save_calibrated_cube)
+
+
+def _calib_reference(data):
+    # Calibration frames are averaged over their scan lines and stored as (columns, bands)
+    return data.mean(axis=1).T
+
+
+def test_calib_frame_is_averaged_over_lines(tmp_path):
+    data = write_bil(str(tmp_path / 'white'), lines=8, seed=2)
+    calib = load_calib_frame(str(tmp_path / 'white'))
+    np.testing.assert_allclose(calib, _calib_reference(data))
+    assert not calib.flags.writeable
+
+
+def test_calib_frame_is_reused_from_disk(tmp_path):
+    data = write_bil(str(tmp_path / 'white'), lines=8, seed=2)
+    cache_dir = tmp_path / 'cache'
+    load_calib_frame(str(tmp_path / 'white'), cache_dir=str(cache_dir))
+    assert [name for name in os.listdir(cache_dir) if name.endswith('.tmp')] == []
+    (npz_filepath,) = cache_dir.glob('*.npz')
+
+    # A cached frame is read back instead of the image
+    np.savez(str(npz_filepath), calib=np.full((1, 1), 7.0), filepath=str(tmp_path / 'white'),
+             mtime=os.path.getmtime(str(tmp_path / 'white.bil')))
+    clear_calib_cache()
+    np.testing.assert_array_equal(load_calib_frame(str(tmp_path / 'white'), cache_dir=str(cache_dir)), [[7.0]])
+
+    # Touching the image invalidates the cached frame
+    os.utime(str(tmp_path / 'white.bil'), (0, 0))
+    clear_calib_cache()
+    np.testing.assert_allclose(load_calib_frame(str(tmp_path / 'white'), cache_dir=str(cache_dir)),
+                               _calib_reference(data))
+
+
+@pytest.mark.parametrize('corrupt', [
+    lambda contents: contents[:100],
+    lambda contents: b'',
+    lambda contents: b'not a zip file',
+])
+def test_unreadable_calib_cache_is_recomputed(tmp_path, corrupt):
+    data = write_bil(str(tmp_path / 'white'), lines=8, seed=2)
+    cache_dir = tmp_path / 'cache'
+    load_calib_frame(str(tmp_path / 'white'), cache_dir=str(cache_dir))
+    (npz_filepath,) = cache_dir.glob('*.npz')
+    npz_filepath.write_bytes(corrupt(npz_filepath.read_bytes()))
+
+    clear_calib_cache()
+    np.testing.assert_allclose(load_calib_frame(str(tmp_path / 'white'), cache_dir=str(cache_dir)),
+                               _calib_reference(data))
+    # The broken file is replaced by a readable one
+    with np.load(str(npz_filepath)) as cached:
+        np.testing.assert_allclose(cached['calib'], _calib_reference(data))
+
+
+def _calibrated_reference(tray):
+    """The whole tray calibrated in float64, HWC"""
+    raw = np.fromfile(tray['tray'] + '.bil', dtype='<u2').reshape(LINES, BANDS, SAMPLES).transpose(0, 2, 1)
+    white = _calib_reference(_read_chw(tray['white'], 8))
+    dark = _calib_reference(_read_chw(tray['dark'], 8))
+    return np.clip((raw - dark) / (white - dark + 1e-10), 0, 1)
+
+
+def _read_chw(base_filepath, lines):
+    return np.fromfile(base_filepath + '.bil', dtype='<u2').reshape(lines, BANDS, SAMPLES).transpose(1, 0, 2)
+
+
+@pytest.mark.parametrize('backend', ['rasterio', 'memmap'])
+def test_extract_all_layers(tray, backend):
+    image = HyperspectralImage(tray['tray'], tray['white'], tray['dark'], backend=backend)
+    wavelengths, cube = image.extract_all_layers()
+    assert len(wavelengths) == BANDS
+    np.testing.assert_allclose(cube, _calibrated_reference(tray), rtol=1e-12)
+
+
+@pytest.mark.parametrize('backend', ['rasterio', 'memmap'])
+@pytest.mark.parametrize('crop_region', [
+    [[5, 7], [30, 20]],
+    [[0, 0], [SAMPLES, LINES]],
+    # Out of range coordinates are clipped like array slices
+    [[-4, 3], [100, 100]],
+    [[10, 10], [10, 20]],
+])
+def test_crop_region_is_read_directly(tray, backend, crop_region):
+    image = HyperspectralImage(tray['tray'], tray['white'], tray['dark'], backend=backend)
+    (col_start, row_start), (col_stop, row_stop) = crop_region
+    expected = _calibrated_reference(tray)[row_start:row_stop, col_start:col_stop]
+    _, cube = image.extract_all_layers(crop_region=crop_region)
+    assert cube.shape == expected.shape
+    np.testing.assert_allclose(cube, expected, rtol=1e-12)
+
+    band, layer = image.extract_image_layer(700, crop_region=crop_region)
+    np.testing.assert_allclose(layer, expected[:, :, band], rtol=1e-12)
+
+    bands, rgb = image.extract_rgb_layers((700, 530, 470), crop_region=crop_region)
+    np.testing.assert_allclose(rgb, expected[:, :, list(bands)], rtol=1e-12)
+
+
+def test_iter_line_blocks_crop(tray):
+    image = HyperspectralImage(tray['tray'], tray['white'], tray['dark'])
+    crop_region = [[3, 2], [25, 21]]
+    blocks = [block for _, block in image.iter_line_blocks(5, crop_region=crop_region, dtype=np.float64)]
+    np.testing.assert_allclose(np.concatenate(blocks), image.extract_all_layers(crop_region=crop_region)[1])
+
+
+@pytest.mark.parametrize('band_block', [7, 32])
+def test_export_hdf5_round_trip(tray, tmp_path, band_block):
+    pytest.importorskip('h5py')
+    image = HyperspectralImage(tray['tray'], tray['white'], tray['dark'])
+    wavelengths, cube = image.extract_all_layers(dtype=np.float32)
+    # Chunks smaller than the image, so reads span several of them
+    filepath = image.export_hdf5(str(tmp_path / 'cube.hdf5'), band_block=band_block, band_chunk=16, tile_size=10)
+
+    loaded_wavelengths, loaded, attrs = load_calibrated_cube(filepath)
+    assert loaded_wavelengths == wavelengths
+    assert loaded.dtype == np.float32
+    np.testing.assert_array_equal(loaded, cube)
+    assert attrs['source'] == os.path.abspath(tray['tray'] + '.bil')
+    assert attrs['white_calib'] == os.path.abspath(tray['white'] + '.bil')
+    assert attrs['dark_calib'] == os.path.abspath(tray['dark'] + '.bil')
+
+
+def test_load_calibrated_cube_bands_and_crop(tray, tmp_path):
+    pytest.importorskip('h5py')
+    image = HyperspectralImage(tray['tray'], tray['white'], tray['dark'])
+    wavelengths, cube = image.extract_all_layers(dtype=np.float32)
+    filepath = str(tmp_path / 'cube.hdf5')
+    save_calibrated_cube(filepath, wavelengths, cube, attrs={'note': 'test'}, tile_size=10)
+
+    crop_region = [[5, 7], [30, 20]]
+    # Out of order and repeated wavelengths come back in the order asked for
+    loaded_wavelengths, loaded, attrs = load_calibrated_cube(filepath, wavelengths=[800, 470, 800, 531],
+                                                             crop_region=crop_region)
+    bands = [int(np.argmin(np.abs(np.asarray(wavelengths) - wl))) for wl in (800, 470, 800, 531)]
+    assert loaded_wavelengths == [wavelengths[band] for band in bands]
+    np.testing.assert_array_equal(loaded, cube[7:20, 5:30][:, :, bands])
+    assert attrs == {'note': 'test'}
+
+    _, loaded, _ = load_calibrated_cube(filepath, crop_region=crop_region)
+    _, cropped = image.extract_all_layers(crop_region=crop_region, dtype=np.float32)
+    np.testing.assert_array_equal(loaded, cropped)
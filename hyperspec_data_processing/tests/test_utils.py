@@ -0,0 +1,164 @@
+import cv2
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+
+from custom_lib import utils
+from custom_lib.utils import (SPECTRAL_INDICES, MaskedIndexMeans, compute_indices, find_nearest,
+                              index_band_indices)
+
+WAVELENGTHS = np.linspace(390, 1000, 120)
+
+
+@pytest.fixture
+def cube():
+    rng = np.random.default_rng(0)
+    hyper = rng.uniform(0.05, 1.2, size=(9, 11, len(WAVELENGTHS)))
+    # Zero pixels exercise the nan_to_num of divisions by zero
+    hyper[0, :3] = 0
+    return hyper
+
+
+def _reference_indices(hyper):
+    """The spectral indices written out one by one, as the original get_* functions computed them"""
+    def band(wavelength):
+        return hyper[:, :, find_nearest(WAVELENGTHS, wavelength)[0]]
+
+    def band_mean(start, stop):
+        first, last = find_nearest(WAVELENGTHS, start)[0], find_nearest(WAVELENGTHS, stop)[0]
+        # Divided by the number of steps rather than bands, as in get_rgr
+        return hyper[:, :, first:last + 1].sum(axis=2) / (last - first)
+
+    def normalised_difference(first, second):
+        return (band(first) - band(second)) / (band(first) + band(second))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ndre = np.clip(np.nan_to_num(normalised_difference(800, 720)), -1, 1)
+        indices = {
+            'ndvi': normalised_difference(800, 680),
+            'ndre': ndre,
+            'ccci': (ndre - ndre.min()) / (ndre.max() - ndre.min()),
+            'npci': normalised_difference(680, 430),
+            'psri': (band(680) - band(531)) / band(800),
+            'pri': normalised_difference(531, 570),
+            'sr': band(800) / band(680),
+            'sipi': (band(800) - band(445)) / (band(800) - band(680)),
+            'rgr': band_mean(640, 760) / band_mean(490, 570),
+            'cri1': 1 / band(510) - 1 / band(550),
+            'cri2': 1 / band(510) - 1 / band(700),
+            'ari1': 1 / band(550) - 1 / band(700),
+            'ari2': band(800) * (1 / band(550) - 1 / band(700)),
+            'rndvi': normalised_difference(750, 705),
+            'npqi': normalised_difference(415, 430),
+        }
+    return {name: np.clip(np.nan_to_num(index), *SPECTRAL_INDICES[name].limits) for name, index in indices.items()}
+
+
+def test_compute_indices_matches_reference(cube):
+    indices = compute_indices(cube, WAVELENGTHS, list(SPECTRAL_INDICES), dtype=np.float64)
+    reference = _reference_indices(cube)
+    assert set(indices) == set(SPECTRAL_INDICES)
+    for name, index in indices.items():
+        np.testing.assert_allclose(index, reference[name], rtol=1e-12, atol=1e-12, err_msg=name)
+
+
+def test_compute_indices_float32(cube):
+    indices = compute_indices(cube, WAVELENGTHS, list(SPECTRAL_INDICES))
+    reference = _reference_indices(cube)
+    for name, index in indices.items():
+        assert index.dtype == np.float32
+        np.testing.assert_allclose(index, reference[name], rtol=1e-4, atol=1e-5, err_msg=name)
+
+
+def test_compute_indices_prefix_sum(cube):
+    prefix = utils.BandPrefixSum(cube)
+    with_prefix = compute_indices(cube, WAVELENGTHS, ['rgr'], dtype=np.float64, prefix=prefix)['rgr']
+    np.testing.assert_allclose(with_prefix, compute_indices(cube, WAVELENGTHS, ['rgr'], dtype=np.float64)['rgr'])
+
+
+def test_compute_indices_on_needed_bands_only(cube):
+    names = list(SPECTRAL_INDICES)
+    bands = index_band_indices(WAVELENGTHS, names)
+    subset = compute_indices(cube[..., bands], WAVELENGTHS[bands], names, dtype=np.float64)
+    full = compute_indices(cube, WAVELENGTHS, names, dtype=np.float64)
+    for name in names:
+        np.testing.assert_allclose(subset[name], full[name], rtol=1e-12, err_msg=name)
+
+
+def test_compute_indices_missing_wavelengths(cube):
+    # Only the visible bands, so every index using 800nm is not computed
+    visible = WAVELENGTHS < 700
+    indices = compute_indices(cube[..., visible], WAVELENGTHS[visible], ['ndvi', 'pri'])
+    assert indices['ndvi'] is None
+    assert indices['pri'] is not None
+
+
+@pytest.mark.parametrize('name', sorted(SPECTRAL_INDICES))
+def test_get_index_wrappers(cube, name):
+    index, colour = getattr(utils, 'get_' + name)(cube, WAVELENGTHS)
+    np.testing.assert_allclose(index, _reference_indices(cube)[name], rtol=1e-12, atol=1e-12)
+    assert colour.shape == cube.shape[:2] + (3,) and colour.dtype == np.uint8
+    index_only, no_colour = getattr(utils, 'get_' + name)(cube, WAVELENGTHS, colour=False)
+    assert no_colour is None
+    np.testing.assert_array_equal(index_only, index)
+
+
+def test_compute_indices_empty_input(cube):
+    indices = compute_indices(cube[:0], WAVELENGTHS, ['ccci', 'ndvi'])
+    assert indices['ccci'].shape == (0, cube.shape[1])
+    assert indices['ndvi'].shape == (0, cube.shape[1])
+
+
+@pytest.mark.parametrize('block_lines', [1, 4, 9])
+def test_masked_index_means_matches_full_compute(cube, block_lines):
+    names = list(SPECTRAL_INDICES)
+    mask = np.random.default_rng(1).random(cube.shape[:2]) < 0.4
+    # Includes the zero pixels
+    mask[0, 0] = True
+
+    means = MaskedIndexMeans(WAVELENGTHS, names, dtype=np.float64)
+    for start in range(0, len(cube), block_lines):
+        means.update(cube[start:start + block_lines], mask[start:start + block_lines])
+    assert means.count == np.count_nonzero(mask)
+
+    full = compute_indices(cube, WAVELENGTHS, names, dtype=np.float64)
+    result = means.means()
+    for name in names:
+        np.testing.assert_allclose(result[name], full[name][mask].mean(), rtol=1e-10, err_msg=name)
+
+
+def test_masked_index_means_missing_and_empty(cube):
+    visible = WAVELENGTHS < 700
+    means = MaskedIndexMeans(WAVELENGTHS[visible], ['ndvi', 'pri'])
+    means.update(cube[..., visible], np.ones(cube.shape[:2], bool))
+    result = means.means()
+    assert np.isnan(result['ndvi'])
+    assert not np.isnan(result['pri'])
+
+    means = MaskedIndexMeans(WAVELENGTHS, ['ndvi', 'ccci'])
+    means.update(cube, np.zeros(cube.shape[:2], bool))
+    assert all(np.isnan(value) for value in means.means().values())
+
+
+@pytest.mark.parametrize('cmap', utils.COLOUR_MAPS)
+def test_apply_colour_map_matches_matplotlib(cmap):
+    data = np.concatenate([np.linspace(-0.5, 1.5, 401), [np.inf, -np.inf]]).reshape(13, 31)
+    mpl_cmap = utils.get_turbo_cmap() if cmap == 'turbo' else plt.get_cmap(cmap)
+    expected = (mpl_cmap(data)[:, :, :3] * 255).astype(np.uint8)
+    np.testing.assert_array_equal(utils.apply_colour_map(data, cmap), expected)
+    np.testing.assert_array_equal(utils.COLOUR_LUTS[cmap], utils.get_colour_lut(cmap))
+
+
+def test_apply_colour_map_nan_is_black():
+    data = np.array([[0.2, np.nan], [np.nan, 0.9]], dtype=np.float32)
+    rgb = utils.apply_colour_map(data, 'viridis')
+    np.testing.assert_array_equal(rgb[[0, 1], [1, 0]], 0)
+    assert rgb[0, 0].any() and rgb[1, 1].any()
+
+
+def test_save_colour_png(tmp_path):
+    data = np.linspace(0, 40, 64).reshape(8, 8)
+    filepath = str(tmp_path / 'disparity.png')
+    assert utils.write_disparity_png(filepath, data, max_disp=40)
+    expected = (utils.get_turbo_cmap()(data / 40)[:, :, :3] * 255).astype(np.uint8)
+    np.testing.assert_array_equal(cv2.cvtColor(cv2.imread(filepath), cv2.COLOR_BGR2RGB), expected)
@@ -1,111 +1,33 @@
-Last login: Tue Mar 22 16:33:58 on ttys009
-pet22a@SERPENTINE-HF portal-core-ui-app % pwd
-/Users/pet22a/AuScope/portal-core-ui-app
-pet22a@SERPENTINE-HF portal-core-ui-app % cd ../..
-pet22a@SERPENTINE-HF ~ % ls
-Applications				Downloads				Untitled.ipynb				lena
-AuScope					Edge_Detection.ipynb			demo_notebooks				pipeline-fracture
-Automatic-Fracture-Detection-Code	Library					eclipse-workspace			pyAFDC
-Bingie_Bingie_area1			Movies					example.py				pyAFDC.ipynb
-Bingie_Bingie_area1_small		Music					flask_project				pyJupyter
-Bingie_Bingie_area2			Pictures				get-pip.py				python_to_c
-DJI_0003A				Postman					ipython-in-depth
-Desktop					Public					jnb.config
-Documents				PyCoShREM				knownlayers.json
-pet22a@SERPENTINE-HF ~ % cd ecl*
-pet22a@SERPENTINE-HF eclipse-workspace % ls
-RemoteSystemsTempFiles			auscope-portal-api copy 10FEB2022	portal-core copy 10FEB2022
-auscope-portal-api			portal-core
-pet22a@SERPENTINE-HF eclipse-workspace % cd portal-core
-pet22a@SERPENTINE-HF portal-core % ls
-COPYING				README.md			checkstyle.xml			pom.xml				target
-COPYING.LESSER			azure-pipelines.yml		eclipse-format-java-modest.xml	src
-pet22a@SERPENTINE-HF portal-core % git config --get remote.origin.url
-https://github.com/chrisvpeters/portal-core.git
-pet22a@SERPENTINE-HF portal-core % 
-pet22a@SERPENTINE-HF portal-core % 
-pet22a@SERPENTINE-HF portal-core % 
-pet22a@SERPENTINE-HF portal-core % ls -lt ~/AuScope/portal-core-ui-app/projects/portal-core-ui/src/lib/service/wms/get-caps.service.ts
-ls: /Users/pet22a/AuScope/portal-core-ui-app/projects/portal-core-ui/src/lib/service/wms/get-caps.service.ts: No such file or directory
-pet22a@SERPENTINE-HF portal-core % pwd
-/Users/pet22a/eclipse-workspace/portal-core
-pet22a@SERPENTINE-HF portal-core % ls
-COPYING				README.md			checkstyle.xml			pom.xml				target
-COPYING.LESSER			azure-pipelines.yml		eclipse-format-java-modest.xml	src
-pet22a@SERPENTINE-HF portal-core % ls -lt
-total 216
--rw-r--r--  1 pet22a  staff  16597 18 Feb 14:36 pom.xml
--rw-r--r--  1 pet22a  staff   1113 18 Feb 14:36 azure-pipelines.yml
-drwxr-xr-x  4 pet22a  staff    128  5 Oct  2021 target
--rw-r--r--  1 pet22a  staff   3891  5 Oct  2021 checkstyle.xml
--rw-r--r--  1 pet22a  staff  35147  5 Oct  2021 COPYING
--rw-r--r--  1 pet22a  staff  30991  5 Oct  2021 eclipse-format-java-modest.xml
--rw-r--r--  1 pet22a  staff   7651  5 Oct  2021 COPYING.LESSER
--rw-r--r--  1 pet22a  staff    131  5 Oct  2021 README.md
-drwxr-xr-x  4 pet22a  staff    128  5 Oct  2021 src
-pet22a@SERPENTINE-HF portal-core % pwd
-/Users/pet22a/eclipse-workspace/portal-core
-pet22a@SERPENTINE-HF portal-core % ls -lt ~/AuScope/portal-core-ui-app/projects/portal-core-ui/src/lib/service/wms/get-caps.service.ts
-ls: /Users/pet22a/AuScope/portal-core-ui-app/projects/portal-core-ui/src/lib/service/wms/get-caps.service.ts: No such file or directory
-pet22a@SERPENTINE-HF portal-core % 
-pet22a@SERPENTINE-HF portal-core % pwd
-/Users/pet22a/eclipse-workspace/portal-core
-pet22a@SERPENTINE-HF portal-core % pwd
-/Users/pet22a/eclipse-workspace/portal-core
-pet22a@SERPENTINE-HF portal-core % cd ..
-pet22a@SERPENTINE-HF eclipse-workspace % cd ..
-pet22a@SERPENTINE-HF ~ % pwd
-/Users/pet22a
-pet22a@SERPENTINE-HF ~ % ls
-Applications				Downloads				Untitled.ipynb				lena
-AuScope					Edge_Detection.ipynb			demo_notebooks				pipeline-fracture
-Automatic-Fracture-Detection-Code	Library					eclipse-workspace			pyAFDC
-Bingie_Bingie_area1			Movies					example.py				pyAFDC.ipynb
-Bingie_Bingie_area1_small		Music					flask_project				pyJupyter
-Bingie_Bingie_area2			Pictures				get-pip.py				python_to_c
-DJI_0003A				Postman					ipython-in-depth
-Desktop					Public					jnb.config
-Documents				PyCoShREM				knownlayers.json
-pet22a@SERPENTINE-HF ~ % mkdir wheatHub
-pet22a@SERPENTINE-HF ~ % cd w*
-pet22a@SERPENTINE-HF wheatHub % pwd
-/Users/pet22a/wheatHub
-pet22a@SERPENTINE-HF wheatHub % cudnn
-zsh: command not found: cudnn
-pet22a@SERPENTINE-HF wheatHub % pwd
-/Users/pet22a/wheatHub
-pet22a@SERPENTINE-HF wheatHub % ls -lt
-total 72
--rw-r--r--@ 1 pet22a  staff  14420 10 May 10:52 process_imagery.py
--rw-r--r--@ 1 pet22a  staff   1303 10 May 10:52 exifgeotags.py
--rw-r--r--@ 1 pet22a  staff   6810 10 May 10:51 dpp_main.py
--rw-r--r--@ 1 pet22a  staff   2138 10 May 10:51 cover_and_cv.py
--rw-r--r--@ 1 pet22a  staff   2509 10 May 10:50 calculate_canopy_height.py
-pet22a@SERPENTINE-HF wheatHub % vi process_imagery.py
-pet22a@SERPENTINE-HF wheatHub % vi    
-pet22a@SERPENTINE-HF wheatHub % vi exifgeotags.py
-pet22a@SERPENTINE-HF wheatHub % vi dpp_main.py
-pet22a@SERPENTINE-HF wheatHub % vi cover_and_cv.py
-pet22a@SERPENTINE-HF wheatHub % vi calculate_canopy_height.py
-
 """This module outputs a csv filled with canopy heights for each plot. It requires a plot shapefile, DSM and DTM"""
 
 import rasterio as rio
+from rasterio import windows
 from rasterio.warp import calculate_default_transform, reproject
 from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from shapely.geometry import box
 import numpy as np
-from rasterstats import zonal_stats
-import pandas as pd
-import geopandas as gpd
+from zonal import get_plot_labels, plot_windows, read_plots
 from shapely import speedups
 speedups.disable()
 
 
 # calculates canopy height using the 99th percentile of CHM values
 # CHM = DSM - DTM
-def get_canopy_height(plots, dsm, dtm, csv_outpath, method='percentile_99'):
+def get_canopy_height(plots, dsm, dtm, csv_outpath, method='percentile_99', block_size=None, chm_outpath=None,
+                      label_cache_dir=None):
+    """Writes the canopy height of every plot to csv_outpath
+
+    By default the whole DSM and DTM are read into memory. Pass block_size (e.g. 1024) to walk the
+    DSM in block_size x block_size windows instead, so memory is bounded by the block rather than
+    the site. chm_outpath optionally writes the CHM as a tiled GeoTIFF. label_cache_dir optionally
+    keeps the rasterised plots between runs (see zonal.get_plot_labels).
+    """
+    if block_size is not None:
+        return get_canopy_height_windowed(plots, dsm, dtm, csv_outpath, method, block_size, chm_outpath,
+                                          label_cache_dir)
+
     with rio.open(dsm) as src:
-        out_meta = src.meta.copy()
         dst_crs = src.crs
         # get the transform, width and height from the DSM
         new_transform, new_width, new_height = calculate_default_transform(
@@ -114,16 +36,6 @@ def get_canopy_height(plots, dsm, dtm, csv_outpath, method='percentile_99'):
         hold_src = src.read(1)
 
     with rio.open(dtm) as src:
-        transform, width, height = calculate_default_transform(
-            src.crs, dst_crs, src.width, src.height, *src.bounds)
-        kwargs = src.meta.copy()
-        kwargs.update({
-            'crs': dst_crs,
-            'transform': new_transform,
-            'width': new_width,
-            'height': new_height,
-        })
-
         # set the shape of the destination numpy array
         dst_shape = (new_height, new_width)
         # initialise a numpy array of zeros with shape: dst_shape
@@ -146,15 +58,113 @@ def get_canopy_height(plots, dsm, dtm, csv_outpath, method='percentile_99'):
         canopy_height[canopy_height >= 32767] = 0.0
         canopy_height[canopy_height <= -32767] = 0.0
 
-    gdf = gpd.read_file(plots)
-    gdf['canopy_height'] = pd.DataFrame(zonal_stats(
-        vectors=gdf['geometry'],
-        raster=canopy_height,
-        affine=new_transform,
-        stats=method)
-    )
+    if chm_outpath is not None:
+        with rio.open(chm_outpath, 'w', **chm_profile(dst_crs, new_transform, new_width, new_height)) as dst:
+            dst.write(canopy_height.astype(np.float32), 1)
+
+    gdf = read_plots(plots)
+    plot_labels = get_plot_labels(plots, new_transform, canopy_height.shape, gdf['geometry'], label_cache_dir)
+    # -999 is the nodata value rasterstats assumed for the CHM array
+    gdf['canopy_height'] = plot_labels.zonal_stats(canopy_height, [method], nodata=-999)[method]
     gdf = gdf.set_index('Plot_ID')
     gdf = gdf[['Row', 'Range', 'canopy_height']]
     gdf.to_csv(csv_outpath)
     # if joining both tables in main script - return should be used.
     # return gdf
+
+
+def chm_profile(crs, transform, width, height, block=256):
+    """GeoTIFF profile for a tiled, compressed float32 CHM"""
+    return {
+        'driver': 'GTiff', 'dtype': 'float32', 'count': 1, 'nodata': None,
+        'crs': crs, 'transform': transform, 'width': width, 'height': height,
+        'tiled': True, 'blockxsize': block, 'blockysize': block,
+        'compress': 'deflate', 'predictor': 3, 'BIGTIFF': 'IF_SAFER',
+    }
+
+
+def block_windows(window, block_size):
+    """Row-major windows of at most block_size x block_size covering window"""
+    row_stop, col_stop = window.row_off + window.height, window.col_off + window.width
+    for row_off in range(window.row_off, row_stop, block_size):
+        for col_off in range(window.col_off, col_stop, block_size):
+            yield windows.Window(col_off, row_off, min(block_size, col_stop - col_off),
+                                 min(block_size, row_stop - row_off))
+
+
+def dtm_on_dsm_grid(src, dst_crs, dst_transform, dst_width, dst_height):
+    """The DTM warped onto the DSM grid, as the reproject call of get_canopy_height
+
+    Windows read from it match the same window of the full reprojection: nearest neighbour, the
+    DTM nodata value passed through unchanged and 0 outside the DTM. The one exception is a DSM
+    pixel centre lying exactly on a DTM pixel edge, which GDAL may round to either neighbouring
+    DTM pixel depending on the window it is read in.
+    """
+    return WarpedVRT(src, crs=dst_crs, transform=dst_transform, width=dst_width, height=dst_height,
+                     src_nodata=None, nodata=None, resampling=Resampling.nearest, dtype='float32')
+
+
+def get_canopy_height_windowed(plots, dsm, dtm, csv_outpath, method='percentile_99', block_size=1024,
+                               chm_outpath=None, label_cache_dir=None):
+    """get_canopy_height one DSM window at a time
+
+    Only the CHM values that fall inside a plot (pixel centre within the polygon, as in
+    rasterstats) are kept between windows. The DTM is read through a warped VRT on the DSM grid
+    (see dtm_on_dsm_grid), so the CHM matches the full-raster path; means and other sums can
+    differ by float32 rounding as the values are reduced in a different order. Unless the CHM is
+    written, only the windows around the plots are read. Plots are rasterized as in the full-raster
+    path (see zonal.PlotLabels), where plots overlap a pixel is counted for each of them.
+    """
+    gdf = read_plots(plots)
+    # CHM values inside a plot and the plot (position in gdf) each belongs to
+    plot_values, value_plots = [], []
+
+    with rio.open(dsm) as dsm_src, rio.open(dtm) as dtm_src:
+        dst_crs = dsm_src.crs
+        # get the transform, width and height from the DSM
+        new_transform, new_width, new_height = calculate_default_transform(
+            dsm_src.crs, dst_crs, dsm_src.width, dsm_src.height, *dsm_src.bounds)
+
+        dst_shape = (new_height, new_width)
+        plot_labels = get_plot_labels(plots, new_transform, dst_shape, gdf['geometry'], label_cache_dir)
+        dtm_vrt = dtm_on_dsm_grid(dtm_src, dst_crs, new_transform, new_width, new_height)
+
+        chm_dst = None
+        if chm_outpath is not None:
+            chm_dst = rio.open(chm_outpath, 'w', **chm_profile(dst_crs, new_transform, new_width, new_height))
+            # the CHM covers the whole DSM, plots are looked up per block
+            blocks = [(block, None) for block in block_windows(windows.Window(0, 0, new_width, new_height), block_size)]
+        else:
+            # only the blocks of the windows around the plots are needed
+            blocks = [(block, members)
+                      for window, members in plot_windows(gdf['geometry'], new_transform, dst_shape)
+                      for block in block_windows(window, block_size)]
+        try:
+            for window, members in blocks:
+                canopy_height = dsm_src.read(1, window=window) - dtm_vrt.read(1, window=window)
+                canopy_height[canopy_height >= 32767] = 0.0
+                canopy_height[canopy_height <= -32767] = 0.0
+                if chm_dst is not None:
+                    chm_dst.write(canopy_height.astype(np.float32), 1, window=window)
+
+                if members is None:
+                    members = gdf.sindex.query(box(*windows.bounds(window, new_transform)))
+                if len(members) == 0:
+                    continue
+                values, value_plot = plot_labels.values(canopy_height, window, members)
+                plot_values.append(values)
+                value_plots.append(value_plot)
+        finally:
+            dtm_vrt.close()
+            if chm_dst is not None:
+                chm_dst.close()
+
+    if plot_values:
+        plot_values, value_plots = np.concatenate(plot_values), np.concatenate(value_plots)
+    else:
+        plot_values, value_plots = np.empty(0, np.float32), np.empty(0, np.int64)
+    # -999 is the nodata value rasterstats assumed for the CHM array
+    gdf['canopy_height'] = plot_labels.reduce(plot_values, value_plots, [method], nodata=-999)[method]
+    gdf = gdf.set_index('Plot_ID')
+    gdf = gdf[['Row', 'Range', 'canopy_height']]
+    gdf.to_csv(csv_outpath)
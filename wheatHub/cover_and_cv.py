@@ -4,57 +4,63 @@
 import rasterio
 import cv2
 import numpy as np
-from rasterstats import zonal_stats
-import pandas as pd
-import geopandas as gpd
+from zonal import get_plot_labels, pad_window, plot_windows, read_plots
 from shapely import speedups
 speedups.disable()
 
 
-def calculate_cover_and_cv(predictions, plot_shp, csv_outpath, probability=0.98, window_size=21):
+def canopy_density(canopy, window_size):
+    """Number of canopy pixels in the window_size x window_size neighbourhood of every pixel
+
+    canopy is a 0/1 uint8 mask. A box filter (running sums) costs the same for any window size,
+    where a dense kernel costs window_size ** 2 per pixel. The sums are exact integers in float32,
+    the border is reflected (BORDER_REFLECT_101) as cv2.filter2D did
+    """
+    return cv2.boxFilter(canopy, cv2.CV_32F, (window_size, window_size), normalize=False,
+                         borderType=cv2.BORDER_REFLECT_101)
+
+
+def calculate_cover_and_cv(predictions, plot_shp, csv_outpath, probability=0.98, window_size=21, label_cache_dir=None):
+    # read in plots and rasterise them once for all the zonal stats
+    gdf = read_plots(plot_shp)
+    # the kernel reaches this far past the plots
+    halo = window_size // 2
+    filtered_values, masked_values, array_values, value_plots = [], [], [], []
+
     # open raster and set nodata value to -9999
     with rasterio.open(predictions, 'r+') as src:
-        array = src.read(1)
         affine = src.transform
         src.nodata = 0
+        plot_labels = get_plot_labels(plot_shp, affine, src.shape, gdf['geometry'], label_cache_dir)
 
-    # set threshold and mask out cells with values below probability value
-    # cells with a 'probability of below the set probability (default=0.98), will be filtered out and not included in canopy cover calc
-    array_masked = np.ma.masked_less(array, probability)
-    array_masked = np.ma.filled(array_masked, fill_value=0)
-    array_rounded = np.rint(array_masked)
-    kernel = np.ones((window_size, window_size))
-    filtered = cv2.filter2D(array_rounded, -1, kernel)
-
-    # read in plots to perform zonal stats with
-    gdf = gpd.read_file(plot_shp)
+        # only the windows around the plots (plus the kernel halo) are read, filtered and reduced
+        for window, members in plot_windows(gdf['geometry'], affine, src.shape, halo):
+            padded = pad_window(window, halo, src.shape)
+            array = src.read(1, window=padded)
 
-    gdf[['mean', 'std']] = pd.DataFrame(zonal_stats(
-        vectors=gdf['geometry'],
-        raster=filtered,
-        affine=affine,
-        stats=['mean', 'std'],
-        nodata=0
-    )
-    )[['mean', 'std']]
+            # set threshold and mask out cells with values below probability value
+            # cells with a 'probability of below the set probability (default=0.98), will be filtered out and not included in canopy cover calc
+            array_masked = np.ma.masked_less(array, probability)
+            array_masked = np.ma.filled(array_masked, fill_value=0)
+            array_rounded = np.rint(array_masked).astype(np.uint8)
+            filtered = canopy_density(array_rounded, window_size)
 
-    gdf['canopy_count'] = pd.DataFrame(zonal_stats(
-        vectors=gdf['geometry'],
-        raster=array_masked,
-        affine=affine,
-        stats=['count'],
-        nodata=0
-    )
-    )['count']
+            for data, collected in ((filtered, filtered_values), (array_masked, masked_values), (array, array_values)):
+                values, plots = plot_labels.values(data, padded, members)
+                collected.append(values)
+            value_plots.append(plots)
 
-    gdf['total_count'] = pd.DataFrame(zonal_stats(
-        vectors=gdf['geometry'],
-        raster=array,
-        affine=affine,
-        stats=['count'],
-        nodata=0
-    )
-    )['count']
+    if value_plots:
+        filtered_values, masked_values, array_values, value_plots = map(
+            np.concatenate, (filtered_values, masked_values, array_values, value_plots))
+    else:
+        filtered_values = masked_values = array_values = np.empty(0, np.float32)
+        value_plots = np.empty(0, np.int64)
+    filtered_stats = plot_labels.reduce(filtered_values, value_plots, ['mean', 'std'], nodata=0)
+    gdf['mean'] = filtered_stats['mean']
+    gdf['std'] = filtered_stats['std']
+    gdf['canopy_count'] = plot_labels.reduce(masked_values, value_plots, ['count'], nodata=0)['count']
+    gdf['total_count'] = plot_labels.reduce(array_values, value_plots, ['count'], nodata=0)['count']
 
     gdf = gdf.set_index('Plot_ID')
     gdf['canopy_cover'] = gdf['canopy_count'] / gdf['total_count']
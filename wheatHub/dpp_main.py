@@ -1,103 +1,45 @@
-Last login: Tue Mar 22 16:33:58 on ttys009
-pet22a@SERPENTINE-HF portal-core-ui-app % pwd
-/Users/pet22a/AuScope/portal-core-ui-app
-pet22a@SERPENTINE-HF portal-core-ui-app % cd ../..
-pet22a@SERPENTINE-HF ~ % ls
-Applications				Downloads				Untitled.ipynb				lena
-AuScope					Edge_Detection.ipynb			demo_notebooks				pipeline-fracture
-Automatic-Fracture-Detection-Code	Library					eclipse-workspace			pyAFDC
-Bingie_Bingie_area1			Movies					example.py				pyAFDC.ipynb
-Bingie_Bingie_area1_small		Music					flask_project				pyJupyter
-Bingie_Bingie_area2			Pictures				get-pip.py				python_to_c
-DJI_0003A				Postman					ipython-in-depth
-Desktop					Public					jnb.config
-Documents				PyCoShREM				knownlayers.json
-pet22a@SERPENTINE-HF ~ % cd ecl*
-pet22a@SERPENTINE-HF eclipse-workspace % ls
-RemoteSystemsTempFiles			auscope-portal-api copy 10FEB2022	portal-core copy 10FEB2022
-auscope-portal-api			portal-core
-pet22a@SERPENTINE-HF eclipse-workspace % cd portal-core
-pet22a@SERPENTINE-HF portal-core % ls
-COPYING				README.md			checkstyle.xml			pom.xml				target
-COPYING.LESSER			azure-pipelines.yml		eclipse-format-java-modest.xml	src
-pet22a@SERPENTINE-HF portal-core % git config --get remote.origin.url
-https://github.com/chrisvpeters/portal-core.git
-pet22a@SERPENTINE-HF portal-core % 
-pet22a@SERPENTINE-HF portal-core % 
-pet22a@SERPENTINE-HF portal-core % 
-pet22a@SERPENTINE-HF portal-core % ls -lt ~/AuScope/portal-core-ui-app/projects/portal-core-ui/src/lib/service/wms/get-caps.service.ts
-ls: /Users/pet22a/AuScope/portal-core-ui-app/projects/portal-core-ui/src/lib/service/wms/get-caps.service.ts: No such file or directory
-pet22a@SERPENTINE-HF portal-core % pwd
-/Users/pet22a/eclipse-workspace/portal-core
-pet22a@SERPENTINE-HF portal-core % ls
-COPYING				README.md			checkstyle.xml			pom.xml				target
-COPYING.LESSER			azure-pipelines.yml		eclipse-format-java-modest.xml	src
-pet22a@SERPENTINE-HF portal-core % ls -lt
-total 216
--rw-r--r--  1 pet22a  staff  16597 18 Feb 14:36 pom.xml
--rw-r--r--  1 pet22a  staff   1113 18 Feb 14:36 azure-pipelines.yml
-drwxr-xr-x  4 pet22a  staff    128  5 Oct  2021 target
--rw-r--r--  1 pet22a  staff   3891  5 Oct  2021 checkstyle.xml
--rw-r--r--  1 pet22a  staff  35147  5 Oct  2021 COPYING
--rw-r--r--  1 pet22a  staff  30991  5 Oct  2021 eclipse-format-java-modest.xml
--rw-r--r--  1 pet22a  staff   7651  5 Oct  2021 COPYING.LESSER
--rw-r--r--  1 pet22a  staff    131  5 Oct  2021 README.md
-drwxr-xr-x  4 pet22a  staff    128  5 Oct  2021 src
-pet22a@SERPENTINE-HF portal-core % pwd
-/Users/pet22a/eclipse-workspace/portal-core
-pet22a@SERPENTINE-HF portal-core % ls -lt ~/AuScope/portal-core-ui-app/projects/portal-core-ui/src/lib/service/wms/get-caps.service.ts
-ls: /Users/pet22a/AuScope/portal-core-ui-app/projects/portal-core-ui/src/lib/service/wms/get-caps.service.ts: No such file or directory
-pet22a@SERPENTINE-HF portal-core % 
-pet22a@SERPENTINE-HF portal-core % pwd
-/Users/pet22a/eclipse-workspace/portal-core
-pet22a@SERPENTINE-HF portal-core % pwd
-/Users/pet22a/eclipse-workspace/portal-core
-pet22a@SERPENTINE-HF portal-core % cd ..
-pet22a@SERPENTINE-HF eclipse-workspace % cd ..
-pet22a@SERPENTINE-HF ~ % pwd
-/Users/pet22a
-pet22a@SERPENTINE-HF ~ % ls
-Applications				Downloads				Untitled.ipynb				lena
-AuScope					Edge_Detection.ipynb			demo_notebooks				pipeline-fracture
-Automatic-Fracture-Detection-Code	Library					eclipse-workspace			pyAFDC
-Bingie_Bingie_area1			Movies					example.py				pyAFDC.ipynb
-Bingie_Bingie_area1_small		Music					flask_project				pyJupyter
-Bingie_Bingie_area2			Pictures				get-pip.py				python_to_c
-DJI_0003A				Postman					ipython-in-depth
-Desktop					Public					jnb.config
-Documents				PyCoShREM				knownlayers.json
-pet22a@SERPENTINE-HF ~ % mkdir wheatHub
-pet22a@SERPENTINE-HF ~ % cd w*
-pet22a@SERPENTINE-HF wheatHub % pwd
-/Users/pet22a/wheatHub
-pet22a@SERPENTINE-HF wheatHub % cudnn
-zsh: command not found: cudnn
-pet22a@SERPENTINE-HF wheatHub % pwd
-/Users/pet22a/wheatHub
-pet22a@SERPENTINE-HF wheatHub % ls -lt
-total 72
--rw-r--r--@ 1 pet22a  staff  14420 10 May 10:52 process_imagery.py
--rw-r--r--@ 1 pet22a  staff   1303 10 May 10:52 exifgeotags.py
--rw-r--r--@ 1 pet22a  staff   6810 10 May 10:51 dpp_main.py
--rw-r--r--@ 1 pet22a  staff   2138 10 May 10:51 cover_and_cv.py
--rw-r--r--@ 1 pet22a  staff   2509 10 May 10:50 calculate_canopy_height.py
-pet22a@SERPENTINE-HF wheatHub % vi process_imagery.py
-pet22a@SERPENTINE-HF wheatHub % vi    
-pet22a@SERPENTINE-HF wheatHub % vi exifgeotags.py
-pet22a@SERPENTINE-HF wheatHub % vi dpp_main.py
-
 import argparse
 from process_imagery import process_existing, process_from_start
 from calculate_canopy_height import get_canopy_height
 from cover_and_cv import calculate_cover_and_cv
 from predictor import predict
+from tiled_predictor import predict_tiled
 import time
 import os
 import Metashape
 import sys
 
 
+def predict_canopy(input_tiff):
+    """Canopy predictions for an orthomosaic, returns the path of the predictions GeoTIFF
+
+    With --tiled_predict the --model is run through tiled_predictor.predict_tiled, which blends
+    overlapping tiles and, given --plot_file, skips tiles away from the plots
+    """
+    if args.tiled_predict:
+        # only needed for tiled prediction, the predictor module loads its own model
+        from tensorflow import keras
+        model = keras.models.load_model(args.model)
+        return predict_tiled(input_tiff, model,
+                             tile_height=args.tile_height,
+                             tile_width=args.tile_width,
+                             stride_height=args.stride_height,
+                             stride_width=args.stride_width,
+                             batch_size=args.batch_size,
+                             plot_shp=args.plot_file)
+    predict(input_tiff=input_tiff,
+            tile_height=args.tile_height,
+            tile_width=args.tile_width,
+            stride_height=args.stride_height,
+            stride_width=args.stride_width,
+            batch_size=args.batch_size
+            )
+    return input_tiff + "-predictions.tif"
+
+
 def main():
+    if args.tiled_predict and args.model is None:
+        am_parser.error('--tiled_predict requires a --model')
     if args.existing:
         process_existing(
             args.input,
@@ -130,22 +72,19 @@ def main():
 
             if args.canopy_height and (args.dtm is not None and args.plot_file is not None):
                 csv_outpath, extension = os.path.splitext(args.input)
+                chm_outpath = csv_outpath + "_CHM.tif" if args.write_chm else None
                 csv_outpath = csv_outpath + "_canopy_height.csv"
-                get_canopy_height(args.plot_file, args.dem, args.dtm, csv_outpath)
+                get_canopy_height(args.plot_file, args.dem, args.dtm, csv_outpath,
+                                  block_size=args.chm_block_size, chm_outpath=chm_outpath,
+                                  label_cache_dir=args.label_cache_dir)
             # else:
             # raise ValueError('DTM file or plot file is invalid or does not exist')
             if args.canopy_cover and args.plot_file is not None:
                 csv_outpath, extension = os.path.splitext(args.input)
                 csv_outpath = csv_outpath + "_canopy_cover.csv"
-                predict(input_tiff=args.input,
-                        tile_height=args.tile_height,
-                        tile_width=args.tile_width,
-                        stride_height=args.stride_height,
-                        stride_width=args.stride_width,
-                        batch_size=args.batch_size
-                        )
-                predictions_tif = args.input + "-predictions.tif"
-                calculate_cover_and_cv(predictions_tif, args.plot_file, csv_outpath)
+                predictions_tif = predict_canopy(args.input)
+                calculate_cover_and_cv(predictions_tif, args.plot_file, csv_outpath,
+                                       label_cache_dir=args.label_cache_dir)
 
     # gets here
 
@@ -160,21 +99,18 @@ def main():
             else:
                 dtm = name + "_DTM.tif"
             ch_csv_filename = name + "_Canopy_Height.csv"
-            get_canopy_height(args.plot_file, dem, dtm, ch_csv_filename)
+            chm_outpath = name + "_CHM.tif" if args.write_chm else None
+            get_canopy_height(args.plot_file, dem, dtm, ch_csv_filename,
+                              block_size=args.chm_block_size, chm_outpath=chm_outpath,
+                              label_cache_dir=args.label_cache_dir)
 
         if args.canopy_cover:
             ortho_path, extension = os.path.splitext(args.output)
             ortho_name = ortho_path + "_orthomosaic.tif"
-            predict(input_tiff=ortho_name,
-                    tile_height=args.tile_height,
-                    tile_width=args.tile_width,
-                    stride_height=args.stride_height,
-                    stride_width=args.stride_width,
-                    batch_size=args.batch_size
-                    )
-            predictions_name = ortho_name + "-predictions.tif"
+            predictions_name = predict_canopy(ortho_name)
             predictions_csv = ortho_path + "_canopy_cover.csv"
-            calculate_cover_and_cv(predictions_name, args.plot_file, predictions_csv)
+            calculate_cover_and_cv(predictions_name, args.plot_file, predictions_csv,
+                                   label_cache_dir=args.label_cache_dir)
 
     print('processing completed')
 
@@ -230,6 +166,19 @@ if __name__ == "__main__":
         '--plot_file', type=str, help='shapefile for plot statistics', default=None
     )
 
+    am_parser.add_argument(
+        '--chm_block_size', type=int, help='compute canopy height in windows of this size to bound memory use',
+        default=None
+    )
+
+    am_parser.add_argument(
+        '--write_chm', action='store_true', help='also write the canopy height model as a tiled GeoTIFF'
+    )
+
+    am_parser.add_argument(
+        '--label_cache_dir', type=str, help='folder to keep the rasterised plots in between runs', default=None
+    )
+
     am_parser.add_argument(
         '--downscale', type=int, help='Downscale factor', default=4
     )
@@ -265,6 +214,13 @@ if __name__ == "__main__":
     am_parser.add_argument(
         "--batch_size", type=int, help="prediction batch sizes.", default=8,
     )
+    am_parser.add_argument(
+        "--tiled_predict", action='store_true',
+        help="predict with tiled_predictor: blended tiles, skipping tiles away from --plot_file",
+    )
+    am_parser.add_argument(
+        "--model", type=str, help="Keras model for --tiled_predict", default=None,
+    )
     """
     am_parse.add_argument(
         '--filtering', type=MetashapeObject, help='Filtering mode to use'
@@ -1,3 +1,8 @@
+import io
+import re
+import struct
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from PIL.ExifTags import TAGS, GPSTAGS
 
@@ -47,8 +52,213 @@ def get_coordinates(geotags):
 
 
 def get_longitude(img_to_get_exif):
-    exif = get_exif(img_to_get_exif)
-    geotags = get_geotagging(exif)
-    lat, long = get_coordinates(geotags)
+    long = read_exif_header(img_to_get_exif)['lon']
+    if long is None:
+        raise ValueError("No EXIF geotagging found")
 
     return long
+
+
+# EXIF tag ids
+GPS_IFD = 0x8825
+EXIF_IFD = 0x8769
+MODEL = 0x0110
+DATETIME = 0x0132
+XMP = 0x02BC
+DATETIME_ORIGINAL = 0x9003
+# GPS IFD tag ids
+GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE, GPS_ALTITUDE_REF, GPS_ALTITUDE = 1, 2, 3, 4, 5, 6
+
+# bytes per value of each TIFF field type
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+# longest tag value read, anything longer (e.g. thumbnails, maker notes) is skipped
+MAX_VALUE_BYTES = 1 << 16
+# a JPEG APP1 segment is at most 64KB, stop looking for it after this many segments
+MAX_JPEG_SEGMENTS = 64
+EXIF_HEADER = b'Exif\x00\x00'
+XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+# DJI altitudes in the XMP packet, as attributes or as elements
+DJI_XMP_PATTERN = re.compile(
+    rb'drone-dji:(AbsoluteAltitude|RelativeAltitude)\s*(?:=\s*"([^"]*)"|>([^<]*)<)')
+
+COORDINATE_DTYPE = np.dtype([('lat', 'f8'), ('lon', 'f8'), ('alt', 'f8'), ('rel_alt', 'f8'),
+                             ('time', 'datetime64[s]')])
+
+
+def _dms_to_decimal(dms, ref):
+    decimal = float(dms[0]) + float(dms[1]) / 60.0 + float(dms[2]) / 3600.0
+    return -decimal if ref in ['S', 'W'] else decimal
+
+
+class _TiffReader:
+    """Reads single IFD entries of a TIFF structure from a file, seeking to each one
+
+    Offsets in the TIFF structure are relative to base (0 for TIFF files, the start of the
+    EXIF payload for JPEG APP1 segments)
+    """
+
+    def __init__(self, f, base=0):
+        self.f = f
+        self.base = base
+        f.seek(base)
+        header = f.read(8)
+        if header[:2] == b'II':
+            self.endian = '<'
+        elif header[:2] == b'MM':
+            self.endian = '>'
+        else:
+            raise ValueError('Not a TIFF structure')
+        magic, self.first_ifd = struct.unpack(self.endian + 'HI', header[2:8])
+        if magic != 42:
+            raise ValueError('Not a TIFF structure')
+
+    def _read(self, offset, size):
+        self.f.seek(self.base + offset)
+        data = self.f.read(size)
+        if len(data) != size:
+            raise ValueError('Truncated TIFF structure')
+        return data
+
+    def read_ifd(self, offset, tags):
+        """Values of the wanted tags in the IFD at offset, other entries are not decoded"""
+        count, = struct.unpack(self.endian + 'H', self._read(offset, 2))
+        entries = self._read(offset + 2, 12 * count)
+        values = {}
+        for i in range(count):
+            tag, field_type, num = struct.unpack(self.endian + 'HHI', entries[12 * i:12 * i + 8])
+            if tag not in tags or field_type not in TIFF_TYPE_SIZES:
+                continue
+            size = TIFF_TYPE_SIZES[field_type] * num
+            if size > MAX_VALUE_BYTES:
+                continue
+            if size <= 4:
+                data = entries[12 * i + 8:12 * i + 8 + size]
+            else:
+                data = self._read(struct.unpack(self.endian + 'I', entries[12 * i + 8:12 * i + 12])[0], size)
+            values[tag] = self._decode(field_type, num, data)
+        return values
+
+    def _decode(self, field_type, num, data):
+        if field_type == 2:
+            return data.split(b'\x00', 1)[0].decode('ascii', 'replace').strip()
+        if field_type in (1, 6, 7):
+            return data
+        if field_type in (5, 10):
+            parts = struct.unpack(self.endian + ('I' if field_type == 5 else 'i') * (2 * num), data)
+            return [numerator / denominator if denominator else float('nan')
+                    for numerator, denominator in zip(parts[::2], parts[1::2])]
+        formats = {3: 'H', 4: 'I', 8: 'h', 9: 'i', 11: 'f', 12: 'd', 13: 'I'}
+        return list(struct.unpack(self.endian + formats[field_type] * num, data))
+
+
+def _read_jpeg_segments(f):
+    """EXIF (TIFF structure) and XMP payloads of a JPEG, reading only the segment headers and APP1s"""
+    exif, xmp = None, None
+    for _ in range(MAX_JPEG_SEGMENTS):
+        marker = f.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            break
+        # start of scan, the image data follows and no more metadata can
+        if marker[1] == 0xDA:
+            break
+        length, = struct.unpack('>H', marker[2:4])
+        if marker[1] == 0xE1 and (exif is None or xmp is None):
+            payload = f.read(length - 2)
+            if payload.startswith(EXIF_HEADER):
+                exif = payload[len(EXIF_HEADER):]
+            elif payload.startswith(XMP_HEADER):
+                xmp = payload[len(XMP_HEADER):]
+        else:
+            f.seek(length - 2, 1)
+        if exif is not None and xmp is not None:
+            break
+    return exif, xmp
+
+
+def read_exif_header(filename):
+    """GPS position, altitudes, capture time and camera model of a JPEG or TIFF image
+
+    Only the metadata is read: the JPEG segment headers and APP1 segments, or the needed TIFF IFDs
+    of a TIFF. GPSInfo is looked up directly rather than through the PIL tag tables. Altitudes
+    from DJI's XMP (drone-dji:AbsoluteAltitude and RelativeAltitude) are used when present.
+
+    Returns:
+        (dict): lat, lon (decimal degrees), alt, rel_alt (metres, rel_alt above the take off
+            point), time (EXIF 'YYYY:MM:DD HH:MM:SS') and model, None where missing
+    """
+    tags = {'lat': None, 'lon': None, 'alt': None, 'rel_alt': None, 'time': None, 'model': None}
+    with open(filename, 'rb') as f:
+        start = f.read(2)
+        if start == b'\xff\xd8':
+            exif, xmp = _read_jpeg_segments(f)
+            reader = _TiffReader(io.BytesIO(exif)) if exif else None
+        elif start in (b'II', b'MM'):
+            reader, xmp = _TiffReader(f), None
+        else:
+            raise ValueError('{} is not a JPEG or TIFF image'.format(filename))
+
+        if reader is not None:
+            ifd0 = reader.read_ifd(reader.first_ifd, {MODEL, DATETIME, EXIF_IFD, GPS_IFD, XMP})
+            tags['model'] = ifd0.get(MODEL)
+            tags['time'] = ifd0.get(DATETIME)
+            if EXIF_IFD in ifd0:
+                time = reader.read_ifd(ifd0[EXIF_IFD][0], {DATETIME_ORIGINAL}).get(DATETIME_ORIGINAL)
+                tags['time'] = time or tags['time']
+            if GPS_IFD in ifd0:
+                gps = reader.read_ifd(ifd0[GPS_IFD][0], {GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF,
+                                                         GPS_LONGITUDE, GPS_ALTITUDE_REF, GPS_ALTITUDE})
+                if len(gps.get(GPS_LATITUDE, ())) == 3 and len(gps.get(GPS_LONGITUDE, ())) == 3:
+                    tags['lat'] = _dms_to_decimal(gps[GPS_LATITUDE], gps.get(GPS_LATITUDE_REF))
+                    tags['lon'] = _dms_to_decimal(gps[GPS_LONGITUDE], gps.get(GPS_LONGITUDE_REF))
+                if GPS_ALTITUDE in gps:
+                    # altitude ref 1 is below sea level
+                    below = gps.get(GPS_ALTITUDE_REF, b'\x00')[:1] == b'\x01'
+                    tags['alt'] = -gps[GPS_ALTITUDE][0] if below else gps[GPS_ALTITUDE][0]
+            if xmp is None and XMP in ifd0:
+                xmp = ifd0[XMP]
+
+    if xmp:
+        for name, attribute, element in DJI_XMP_PATTERN.findall(xmp):
+            try:
+                value = float(attribute or element)
+            except ValueError:
+                continue
+            if name == b'RelativeAltitude':
+                tags['rel_alt'] = value
+            elif tags['alt'] is None:
+                tags['alt'] = value
+    return tags
+
+
+def _exif_time(time):
+    # EXIF times are 'YYYY:MM:DD HH:MM:SS'
+    try:
+        return np.datetime64(time[:10].replace(':', '-') + 'T' + time[11:19], 's')
+    except (TypeError, ValueError):
+        return np.datetime64('NaT', 's')
+
+
+def _coordinates_row(filename):
+    try:
+        tags = read_exif_header(filename)
+    except (OSError, ValueError, struct.error):
+        return (np.nan, np.nan, np.nan, np.nan, np.datetime64('NaT', 's'))
+    return tuple(np.nan if tags[key] is None else tags[key] for key in ('lat', 'lon', 'alt', 'rel_alt')) + (
+        _exif_time(tags['time']),)
+
+
+def get_coordinates_many(paths, workers=8):
+    """Geotags of many images, read on a thread pool
+
+    Args:
+        paths (list of str): JPEG or TIFF images
+        workers (int): Number of threads
+
+    Returns:
+        (numpy ndarray): Structured array (COORDINATE_DTYPE) with lat, lon, alt, rel_alt and time
+            per image, NaN/NaT where a tag is missing or the image could not be read
+    """
+    paths = list(paths)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        rows = list(executor.map(_coordinates_row, paths))
+    return np.array(rows, dtype=COORDINATE_DTYPE)
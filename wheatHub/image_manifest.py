@@ -0,0 +1,154 @@
+"""This module keeps a manifest of the images of a flight together with their EXIF geotags"""
+"""The photo folder is walked once and the EXIF headers of all images are read in a thread pool
+(metadata only, see exifgeotags.read_exif_header). The result is cached in a sidecar file in the
+folder, and only new or modified images are read again. Image listing, UTM zone selection and
+spatial subsetting then all reuse the manifest."""
+
+import os
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from exifgeotags import read_exif_header
+
+MANIFEST_FILENAME = '.image_manifest.json'
+MANIFEST_VERSION = 2
+RGB_EXTENSIONS = ('.jpg', '.jpeg')
+MULTISPEC_EXTENSIONS = ('.tif', '.tiff')
+IMAGE_EXTENSIONS = RGB_EXTENSIONS + MULTISPEC_EXTENSIONS
+TAG_FIELDS = ('lat', 'lon', 'alt', 'rel_alt', 'time', 'model')
+
+
+def find_images(folder, extensions=IMAGE_EXTENSIONS):
+    """Paths of the images under folder (recursively), sorted, matched on the (case insensitive) extension"""
+    image_list = list()
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for filename in sorted(files):
+            if os.path.splitext(filename)[1].lower() in extensions:
+                image_list.append(os.path.join(root, filename))
+    return image_list
+
+
+def _read_tags(path):
+    try:
+        return read_exif_header(path)
+    except Exception:
+        # an unreadable or untagged image should not stop the whole flight from being indexed
+        return dict.fromkeys(TAG_FIELDS)
+
+
+def utm_zone(longitude):
+    """Australian UTM/MGA zone (49 to 56) of a longitude, as used for the exports"""
+    if not np.isfinite(longitude) or longitude >= 156.0:
+        raise ValueError('Invalid image geotags.')
+    return max(49, int(longitude // 6) + 31)
+
+
+class ImageManifest:
+    """Images of a flight with their GPS position, altitudes, capture time and camera model"""
+
+    def __init__(self, folder, records):
+        self.folder = folder
+        # one dict per image: path (relative to folder), size, mtime_ns and the TAG_FIELDS
+        self.records = records
+
+    @classmethod
+    def load(cls, folder, workers=8, write=True):
+        """Walks folder and reads the EXIF of every image not in the sidecar file (or changed since)
+
+        Args:
+            folder (str): Photo folder
+            workers (int): Threads reading EXIF headers
+            write (bool): Write the sidecar file. Failing to write it (e.g. a read-only folder)
+                is not an error
+
+        Returns:
+            (ImageManifest)
+        """
+        cached = {}
+        manifest_path = os.path.join(folder, MANIFEST_FILENAME)
+        try:
+            with open(manifest_path) as json_file:
+                data = json.load(json_file)
+            if data.get('version') == MANIFEST_VERSION:
+                cached = {record['path']: record for record in data['images']}
+        except (OSError, ValueError, KeyError):
+            pass
+
+        records, to_read = [], []
+        for path in find_images(folder):
+            stat = os.stat(path)
+            relative_path = os.path.relpath(path, folder)
+            record = cached.get(relative_path)
+            if record is None or record['size'] != stat.st_size or record['mtime_ns'] != stat.st_mtime_ns:
+                record = {'path': relative_path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+                to_read.append(record)
+            records.append(record)
+
+        if to_read:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                paths = [os.path.join(folder, record['path']) for record in to_read]
+                for record, tags in zip(to_read, executor.map(_read_tags, paths)):
+                    record.update(tags)
+
+        manifest = cls(folder, records)
+        if write and (to_read or len(records) != len(cached)):
+            try:
+                manifest.save()
+            except OSError:
+                pass
+        return manifest
+
+    def save(self):
+        """Writes the sidecar file, atomically so that readers never see a partial file"""
+        manifest_path = os.path.join(self.folder, MANIFEST_FILENAME)
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w') as json_file:
+            json.dump({'version': MANIFEST_VERSION, 'images': self.records}, json_file)
+        os.replace(tmp_path, manifest_path)
+
+    def __len__(self):
+        return len(self.records)
+
+    def paths(self, extensions=IMAGE_EXTENSIONS):
+        """Absolute paths of the images with the given extensions"""
+        return [os.path.join(self.folder, record['path']) for record in self.records
+                if os.path.splitext(record['path'])[1].lower() in extensions]
+
+    def geotagged(self, extensions=IMAGE_EXTENSIONS):
+        """Records of the images with a GPS position"""
+        return [record for record in self.records
+                if record.get('lat') is not None and record.get('lon') is not None and
+                os.path.splitext(record['path'])[1].lower() in extensions]
+
+    def coordinates(self, extensions=IMAGE_EXTENSIONS):
+        """N x 2 array of the (lat, lon) of the geotagged images"""
+        return np.array([(record['lat'], record['lon']) for record in self.geotagged(extensions)],
+                        dtype=np.float64).reshape(-1, 2)
+
+    def median_longitude(self, extensions=IMAGE_EXTENSIONS):
+        """Median longitude of the geotagged images, ignoring non-finite values"""
+        longitudes = self.coordinates(extensions)[:, 1]
+        longitudes = longitudes[np.isfinite(longitudes)]
+        if longitudes.size == 0:
+            raise ValueError('No EXIF geotagging found')
+        return float(np.median(longitudes))
+
+    def utm_zones(self, extensions=IMAGE_EXTENSIONS):
+        """Sorted UTM zones the images were taken in, more than one means the flight spans a zone boundary
+
+        Longitudes outside the Australian zones (or not finite) are ignored here, a bad median is
+        reported when the EPSG is chosen
+        """
+        longitudes = self.coordinates(extensions)[:, 1]
+        longitudes = longitudes[np.isfinite(longitudes) & (longitudes < 156.0)]
+        return sorted({utm_zone(longitude) for longitude in longitudes})
+
+    def within(self, west, south, east, north, extensions=IMAGE_EXTENSIONS):
+        """Absolute paths of the images taken inside a lon/lat bounding box"""
+        return [os.path.join(self.folder, record['path']) for record in self.geotagged(extensions)
+                if west <= record['lon'] <= east and south <= record['lat'] <= north]
+
+    def models(self):
+        """Camera models found in the flight"""
+        return sorted({record['model'] for record in self.records if record.get('model')})
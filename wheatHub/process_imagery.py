@@ -2,11 +2,13 @@
 
 import os
 import Metashape
-from exifgeotags import get_longitude
+from image_manifest import ImageManifest, RGB_EXTENSIONS, MULTISPEC_EXTENSIONS
 from pathlib import Path
 
 
 class MetaProcess:
+    # extensions of the photos added to the chunk
+    image_extensions = RGB_EXTENSIONS
 
     # option to use default parameters instead of kwargs
     # e.g. crs = None in function parameter
@@ -21,6 +23,7 @@ class MetaProcess:
         self.gcp_file = gcps
         # self.params = kwargs.get('params', None)
         self.root_dir = Path(self.img_input).parent
+        self.manifest = None
 
     def get_output_name(self):
         return self.output_psx
@@ -49,13 +52,14 @@ class MetaProcess:
 
         return self.chunk
 
+    def get_manifest(self):
+        # photo folder is walked and its EXIF read once, then reused by every step
+        if self.manifest is None:
+            self.manifest = ImageManifest.load(self.img_input)
+        return self.manifest
+
     def add_images(self):
-        path_photos = self.img_input
-        photo_list = list()
-        for r, d, f in os.walk(path_photos):
-            for photo in f:
-                    if ("jpg" or "jpeg" or "JPG" or "JPEG") in photo.lower():
-                    photo_list.append(os.path.join(path_photos, r, photo))
+        photo_list = self.get_manifest().paths(self.image_extensions)
         # print(photo_list)
         self.chunk.addPhotos(photo_list)
         self.doc.save()
@@ -158,7 +162,7 @@ class MetaProcess:
 
         self.chunk.exportReport(self.output_psx[:-4] + "_report.pdf",
                                 title=os.path.basename(self.output_psx)[:-4])
-      def optimise_cameras(self):
+    def optimise_cameras(self):
         count = 0
         for camera in self.chunk.cameras:
             camera.reference.enabled = False
@@ -201,17 +205,12 @@ class MetaProcess:
                 "zone_56": 28356
             }
 
-        path_photos = self.img_input
-        photo_list = list()
-        for r, d, f in os.walk(path_photos):
-            for photo in f:
-                if ("jpg" or "jpeg" or "JPG" or "JPEG") in photo.lower():
-                    photo_list.append(os.path.join(path_photos, r, photo))
-
-        img_exif_to_sample = photo_list[int(len(photo_list) / 2)]
-
-        img_long = get_longitude(img_exif_to_sample)
-
+        # median longitude of all the geotagged photos
+        manifest = self.get_manifest()
+        img_long = manifest.median_longitude(self.image_extensions)
+        zones = manifest.utm_zones(self.image_extensions)
+        if len(zones) > 1:
+            print('Photos span UTM zones {}, using the zone of the median longitude.'.format(zones))
 
         if img_long < 114.0:
             epsg = epsg_dict["zone_49"]
@@ -241,13 +240,10 @@ class MetaProcess:
 class MultispecProcess(MetaProcess):
     # child class of MetaProcess
     # does extra stuff for multispectral imagery
+    image_extensions = MULTISPEC_EXTENSIONS
+
     def add_images(self):
-        path_photos = self.img_input
-        photo_list = list()
-        for r, d, f in os.walk(path_photos):
-            for photo in f:
-                if ("tif" or "tiff" or "TIF" or "TIFF") in photo.lower():
-                    photo_list.append(os.path.join(path_photos, r, photo))
+        photo_list = self.get_manifest().paths(self.image_extensions)
 
         self.chunk.addPhotos(photo_list)
         # automatically calibrate reflectance after importing images
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.transform import from_origin
+from rasterio.warp import Resampling, calculate_default_transform, reproject
+
+from synthetic import CRS, ORIGIN, plot_geometries, terrain, write_plots, write_raster
+
+# the wheatHub modules import each other as top-level scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def site(tmp_path_factory):
+    """A synthetic DSM, DTMs at other resolutions, offsets and crs, and a plot shapefile"""
+    folder = tmp_path_factory.mktemp('site')
+    height, width, res = 700, 900, 0.05
+    rng = np.random.default_rng(0)
+    transform = from_origin(ORIGIN[0], ORIGIN[1], res, res)
+    rows, cols = np.mgrid[0:height, 0:width]
+    xs, ys = transform * (cols + 0.5, rows + 0.5)
+    dsm = terrain(xs, ys) + rng.random((height, width)) * 1.2
+    dsm[:5] = -32767
+    write_raster(str(folder / 'dsm.tif'), dsm, transform, CRS, -32767)
+
+    dtms = {}
+    # DTM resolutions and offsets from the DSM grid, the finer one splits DSM pixels
+    for name, dtm_res, dx, dy in [('dtm', 0.13, 0.02, -0.01), ('dtm_fine', 0.0371, 0.01234, -0.00771),
+                                  ('dtm_coarse', 0.1013, 0.731, -0.293)]:
+        dtm_transform = from_origin(ORIGIN[0] + dx, ORIGIN[1] + dy, dtm_res, dtm_res)
+        dtm_height, dtm_width = int(height * res / dtm_res), int(width * res / dtm_res)
+        rows, cols = np.mgrid[0:dtm_height, 0:dtm_width]
+        xs, ys = dtm_transform * (cols + 0.5, rows + 0.5)
+        dtm = terrain(xs, ys)
+        dtm[dtm_height // 2:dtm_height // 2 + 20, 10:40] = -32767
+        dtms[name] = str(folder / (name + '.tif'))
+        write_raster(dtms[name], dtm, dtm_transform, CRS, -32767)
+
+    # the first DTM again in geographic coordinates
+    with rio.open(dtms['dtm']) as src:
+        dst_transform, dst_width, dst_height = calculate_default_transform(
+            src.crs, 'EPSG:4326', src.width, src.height, *src.bounds)
+        dtm = np.zeros((dst_height, dst_width), np.float32)
+        reproject(src.read(1), dtm, src_transform=src.transform, src_crs=src.crs, dst_transform=dst_transform,
+                  dst_crs='EPSG:4326', resampling=Resampling.nearest)
+    dtms['dtm_4326'] = str(folder / 'dtm_4326.tif')
+    write_raster(dtms['dtm_4326'], dtm, dst_transform, 'EPSG:4326', -32767)
+
+    write_plots(str(folder / 'plots.shp'), plot_geometries())
+    return {'folder': folder, 'dsm': str(folder / 'dsm.tif'), 'plots': str(folder / 'plots.shp'), 'dtms': dtms}
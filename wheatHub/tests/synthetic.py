@@ -0,0 +1,37 @@
+"""Synthetic rasters and plot shapefiles for the tests"""
+
+import geopandas as gpd
+import numpy as np
+import rasterio as rio
+from shapely.geometry import Polygon, box
+
+CRS = 'EPSG:32755'
+ORIGIN = (500000.0, 6100000.0)
+
+
+def write_raster(path, data, transform, crs, nodata=None):
+    with rio.open(path, 'w', driver='GTiff', dtype='float32', count=1, width=data.shape[1], height=data.shape[0],
+                  crs=crs, transform=transform, nodata=nodata) as dst:
+        dst.write(data.astype(np.float32), 1)
+
+
+def terrain(xs, ys):
+    # smooth ground surface, so every DTM resolution samples the same landscape
+    return 600 + 0.02 * (xs - ORIGIN[0]) + 0.5 * np.sin((ys - ORIGIN[1]) / 3.0)
+
+
+def plot_geometries():
+    """A grid of plots, a triangle, two overlapping plots and a plot outside the rasters"""
+    geometries = [box(ORIGIN[0] + 2 + 8 * i, ORIGIN[1] - 3 - 6.5 * j, ORIGIN[0] + 7.3 + 8 * i, ORIGIN[1] - 7.9 - 6.5 * j)
+                  for j in range(5) for i in range(5)]
+    geometries[7] = Polygon([(ORIGIN[0] + 18.1, ORIGIN[1] - 9.6), (ORIGIN[0] + 23.2, ORIGIN[1] - 10.2),
+                             (ORIGIN[0] + 20.4, ORIGIN[1] - 14.3)])
+    geometries.append(box(ORIGIN[0] + 5.1, ORIGIN[1] - 5.2, ORIGIN[0] + 12.6, ORIGIN[1] - 11.4))
+    geometries.append(box(ORIGIN[0] - 20, ORIGIN[1] + 10, ORIGIN[0] - 15, ORIGIN[1] + 15))
+    return geometries
+
+
+def write_plots(path, geometries, crs=CRS):
+    gpd.GeoDataFrame({'Plot_ID': range(1000, 1000 + len(geometries)), 'Row': [i // 5 for i in range(len(geometries))],
+                      'Range': [i % 5 for i in range(len(geometries))]},
+                     geometry=geometries, crs=crs).to_file(path)
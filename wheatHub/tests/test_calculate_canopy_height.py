@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio as rio
+
+from rasterio.transform import from_origin
+
+from calculate_canopy_height import get_canopy_height
+from synthetic import CRS, terrain, write_raster
+
+METHODS = ['percentile_99', 'mean', 'max', 'count']
+
+
+def _canopy_height(site, tmp_path, dtm, method, block_size=None, name='full'):
+    csv_path, chm_path = str(tmp_path / (name + '.csv')), str(tmp_path / (name + '_chm.tif'))
+    get_canopy_height(site['plots'], site['dsm'], site['dtms'][dtm], csv_path, method, block_size, chm_path)
+    with rio.open(chm_path) as src:
+        return pd.read_csv(csv_path), src.read(1)
+
+
+@pytest.mark.parametrize('dtm', ['dtm', 'dtm_fine', 'dtm_coarse', 'dtm_4326'])
+@pytest.mark.parametrize('block_size', [64, 100, 333])
+def test_windowed_matches_full(site, tmp_path, dtm, block_size):
+    for method in METHODS:
+        full, full_chm = _canopy_height(site, tmp_path, dtm, method)
+        windowed, windowed_chm = _canopy_height(site, tmp_path, dtm, method, block_size, 'windowed')
+        np.testing.assert_array_equal(windowed_chm, full_chm)
+        pd.testing.assert_frame_equal(windowed[['Plot_ID', 'Row', 'Range']], full[['Plot_ID', 'Row', 'Range']])
+        # sums are reduced in a different order, so means may differ by float32 rounding
+        np.testing.assert_allclose(windowed['canopy_height'], full['canopy_height'], rtol=1e-6, err_msg=method)
+
+
+def test_windowed_without_chm(site, tmp_path):
+    # only the windows around the plots are read
+    full, _ = _canopy_height(site, tmp_path, 'dtm', 'percentile_99')
+    csv_path = str(tmp_path / 'windowed.csv')
+    get_canopy_height(site['plots'], site['dsm'], site['dtms']['dtm'], csv_path, 'percentile_99', block_size=128)
+    pd.testing.assert_frame_equal(pd.read_csv(csv_path), full)
+
+
+def test_plot_outside_rasters(site, tmp_path):
+    full, _ = _canopy_height(site, tmp_path, 'dtm', 'count')
+    windowed, _ = _canopy_height(site, tmp_path, 'dtm', 'count', 100, 'windowed')
+    for heights in (full, windowed):
+        assert heights['canopy_height'].iloc[:-1].gt(0).all()
+        assert heights['canopy_height'].iloc[-1] == 0
+
+
+def test_windowed_dtm_pixel_edge_ties(site, tmp_path):
+    # DSM pixel centres on DTM pixel edges, GDAL may round these to either neighbouring DTM pixel
+    # depending on the window they are read in, every other pixel must match
+    with rio.open(site['dsm']) as src:
+        transform, width, height = src.transform, src.width, src.height
+    dtm_transform = from_origin(transform.c + 0.025, transform.f - 0.025, 0.1, 0.1)
+    rows, cols = np.mgrid[0:height // 2, 0:width // 2]
+    write_raster(str(tmp_path / 'dtm_ties.tif'), terrain(*(dtm_transform * (cols + 0.5, rows + 0.5))),
+                 dtm_transform, CRS, -32767)
+    site = dict(site, dtms={'dtm_ties': str(tmp_path / 'dtm_ties.tif')})
+
+    _, full_chm = _canopy_height(site, tmp_path, 'dtm_ties', 'mean')
+    _, windowed_chm = _canopy_height(site, tmp_path, 'dtm_ties', 'mean', 100, 'windowed')
+    rows, cols = np.nonzero(windowed_chm != full_chm)
+    dtm_cols, dtm_rows = ~dtm_transform * (transform * (cols + 0.5, rows + 0.5))
+    on_edge = (np.abs(dtm_cols - np.round(dtm_cols)) < 1e-6) | (np.abs(dtm_rows - np.round(dtm_rows)) < 1e-6)
+    assert on_edge.all()
@@ -0,0 +1,126 @@
+import numpy as np
+import pytest
+from PIL import Image
+from PIL.TiffImagePlugin import IFDRational
+
+from exifgeotags import COORDINATE_DTYPE, EXIF_HEADER, GPS_IFD, get_coordinates_many, read_exif_header
+
+XMP = ('<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+       '<rdf:Description xmlns:drone-dji="http://www.dji.com/drone-dji/1.0/" '
+       'drone-dji:AbsoluteAltitude="+612.125" drone-dji:RelativeAltitude="+30.250"/></rdf:RDF></x:xmpmeta>')
+
+
+def _dms(value):
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = (value - degrees - minutes / 60) * 3600
+    return IFDRational(degrees, 1), IFDRational(minutes, 1), IFDRational(int(round(seconds * 10000)), 10000)
+
+
+def write_image(path, lat, lon, alt, model='FC6310', image_format='JPEG', xmp=None, original_time=True,
+                endian='>'):
+    """Writes an image geotagged like a drone camera
+
+    Pillow does not write the GPS IFD of TIFF files, so a TIFF is written as the bare TIFF
+    structure of the EXIF block, without any image data
+    """
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (48, 64, 3), dtype=np.uint8))
+    exif = Image.Exif()
+    exif.endian = endian
+    exif[0x0110] = model
+    exif[0x0132] = '2021:10:05 10:11:12'
+    if original_time:
+        exif.get_ifd(0x8769)[0x9003] = '2021:10:05 10:11:42'
+    gps = exif.get_ifd(GPS_IFD)
+    gps[1], gps[2] = 'S' if lat < 0 else 'N', _dms(lat)
+    gps[3], gps[4] = 'W' if lon < 0 else 'E', _dms(lon)
+    gps[5], gps[6] = b'\x01' if alt < 0 else b'\x00', IFDRational(int(round(abs(alt) * 100)), 100)
+    if image_format == 'TIFF':
+        with open(path, 'wb') as tiff_file:
+            tiff_file.write(exif.tobytes()[len(EXIF_HEADER):])
+        return
+    kwargs = {'exif': exif}
+    if xmp is not None:
+        kwargs['xmp'] = xmp.encode()
+    image.save(path, image_format, **kwargs)
+
+
+def _pil_tags(path):
+    """The same tags read through PIL"""
+    if path.endswith('.tif'):
+        exif = Image.Exif()
+        with open(path, 'rb') as tiff_file:
+            exif.load(tiff_file.read())
+    else:
+        with Image.open(path) as image:
+            exif = image.getexif()
+    gps = exif.get_ifd(GPS_IFD)
+    original_time = exif.get_ifd(0x8769).get(0x9003)
+
+    def decimal(dms, ref):
+        value = float(dms[0]) + float(dms[1]) / 60 + float(dms[2]) / 3600
+        return -value if ref in ('S', 'W') else value
+
+    alt = float(gps[6])
+    return {'lat': decimal(gps[2], gps[1]), 'lon': decimal(gps[4], gps[3]),
+            'alt': -alt if gps[5] == b'\x01' else alt, 'time': original_time or exif[0x0132], 'model': exif[0x0110]}
+
+
+@pytest.mark.parametrize('image_format, suffix', [('JPEG', '.JPG'), ('TIFF', '.tif')])
+@pytest.mark.parametrize('endian', ['<', '>'])
+@pytest.mark.parametrize('lat, lon, alt', [(-35.2071, 149.1123, 601.37), (51.4779, -0.0015, -2.5)])
+def test_read_exif_header_matches_pil(tmp_path, image_format, suffix, endian, lat, lon, alt):
+    path = str(tmp_path / ('image' + suffix))
+    write_image(path, lat, lon, alt, image_format=image_format, endian=endian)
+    tags = read_exif_header(path)
+    expected = _pil_tags(path)
+    for key in ('lat', 'lon', 'alt'):
+        assert tags[key] == pytest.approx(expected[key], abs=1e-12), key
+    assert tags['lat'] == pytest.approx(lat, abs=1e-6)
+    assert tags['time'] == expected['time'] == '2021:10:05 10:11:42'
+    assert tags['model'] == expected['model']
+    assert tags['rel_alt'] is None
+
+
+def test_read_exif_header_dji_xmp(tmp_path):
+    path = str(tmp_path / 'DJI_0001.JPG')
+    write_image(path, -35.2, 149.1, 600.0, xmp=XMP, original_time=False)
+    tags = read_exif_header(path)
+    # the GPS altitude is kept, the XMP only adds the height above take off
+    assert tags['alt'] == pytest.approx(600.0)
+    assert tags['rel_alt'] == pytest.approx(30.25)
+    assert tags['time'] == '2021:10:05 10:11:12'
+
+
+def test_read_exif_header_without_gps(tmp_path):
+    path = str(tmp_path / 'nogps.jpeg')
+    Image.new('RGB', (8, 8)).save(path)
+    assert read_exif_header(path) == {'lat': None, 'lon': None, 'alt': None, 'rel_alt': None, 'time': None,
+                                      'model': None}
+    with open(str(tmp_path / 'broken.jpg'), 'wb') as broken:
+        broken.write(b'not a jpeg')
+    with pytest.raises(ValueError):
+        read_exif_header(str(tmp_path / 'broken.jpg'))
+
+
+def test_get_coordinates_many(tmp_path):
+    paths = []
+    for i in range(5):
+        paths.append(str(tmp_path / 'DJI_{:04d}.JPG'.format(i)))
+        write_image(paths[-1], -35.2 - i * 1e-4, 149.1 + i * 1e-4, 600 + i)
+    paths.append(str(tmp_path / 'broken.jpg'))
+    with open(paths[-1], 'wb') as broken:
+        broken.write(b'not a jpeg')
+    paths.append(str(tmp_path / 'missing.jpg'))
+
+    coordinates = get_coordinates_many(paths, workers=3)
+    assert coordinates.dtype == COORDINATE_DTYPE
+    for path, row in zip(paths[:5], coordinates[:5]):
+        expected = _pil_tags(path)
+        assert (row['lat'], row['lon'], row['alt']) == pytest.approx((expected['lat'], expected['lon'],
+                                                                      expected['alt']), abs=1e-12)
+        assert row['time'] == np.datetime64('2021-10-05T10:11:42')
+    # unreadable images are NaN rather than an error
+    assert np.isnan(coordinates['lat'][5:]).all()
+    assert np.isnat(coordinates['time'][5:]).all()
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio import windows
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+from synthetic import CRS, ORIGIN, write_plots
+from tiled_predictor import blend_weights, predict_tiled, tile_offsets
+
+TRANSFORM = from_origin(ORIGIN[0], ORIGIN[1], 0.05, 0.05)
+
+
+def write_orthomosaic(path, height, width):
+    image = np.random.default_rng(3).integers(0, 256, size=(3, height, width), dtype=np.uint8)
+    with rio.open(path, 'w', driver='GTiff', dtype='uint8', count=3, width=width, height=height, crs=CRS,
+                  transform=TRANSFORM) as dst:
+        dst.write(image)
+    return image.transpose(1, 2, 0)
+
+
+def pointwise_model(batch):
+    # N x H x W x 3 -> N x H x W x 1, each pixel on its own
+    return 1 / (1 + np.exp(-(batch[..., :1] - batch[..., 1:2]) / 64))
+
+
+def context_model(batch):
+    # depends on where a pixel is in its tile, so the blend of overlapping tiles matters
+    tile_mean = batch.mean(axis=(1, 2, 3), keepdims=True)[..., 0]
+    return batch[..., 0] / 255 * 0.5 + tile_mean / 255 * 0.5
+
+
+def _read(path):
+    with rio.open(path) as src:
+        return src.read(1)
+
+
+@pytest.mark.parametrize('shape', [(300, 420), (100, 90)])
+def test_pointwise_model_matches_full_image(tmp_path, shape):
+    image = write_orthomosaic(str(tmp_path / 'ortho.tif'), *shape)
+    output = predict_tiled(str(tmp_path / 'ortho.tif'), pointwise_model, tile_height=128, tile_width=96,
+                           stride_height=48, stride_width=40, batch_size=3)
+    assert output == str(tmp_path / 'ortho.tif') + '-predictions.tif'
+    expected = pointwise_model(image[None].astype(np.float32))[0, :, :, 0]
+    np.testing.assert_allclose(_read(output), expected, rtol=1e-5)
+
+
+def test_blend_matches_reference(tmp_path):
+    height, width, tile, stride = 300, 420, 128, 48
+    image = write_orthomosaic(str(tmp_path / 'ortho.tif'), height, width)
+    output = predict_tiled(str(tmp_path / 'ortho.tif'), context_model, tile_height=tile, tile_width=tile,
+                           stride_height=stride, stride_width=stride, batch_size=5)
+
+    # every tile predicted and weighted over the whole image at once
+    weights = blend_weights(tile, tile).astype(np.float64)
+    total = np.zeros((height, width))
+    total_weights = np.zeros((height, width))
+    for row_off in tile_offsets(height, tile, stride):
+        for col_off in tile_offsets(width, tile, stride):
+            batch = image[None, row_off:row_off + tile, col_off:col_off + tile].astype(np.float32)
+            total[row_off:row_off + tile, col_off:col_off + tile] += context_model(batch)[0] * weights
+            total_weights[row_off:row_off + tile, col_off:col_off + tile] += weights
+    np.testing.assert_allclose(_read(output), total / total_weights, rtol=1e-5)
+
+
+def test_tiles_away_from_plots_are_skipped(tmp_path):
+    write_orthomosaic(str(tmp_path / 'ortho.tif'), 300, 420)
+    # pixels 80-100 down and 20-40 across, inside the tile at (64, 0)
+    plot = box(ORIGIN[0] + 1, ORIGIN[1] - 4, ORIGIN[0] + 2, ORIGIN[1] - 5)
+    write_plots(str(tmp_path / 'plots.shp'), [plot])
+    calls = []
+
+    def model(batch):
+        calls.append(len(batch))
+        return np.ones(batch.shape[:3], np.float32)
+
+    output = predict_tiled(str(tmp_path / 'ortho.tif'), model, tile_height=64, tile_width=64, stride_height=64,
+                           stride_width=64, plot_shp=str(tmp_path / 'plots.shp'))
+    predictions = _read(output)
+    plot_window = windows.from_bounds(*plot.bounds, transform=TRANSFORM).round_offsets().round_lengths()
+    assert (predictions[plot_window.toslices()] == 1).all()
+    # only the tile holding the plot is predicted
+    assert sum(calls) == 1
+    assert (predictions[64:128, 0:64] == 1).all()
+    assert np.count_nonzero(predictions) == 64 * 64
+
+
+def test_stride_larger_than_tile(tmp_path):
+    write_orthomosaic(str(tmp_path / 'ortho.tif'), 100, 100)
+    with pytest.raises(ValueError):
+        predict_tiled(str(tmp_path / 'ortho.tif'), pointwise_model, tile_height=32, tile_width=32,
+                      stride_height=40, stride_width=16)
@@ -0,0 +1,155 @@
+import os
+
+import numpy as np
+import pytest
+from rasterio.transform import from_origin
+from rasterstats import zonal_stats
+from shapely.geometry import Polygon, box
+
+import zonal
+from synthetic import ORIGIN, plot_geometries, write_plots
+from zonal import PlotLabels, get_plot_labels, label_cache_path, plot_windows
+
+STATS = ['count', 'sum', 'mean', 'std', 'min', 'max', 'median', 'percentile_99']
+SHAPE = (700, 900)
+TRANSFORM = from_origin(ORIGIN[0], ORIGIN[1], 0.05, 0.05)
+
+
+@pytest.fixture
+def raster():
+    data = np.random.default_rng(1).random(SHAPE).astype(np.float32) * 2
+    data[300:320, 100:180] = -999
+    data[200:210, 50:60] = np.nan
+    return data
+
+
+@pytest.fixture
+def plots_shp(tmp_path):
+    path = str(tmp_path / 'plots.shp')
+    write_plots(path, plot_geometries())
+    return path
+
+
+def _rasterstats(geometries, raster, stats):
+    # rasterstats' percentile is computed the same way but rounded, so it is compared separately
+    return {stat: np.array([np.nan if row[stat] is None else row[stat]
+                            for row in zonal_stats(geometries, raster, affine=TRANSFORM, stats=stats, nodata=-999)],
+                           dtype=np.float64)
+            for stat in stats}
+
+
+def test_zonal_stats_match_rasterstats(raster):
+    geometries = plot_geometries()
+    # a plot inside another and one overlapping the first row of plots
+    geometries += [box(ORIGIN[0] + 3, ORIGIN[1] - 4, ORIGIN[0] + 5, ORIGIN[1] - 6),
+                   Polygon([(ORIGIN[0] + 6, ORIGIN[1] - 2), (ORIGIN[0] + 30, ORIGIN[1] - 4),
+                            (ORIGIN[0] + 6, ORIGIN[1] - 8)])]
+    plot_labels = PlotLabels.from_geometries(geometries, TRANSFORM, SHAPE)
+    result = plot_labels.zonal_stats(raster, STATS, nodata=-999)
+    expected = _rasterstats(geometries, raster, STATS)
+    for stat in STATS:
+        np.testing.assert_allclose(result[stat], expected[stat], rtol=1e-5, equal_nan=True, err_msg=stat)
+    # the plot outside the raster has no pixels
+    assert result['count'][len(plot_geometries()) - 1] == 0
+
+
+def test_overlapping_plots_keep_their_pixels():
+    geometries = [box(ORIGIN[0] + 1, ORIGIN[1] - 1, ORIGIN[0] + 3, ORIGIN[1] - 3),
+                  box(ORIGIN[0] + 2, ORIGIN[1] - 2, ORIGIN[0] + 4, ORIGIN[1] - 4)]
+    plot_labels = PlotLabels.from_geometries(geometries, TRANSFORM, SHAPE)
+    np.testing.assert_array_equal(plot_labels.counts, [1600, 1600])
+    shared = np.intersect1d(plot_labels.plot_pixels(0), plot_labels.plot_pixels(1))
+    assert len(shared) == 400
+    # the label raster gives shared pixels to the later plot
+    assert (plot_labels.labels.ravel()[shared] == 2).all()
+    assert np.count_nonzero(plot_labels.labels) == 2800
+
+
+def test_values_in_windows_match_whole_raster(raster):
+    geometries = plot_geometries()
+    plot_labels = PlotLabels.from_geometries(geometries, TRANSFORM, SHAPE)
+    values, plots = [], []
+    for window, members in plot_windows(geometries, TRANSFORM, SHAPE):
+        window_values, window_plots = plot_labels.values(raster[window.toslices()], window, members)
+        values.append(window_values)
+        plots.append(window_plots)
+    windowed = plot_labels.reduce(np.concatenate(values), np.concatenate(plots), STATS, nodata=-999)
+    full = plot_labels.zonal_stats(raster, STATS, nodata=-999)
+    for stat in STATS:
+        np.testing.assert_allclose(windowed[stat], full[stat], rtol=1e-6, equal_nan=True, err_msg=stat)
+
+
+@pytest.mark.parametrize('halo', [0, 10, 60])
+def test_plot_windows(halo):
+    rng = np.random.default_rng(2)
+    geometries = []
+    for _ in range(300):
+        x, y = rng.uniform(0, 45), rng.uniform(-35, 0)
+        geometries.append(box(ORIGIN[0] + x, ORIGIN[1] + y - rng.uniform(0.1, 3),
+                              ORIGIN[0] + x + rng.uniform(0.1, 3), ORIGIN[1] + y))
+    geometries.append(box(ORIGIN[0] - 20, ORIGIN[1] + 10, ORIGIN[0] - 15, ORIGIN[1] + 15))
+    result = plot_windows(geometries, TRANSFORM, SHAPE, halo)
+
+    # every plot inside the raster is in exactly one window, which covers its bounding box
+    members = np.concatenate([plots for _, plots in result])
+    np.testing.assert_array_equal(np.sort(members), np.arange(300))
+    for window, plots in result:
+        for i in plots:
+            row_start, row_stop, col_start, col_stop = zonal.plot_box(geometries[i], TRANSFORM, SHAPE)
+            assert window.row_off <= row_start and row_stop <= window.row_off + window.height
+            assert window.col_off <= col_start and col_stop <= window.col_off + window.width
+
+    # no two windows overlap once grown by halo
+    boxes = [[w.row_off, w.row_off + w.height, w.col_off, w.col_off + w.width] for w, _ in result]
+    for i, first in enumerate(boxes):
+        for second in boxes[i + 1:]:
+            assert not zonal._boxes_overlap(first, second, halo)
+
+
+def test_plot_windows_chain():
+    # each box only reaches the next through the one merged before it
+    geometries = [box(ORIGIN[0] + 1, ORIGIN[1] - 30, ORIGIN[0] + 2, ORIGIN[1] - 1),
+                  box(ORIGIN[0] + 10, ORIGIN[1] - 2, ORIGIN[0] + 11, ORIGIN[1] - 1),
+                  box(ORIGIN[0] + 1.5, ORIGIN[1] - 20, ORIGIN[0] + 10.5, ORIGIN[1] - 19)]
+    ((window, plots),) = plot_windows(geometries, TRANSFORM, SHAPE)
+    np.testing.assert_array_equal(plots, [0, 1, 2])
+
+
+def test_label_cache_dir(plots_shp, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    zonal._LABEL_CACHE.clear()
+    plot_labels = get_plot_labels(plots_shp, TRANSFORM, SHAPE, cache_dir=cache_dir)
+    cache_path = label_cache_path(plots_shp, TRANSFORM, SHAPE, cache_dir)
+    assert os.listdir(cache_dir) == [os.path.basename(cache_path)]
+    # nothing is written next to the shapefile
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.npz')]
+
+    zonal._LABEL_CACHE.clear()
+    cached = get_plot_labels(plots_shp, TRANSFORM, SHAPE, geometries=[], cache_dir=cache_dir)
+    np.testing.assert_array_equal(cached.indices, plot_labels.indices)
+    np.testing.assert_array_equal(cached.indptr, plot_labels.indptr)
+
+    # a truncated file is rasterised again and replaced
+    with open(cache_path, 'r+b') as npz_file:
+        npz_file.truncate(50)
+    zonal._LABEL_CACHE.clear()
+    again = get_plot_labels(plots_shp, TRANSFORM, SHAPE, cache_dir=cache_dir)
+    np.testing.assert_array_equal(again.indices, plot_labels.indices)
+    np.testing.assert_array_equal(PlotLabels.load(cache_path).indices, plot_labels.indices)
+
+
+def test_label_cache_dir_not_writable(plots_shp, tmp_path):
+    # a file where the cache folder should be, so it can not be created
+    cache_dir = str(tmp_path / 'cache')
+    open(cache_dir, 'w').close()
+    zonal._LABEL_CACHE.clear()
+    plot_labels = get_plot_labels(plots_shp, TRANSFORM, SHAPE, cache_dir=cache_dir)
+    assert plot_labels.counts.sum() > 0
+    assert os.listdir(str(tmp_path)).count('cache') == 1
+
+
+def test_label_cache_memory_only(plots_shp, tmp_path):
+    zonal._LABEL_CACHE.clear()
+    first = get_plot_labels(plots_shp, TRANSFORM, SHAPE)
+    assert get_plot_labels(plots_shp, TRANSFORM, SHAPE) is first
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.npz')]
@@ -0,0 +1,136 @@
+"""This module runs a canopy segmentation model over an orthomosaic in overlapping tiles"""
+"""Tiles are read straight from the GeoTIFF with rasterio windows and pushed through the model in
+batches. Overlapping predictions are blended with a weight map that falls off towards the tile
+edges, where the model has the least context. The output is written to a tiled -predictions.tif
+one band of tile rows at a time, so memory is bounded by tile_height x raster width rather than
+the whole orthomosaic"""
+
+import numpy as np
+import rasterio
+from rasterio import windows
+from shapely.geometry import box
+from zonal import read_plots
+
+
+def tile_offsets(size, tile, stride):
+    """Offsets of tiles of length tile every stride along an axis of length size
+
+    The last tile is aligned with the end of the axis so that every pixel is covered. Axes shorter
+    than a tile get a single (padded) tile at 0
+    """
+    if size <= tile:
+        return [0]
+    offsets = list(range(0, size - tile + 1, stride))
+    if offsets[-1] != size - tile:
+        offsets.append(size - tile)
+    return offsets
+
+
+def blend_weights(tile_height, tile_width):
+    """tile_height x tile_width weights, 1 at the centre and falling linearly to the edges
+
+    Weights stay above 0 so that pixels only covered by the edge of a tile still get a prediction
+    """
+    def ramp(n):
+        x = np.arange(n)
+        return np.minimum(x + 1, n - x).astype(np.float32) / ((n + 1) // 2)
+    return np.outer(ramp(tile_height), ramp(tile_width))
+
+
+def plot_footprint(plot_shp, crs):
+    """Plot geometries of a shapefile in the raster crs, for tile skipping"""
+    gdf = read_plots(plot_shp)
+    if crs is not None and gdf.crs is not None and gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+    return gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)]
+
+
+def _read_tile(src, window, tile_height, tile_width, bands):
+    # tiles hanging over the edge of a small raster are zero padded
+    tile = np.zeros((len(bands), tile_height, tile_width), src.dtypes[bands[0] - 1])
+    data = src.read(bands, window=window)
+    tile[:, :data.shape[1], :data.shape[2]] = data
+    return tile.transpose(1, 2, 0)
+
+
+def predict_tiled(input_tiff, model, tile_height=512, tile_width=512, stride_height=128, stride_width=128,
+                  batch_size=8, bands=(1, 2, 3), preprocess=None, plot_shp=None, output_tiff=None):
+    """Predicts canopy probabilities for an orthomosaic and writes them to a tiled GeoTIFF
+
+    Args:
+        input_tiff (str): Orthomosaic
+        model: Callable (or object with a predict method, e.g. a Keras model) taking an
+            N x tile_height x tile_width x bands float32 batch and returning N x tile_height x
+            tile_width probabilities (a trailing or leading channel of 1 is fine)
+        bands (tuple): 1-based bands of input_tiff fed to the model
+        preprocess: Optional callable applied to each batch (e.g. scaling) before the model,
+            by default the batch is only cast to float32
+        plot_shp (str): If given, tiles not touching a plot are skipped and left at 0
+        output_tiff (str): Defaults to input_tiff + "-predictions.tif"
+
+    Returns:
+        (str): The path of the predictions GeoTIFF
+    """
+    if stride_height > tile_height or stride_width > tile_width:
+        raise ValueError('Strides larger than the tile would leave pixels without a prediction')
+    predict_batch = model.predict if hasattr(model, 'predict') else model
+    output_tiff = output_tiff or input_tiff + "-predictions.tif"
+    bands = list(bands)
+    weights = blend_weights(tile_height, tile_width)
+
+    with rasterio.open(input_tiff) as src:
+        height, width = src.height, src.width
+        footprint = plot_footprint(plot_shp, src.crs) if plot_shp is not None else None
+        profile = {
+            'driver': 'GTiff', 'dtype': 'float32', 'count': 1, 'nodata': None,
+            'crs': src.crs, 'transform': src.transform, 'width': width, 'height': height,
+            'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'deflate', 'BIGTIFF': 'IF_SAFER',
+        }
+        row_offsets = tile_offsets(height, tile_height, stride_height)
+        col_offsets = tile_offsets(width, tile_width, stride_width)
+
+        # weighted sums of the predictions and of the weights for rows buffer_row onwards
+        buffer_rows = min(tile_height, height)
+        predictions = np.zeros((buffer_rows, width), np.float32)
+        total_weights = np.zeros((buffer_rows, width), np.float32)
+        buffer_row = 0
+
+        with rasterio.open(output_tiff, 'w', **profile) as dst:
+            for i, row_off in enumerate(row_offsets):
+                tile_windows = []
+                for col_off in col_offsets:
+                    window = windows.Window(col_off, row_off, min(tile_width, width - col_off),
+                                            min(tile_height, height - row_off))
+                    if footprint is not None and not len(
+                            footprint.sindex.query(box(*windows.bounds(window, src.transform)))):
+                        continue
+                    tile_windows.append(window)
+
+                for start in range(0, len(tile_windows), batch_size):
+                    batch_windows = tile_windows[start:start + batch_size]
+                    batch = np.stack([_read_tile(src, window, tile_height, tile_width, bands)
+                                      for window in batch_windows])
+                    batch = preprocess(batch) if preprocess is not None else batch.astype(np.float32)
+                    batch_predictions = np.asarray(predict_batch(batch), np.float32).reshape(
+                        len(batch_windows), tile_height, tile_width)
+                    for window, prediction in zip(batch_windows, batch_predictions):
+                        h, w = int(window.height), int(window.width)
+                        rows = slice(row_off - buffer_row, row_off - buffer_row + h)
+                        cols = slice(window.col_off, window.col_off + w)
+                        predictions[rows, cols] += prediction[:h, :w] * weights[:h, :w]
+                        total_weights[rows, cols] += weights[:h, :w]
+
+                # rows above the next tile row will not receive any more predictions
+                next_row = row_offsets[i + 1] if i + 1 < len(row_offsets) else height
+                done = next_row - buffer_row
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    blended = np.where(total_weights[:done] > 0, predictions[:done] / total_weights[:done], 0)
+                dst.write(blended.astype(np.float32), 1, window=windows.Window(0, buffer_row, width, done))
+
+                # shift the buffers up to start at the next tile row
+                predictions[:buffer_rows - done] = predictions[done:]
+                predictions[buffer_rows - done:] = 0
+                total_weights[:buffer_rows - done] = total_weights[done:]
+                total_weights[buffer_rows - done:] = 0
+                buffer_row = next_row
+    return output_tiff
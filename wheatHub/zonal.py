@@ -0,0 +1,420 @@
+"""This module computes per-plot zonal statistics from a single rasterisation of the plot shapefile"""
+"""rasterstats.zonal_stats rasterises every polygon again on each call. Here the plots are burnt once
+into a label raster (0 outside the plots, i + 1 inside the i-th plot) and kept as per-plot pixel
+index lists, cached per shapefile version and grid in memory and, optionally, as an .npz in a cache
+folder. Every statistic of every raster is then a gather plus a bincount. As in rasterstats, a pixel
+belongs to a plot when its centre is inside the polygon, and where plots overlap the pixel belongs
+to each of them."""
+"""Trial plots usually cover a small part of a flight, so the plots are rasterised, read and reduced
+only within plot_windows, merged bounding windows of the plots."""
+
+import os
+import math
+import hashlib
+import zipfile
+import numpy as np
+import geopandas as gpd
+from rasterio import windows
+from rasterio.enums import MergeAlg
+from rasterio.features import rasterize
+
+# statistics understood by reduce_by_label, plus 'percentile_<q>' for any q in [0, 100]
+STATISTICS = ('count', 'sum', 'mean', 'std', 'min', 'max', 'median')
+
+# bumped when the pixels PlotLabels.from_geometries assigns to plots change, so old .npz files are not reused
+LABEL_CACHE_VERSION = 2
+
+# (shapefile path, mtime, transform, shape) -> PlotLabels
+_LABEL_CACHE = {}
+# (shapefile path, mtime) -> GeoDataFrame
+_PLOT_CACHE = {}
+
+
+def plot_box(geometry, transform, shape):
+    """Pixel bounds [row_start, row_stop, col_start, col_stop] of a plot clipped to the raster, None if outside"""
+    if geometry is None or geometry.is_empty:
+        return None
+    height, width = shape
+    window = windows.from_bounds(*geometry.bounds, transform=transform)
+    row_start = max(int(math.floor(min(window.row_off, window.row_off + window.height))), 0)
+    row_stop = min(int(math.ceil(max(window.row_off, window.row_off + window.height))), height)
+    col_start = max(int(math.floor(min(window.col_off, window.col_off + window.width))), 0)
+    col_stop = min(int(math.ceil(max(window.col_off, window.col_off + window.width))), width)
+    if row_stop <= row_start or col_stop <= col_start:
+        return None
+    return [row_start, row_stop, col_start, col_stop]
+
+
+def _boxes_overlap(first, second, halo):
+    return (first[0] - halo < second[1] + halo and second[0] - halo < first[1] + halo and
+            first[2] - halo < second[3] + halo and second[2] - halo < first[3] + halo)
+
+
+def _merge_boxes(boxes, halo):
+    """One sweep down the rows merging overlapping boxes, returns the boxes and whether any merged
+
+    Boxes are visited by their first row. A box whose last row is above the current box can not
+    reach it or any later box, so it is retired and only the boxes still open are compared.
+    """
+    boxes.sort(key=lambda b: (b[0], b[2]))
+    done, active = [], []
+    merged = False
+    for current in boxes:
+        still_active = []
+        for other in active:
+            (done if other[1] + halo <= current[0] - halo else still_active).append(other)
+        active = still_active
+
+        # a merged box is larger, so check the open boxes again until none overlap it
+        overlapping = True
+        while overlapping:
+            overlapping = False
+            remaining = []
+            for other in active:
+                if _boxes_overlap(current, other, halo):
+                    current = [min(current[0], other[0]), max(current[1], other[1]),
+                               min(current[2], other[2]), max(current[3], other[3]), current[4] + other[4]]
+                    overlapping = merged = True
+                else:
+                    remaining.append(other)
+            active = remaining
+        active.append(current)
+    return done + active, merged
+
+
+def plot_windows(geometries, transform, shape, halo=0):
+    """Pixel windows covering the plots, with each plot in exactly one window
+
+    Plot bounding boxes (clipped to the raster) are merged where they overlap once grown by halo
+    pixels, so windows padded by halo (see pad_window) for a filter kernel do not overlap either.
+    Plots outside the raster are left out.
+
+    Returns:
+        (list): (Window, array of plot positions) pairs
+    """
+    boxes = []
+    for i, geometry in enumerate(geometries):
+        bounds = plot_box(geometry, transform, shape)
+        if bounds is not None:
+            boxes.append(bounds + [[i]])
+
+    # a box grown by a merge can reach a box retired earlier in the sweep, which takes another
+    # sweep. Plots laid out in a grid are merged in the first one
+    merged = True
+    while merged:
+        boxes, merged = _merge_boxes(boxes, halo)
+
+    return [(windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start),
+             np.array(sorted(plots)))
+            for row_start, row_stop, col_start, col_stop, plots in sorted(boxes, key=lambda b: (b[0], b[2]))]
+
+
+def pad_window(window, halo, shape):
+    """window grown by halo pixels on every side, clipped to a raster of shape (height, width)"""
+    row_start = max(window.row_off - halo, 0)
+    col_start = max(window.col_off - halo, 0)
+    row_stop = min(window.row_off + window.height + halo, shape[0])
+    col_stop = min(window.col_off + window.width + halo, shape[1])
+    return windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def reduce_by_label(values, labels, num_labels, stats):
+    """Statistics of values grouped by labels (0 .. num_labels - 1)
+
+    Returns a dict of stat -> array of length num_labels. count is an int array, the others are
+    float64 and NaN for labels without values. std is the population std (ddof=0) and percentiles
+    use numpy's linear interpolation, both as in rasterstats
+    """
+    values = np.asarray(values)
+    labels = np.asarray(labels)
+    count = np.bincount(labels, minlength=num_labels)
+    empty = count == 0
+    results = {}
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if {'sum', 'mean', 'std'} & set(stats):
+            total = np.bincount(labels, weights=values, minlength=num_labels)
+            mean = total / count
+        if 'std' in stats:
+            # two pass, subtracting the plot mean first avoids cancellation
+            squares = np.bincount(labels, weights=(values - mean[labels]) ** 2, minlength=num_labels)
+            std = np.sqrt(squares / count)
+
+    # min, max, median and percentiles are read from each plot's sorted values
+    order_stats = [stat for stat in stats if stat in ('min', 'max', 'median') or stat.startswith('percentile_')]
+    if order_stats:
+        ends = np.cumsum(count)
+        starts = ends - count
+        order = np.lexsort((values, labels))
+        sorted_values = values[order]
+        groups = np.split(sorted_values, ends[:-1])
+
+    for stat in stats:
+        if stat == 'count':
+            results[stat] = count
+            continue
+        if stat == 'sum':
+            result = total
+        elif stat == 'mean':
+            result = mean
+        elif stat == 'std':
+            result = std
+        elif stat == 'min':
+            result = sorted_values[np.minimum(starts, sorted_values.size - 1)].astype(np.float64)
+        elif stat == 'max':
+            result = sorted_values[np.maximum(ends - 1, 0)].astype(np.float64)
+        elif stat == 'median':
+            result = np.array([np.median(group) if group.size else np.nan for group in groups])
+        elif stat.startswith('percentile_'):
+            q = float(stat[len('percentile_'):])
+            result = np.array([np.percentile(group, q) if group.size else np.nan for group in groups])
+        else:
+            raise ValueError('Unsupported statistic {}'.format(stat))
+        result = np.asarray(result, dtype=np.float64)
+        result[empty] = np.nan
+        results[stat] = result
+    return results
+
+
+class PlotLabels:
+    """Plot polygons rasterised onto a raster grid
+
+    The pixels of each plot are stored CSR style: the flat (row-major) indices of the i-th plot's
+    pixels are indices[indptr[i]:indptr[i + 1]]. A pixel inside overlapping plots is listed for
+    each of them
+    """
+
+    def __init__(self, indptr, indices, shape):
+        self.indptr = indptr
+        self.indices = indices
+        self.shape = tuple(shape)
+        self.num_plots = len(indptr) - 1
+        self._labels = None
+
+    @classmethod
+    def from_labels(cls, labels, num_plots):
+        """From an HW label raster, 0 outside the plots and i + 1 inside the i-th plot"""
+        flat = labels.ravel()
+        indices = np.flatnonzero(flat)
+        plots = flat[indices]
+        order = np.argsort(plots, kind='stable')
+        indptr = np.zeros(num_plots + 1, np.int64)
+        np.cumsum(np.bincount(plots, minlength=num_plots + 1)[1:], out=indptr[1:])
+        return cls(indptr, indices[order], labels.shape)
+
+    @classmethod
+    def from_geometries(cls, geometries, transform, shape):
+        """Rasterises the plots one plot window at a time, memory scales with the plot area
+
+        Each window is burnt into a label raster in one pass. Where plots overlap, the plots
+        reaching an overlapping pixel are then rasterised on their own, so every plot keeps all
+        of its pixels as rasterstats gives them.
+        """
+        geometries = list(geometries)
+        indices, plots = [], []
+        for window, members in plot_windows(geometries, transform, shape):
+            window_shape = (int(window.height), int(window.width))
+            window_transform = windows.transform(window, transform)
+            labels = rasterize([(geometries[i], i + 1) for i in members], out_shape=window_shape,
+                               transform=window_transform, fill=0, dtype='int32')
+            overlaps = None
+            if len(members) > 1:
+                burns = rasterize([(geometries[i], 1) for i in members], out_shape=window_shape,
+                                  transform=window_transform, fill=0, dtype='int32', merge_alg=MergeAlg.add)
+                if burns.max() > 1:
+                    overlaps = burns > 1
+
+            if overlaps is None:
+                rows, cols = np.nonzero(labels)
+                indices.append((rows + window.row_off) * shape[1] + cols + window.col_off)
+                plots.append(labels[rows, cols] - 1)
+                continue
+
+            for i in members:
+                row_start, row_stop, col_start, col_stop = plot_box(geometries[i], transform, shape)
+                bounds = (slice(row_start - window.row_off, row_stop - window.row_off),
+                          slice(col_start - window.col_off, col_stop - window.col_off))
+                if overlaps[bounds].any():
+                    plot_window = windows.Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+                    mask = rasterize([(geometries[i], 1)], out_shape=(row_stop - row_start, col_stop - col_start),
+                                     transform=windows.transform(plot_window, transform), fill=0, dtype='uint8')
+                else:
+                    # none of its pixels are shared, so the label raster has them all
+                    mask = labels[bounds] == i + 1
+                rows, cols = np.nonzero(mask)
+                indices.append((rows + row_start) * shape[1] + cols + col_start)
+                plots.append(np.full(len(rows), i, np.int32))
+
+        indices = np.concatenate(indices) if indices else np.empty(0, np.int64)
+        plots = np.concatenate(plots) if plots else np.empty(0, np.int32)
+        # every plot is inside one window, so a stable sort keeps each plot's pixels row-major
+        order = np.argsort(plots, kind='stable')
+        indptr = np.zeros(len(geometries) + 1, np.int64)
+        np.cumsum(np.bincount(plots, minlength=len(geometries)), out=indptr[1:])
+        return cls(indptr, indices[order].astype(np.int64), shape)
+
+    @classmethod
+    def load(cls, filepath):
+        with np.load(filepath) as data:
+            return cls(data['indptr'], data['indices'], data['shape'])
+
+    def save(self, filepath):
+        """Writes the pixel lists to an .npz, atomically so that readers never see a partial file"""
+        tmp_filepath = '{}.{}.tmp'.format(filepath, os.getpid())
+        try:
+            with open(tmp_filepath, 'wb') as npz_file:
+                np.savez(npz_file, indptr=self.indptr, indices=self.indices, shape=np.array(self.shape))
+            os.replace(tmp_filepath, filepath)
+        except OSError:
+            # leave nothing behind in the cache folder, e.g. when the disk is full
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            raise
+
+    @property
+    def counts(self):
+        """Number of pixels of each plot"""
+        return np.diff(self.indptr)
+
+    @property
+    def labels(self):
+        """HW int32 label raster, 0 outside the plots and i + 1 inside the i-th plot
+
+        A pixel inside overlapping plots is labelled with the last of them
+        """
+        if self._labels is None:
+            labels = np.zeros(self.shape, np.int32)
+            labels.ravel()[self.indices] = np.repeat(np.arange(1, self.num_plots + 1, dtype=np.int32), self.counts)
+            self._labels = labels
+        return self._labels
+
+    def plot_pixels(self, plot):
+        """Flat indices of the pixels of the plot at position plot"""
+        return self.indices[self.indptr[plot]:self.indptr[plot + 1]]
+
+    def values(self, raster, window=None, plots=None):
+        """The pixels of raster inside the plots (grouped by plot) and the plot each belongs to
+
+        Args:
+            raster (numpy ndarray): The whole raster or, if window is given, just that window of it
+            window (Window): Window of the label grid covered by raster, plot pixels outside it
+                are left out
+            plots (array): Positions of the plots to gather, by default all of them
+        """
+        raster = np.asarray(raster)
+        expected = self.shape if window is None else (int(window.height), int(window.width))
+        if raster.shape != expected:
+            raise ValueError('Raster shape {} does not match the plot labels {}'.format(raster.shape, expected))
+        if plots is None:
+            indices = self.indices
+            plots = np.repeat(np.arange(self.num_plots), self.counts)
+        else:
+            plots = np.asarray(plots, dtype=np.int64)
+            indices = np.concatenate([self.plot_pixels(plot) for plot in plots]) if len(plots) else self.indices[:0]
+            plots = np.repeat(plots, self.counts[plots])
+        if window is None:
+            return raster.ravel()[indices], plots
+
+        rows, cols = np.divmod(indices, self.shape[1])
+        rows -= int(window.row_off)
+        cols -= int(window.col_off)
+        inside = (rows >= 0) & (rows < raster.shape[0]) & (cols >= 0) & (cols < raster.shape[1])
+        if not inside.all():
+            rows, cols, plots = rows[inside], cols[inside], plots[inside]
+        return raster[rows, cols], plots
+
+    def zonal_stats(self, raster, stats=('mean',), nodata=None):
+        """Statistics of raster (same grid as the labels) for every plot
+
+        Pixels equal to nodata and NaN pixels are left out, as in rasterstats. Note that
+        rasterstats defaults nodata to -999 for arrays, here None means every pixel is valid.
+
+        Returns:
+            (dict): stat -> array with one value per plot, in shapefile order
+        """
+        return self.reduce(*self.values(raster), stats=stats, nodata=nodata)
+
+    def reduce(self, values, plots, stats=('mean',), nodata=None):
+        """zonal_stats of values gathered with values(), e.g. concatenated over windows"""
+        values = np.asarray(values)
+        plots = np.asarray(plots)
+        valid = np.ones(values.shape, bool) if nodata is None else values != nodata
+        if np.issubdtype(values.dtype, np.floating):
+            valid &= ~np.isnan(values)
+        if not valid.all():
+            values, plots = values[valid], plots[valid]
+        return reduce_by_label(values, plots, self.num_plots, stats)
+
+
+def _shapefile_version(plot_shp):
+    """Path and last modification of a shapefile, the geometries (.shp) or the attributes (.dbf)"""
+    plot_shp = os.path.abspath(plot_shp)
+    mtime = os.stat(plot_shp).st_mtime_ns
+    dbf = os.path.splitext(plot_shp)[0] + '.dbf'
+    if os.path.exists(dbf):
+        mtime = max(mtime, os.stat(dbf).st_mtime_ns)
+    return plot_shp, mtime
+
+
+def read_plots(plot_shp):
+    """Reads a plot shapefile, once per version of the file
+
+    Returns a copy, so callers are free to add columns
+    """
+    key = _shapefile_version(plot_shp)
+    gdf = _PLOT_CACHE.get(key)
+    if gdf is None:
+        gdf = gpd.read_file(plot_shp)
+        _PLOT_CACHE[key] = gdf
+    return gdf.copy()
+
+
+def label_cache_path(plot_shp, transform, shape, cache_dir):
+    """.npz file in cache_dir for the plot labels of a shapefile version on a grid"""
+    plot_shp, mtime = _shapefile_version(plot_shp)
+    key = repr((LABEL_CACHE_VERSION, plot_shp, mtime, tuple(transform)[:6], tuple(shape))).encode()
+    name = os.path.splitext(os.path.basename(plot_shp))[0]
+    return os.path.join(cache_dir, '{}.labels-{}.npz'.format(name, hashlib.sha1(key).hexdigest()[:16]))
+
+
+def get_plot_labels(plot_shp, transform, shape, geometries=None, cache_dir=None):
+    """Plot labels of a shapefile on a raster grid, rasterised once per shapefile version and grid
+
+    Labels are cached in memory and, if cache_dir is given, as an .npz there so that later runs on
+    the same trial grid skip the rasterisation. Failing to write the .npz (e.g. a read-only
+    folder) is not an error, the labels are just rasterised again next run.
+
+    Args:
+        plot_shp (str): Plot shapefile
+        transform (Affine): Transform of the raster grid
+        shape (tuple): (height, width) of the raster grid
+        geometries (GeoSeries): The shapefile's geometries if the caller has already read them
+        cache_dir (str): Optional folder for the on-disk .npz cache
+
+    Returns:
+        (PlotLabels)
+    """
+    key = _shapefile_version(plot_shp) + (tuple(transform)[:6], tuple(shape))
+    plot_labels = _LABEL_CACHE.get(key)
+    if plot_labels is not None:
+        return plot_labels
+
+    cache_path = label_cache_path(plot_shp, transform, shape, cache_dir) if cache_dir is not None else None
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            plot_labels = PlotLabels.load(cache_path)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # truncated or foreign files are rasterised again
+            plot_labels = None
+    if plot_labels is None:
+        if geometries is None:
+            geometries = read_plots(plot_shp)['geometry']
+        plot_labels = PlotLabels.from_geometries(geometries, transform, shape)
+        if cache_path is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                plot_labels.save(cache_path)
+            except OSError:
+                pass
+    _LABEL_CACHE[key] = plot_labels
+    return plot_labels